@@ -0,0 +1,116 @@
+import hashlib
+import math
+
+
+class BloomSlice(object):
+    """
+    A fixed-size Bloom filter whose bit array is split into chunks, so that only modified chunks need to be saved
+    """
+
+    def __init__(self, capacity, error_rate, chunk_size, count=0):
+        """
+        Initialize
+
+        :param capacity: Number of elements the slice holds before the error rate is exceeded
+        :param error_rate: Target false positive rate
+        :param chunk_size: Size in bytes of one persisted chunk of the bit array
+        :param count: Number of elements already added
+        """
+        if capacity <= 0:
+            raise ValueError(f'capacity must be positive: {capacity}')
+        if not 0 < error_rate < 1:
+            raise ValueError(f'error_rate must be between 0 and 1: {error_rate}')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.count = count
+        self.num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.dirty = set()
+
+    @property
+    def num_chunks(self):
+        return math.ceil(len(self.bits) / self.chunk_size)
+
+    def _offsets(self, key):
+        # Kirsch-Mitzenmacher double hashing over a 128 bits digest
+        h1 = int.from_bytes(key[:8], 'big')
+        h2 = int.from_bytes(key[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[o >> 3] & (1 << (o & 7)) for o in self._offsets(key))
+
+    def add(self, key):
+        for o in self._offsets(key):
+            self.bits[o >> 3] |= 1 << (o & 7)
+            self.dirty.add((o >> 3) // self.chunk_size)
+        self.count += 1
+
+    def get_chunk(self, index):
+        return bytes(self.bits[index * self.chunk_size:(index + 1) * self.chunk_size])
+
+    def set_chunk(self, index, data):
+        start = index * self.chunk_size
+        self.bits[start:start + len(data)] = data
+
+
+class ScalableBloomFilter(object):
+    """
+    A Bloom filter that adds a larger and stricter slice each time the last one is full,
+    keeping the overall false positive rate below error_rate however many elements are added
+    """
+    growth = 2
+    tightening_ratio = 0.5
+
+    def __init__(self, capacity, error_rate, chunk_size):
+        """
+        Initialize
+
+        :param capacity: Capacity of the first slice
+        :param error_rate: Target overall false positive rate
+        :param chunk_size: Size in bytes of one persisted chunk of the bit arrays
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.slices = []
+
+    @staticmethod
+    def digest(value):
+        """
+        Hash an arbitrary value to the key format used by the slices
+
+        :param value: Bytes to hash
+        :return: The key
+        """
+        return hashlib.blake2b(value, digest_size=16).digest()
+
+    def __len__(self):
+        return sum(s.count for s in self.slices)
+
+    def __contains__(self, value):
+        key = self.digest(value)
+        return any(key in s for s in self.slices)
+
+    def add(self, value):
+        """
+        Add a value
+
+        :param value: Bytes to add
+        :return: True if the value was not in the filter yet
+        """
+        key = self.digest(value)
+        if any(key in s for s in self.slices):
+            return False
+        if not self.slices or self.slices[-1].count >= self.slices[-1].capacity:
+            n = len(self.slices)
+            self.slices.append(BloomSlice(
+                self.capacity * self.growth ** n,
+                self.error_rate * (1 - self.tightening_ratio) * self.tightening_ratio ** n,
+                self.chunk_size,
+            ))
+        self.slices[-1].add(key)
+        return True
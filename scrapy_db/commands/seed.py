@@ -0,0 +1,63 @@
+import sys
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.misc import load_object
+
+from scrapy_db import defaults
+from scrapy_db.loader import load_requests, load_start_urls
+
+
+class Command(ScrapyCommand):
+    """
+    scrapy seed <spider> [file], load start urls or requests from a file or stdin into the tables of a spider
+    """
+    requires_project = True
+    requires_crawler_process = False
+
+    def syntax(self):
+        return '[options] <spider> [file]'
+
+    def short_desc(self):
+        return 'Load start urls, one per line, from a file or stdin into the database tables of a spider'
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument('--queue', action='store_true',
+                            help='push requests into the request queue, registering them in the dupefilter, '
+                                 'instead of loading start urls')
+        parser.add_argument('--chunk-size', type=int, default=defaults.SEED_CHUNK_SIZE,
+                            help=f'rows inserted per transaction (default: {defaults.SEED_CHUNK_SIZE})')
+
+    def _spider_settings(self, spider_name):
+        """
+        Get the settings with the custom settings of the spider, which may set DB_URL or the table names
+
+        :param spider_name: The name of the spider
+        :return: The settings
+        """
+        settings = self.settings.copy()
+        spider_loader = load_object(settings['SPIDER_LOADER_CLASS']).from_settings(settings.frozencopy())
+        try:
+            spider_loader.load(spider_name).update_settings(settings)
+        except KeyError:
+            pass
+        return settings
+
+    def run(self, args, opts):
+        if len(args) not in (1, 2):
+            raise UsageError()
+        spider_name = args[0]
+        settings = self._spider_settings(spider_name)
+
+        def progress(count, elapsed):
+            sys.stderr.write(f'\r{count} rows loaded ({count / elapsed if elapsed else 0:.0f} rows/sec)')
+
+        load = load_requests if opts.queue else load_start_urls
+        f = sys.stdin if len(args) == 1 or args[1] == '-' else open(args[1], encoding='utf-8')
+        try:
+            count = load(f, settings, spider_name, chunk_size=opts.chunk_size, progress=progress)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        sys.stderr.write(f'\n{count} rows loaded\n')
@@ -0,0 +1,162 @@
+import lzma
+import time
+import zlib
+from collections import Counter
+
+from scrapy_db import defaults
+
+# The first byte of the stored data, telling how the rest was compressed
+RAW = b'\x00'
+ZLIB = b'\x01'
+LZMA = b'\x02'
+ZLIB_DICT = b'\x03'
+
+
+def train_zdict(samples, size=32768, length=16):
+    """
+    Build a zlib preset dictionary from sample payloads, made of their most frequent substrings
+
+    zlib references the end of the dictionary with shorter codes, the most frequent substrings are put last.
+
+    :param samples: Serialized requests representative of the crawl
+    :param size: Maximum size in bytes of the dictionary, zlib uses at most 32 KiB
+    :param length: Length of the substrings counted
+    :return: The dictionary
+    """
+    counter = Counter()
+    for sample in samples:
+        counter.update({sample[i:i + length] for i in range(0, max(1, len(sample) - length + 1), length // 4 or 1)})
+    parts = []
+    total = 0
+    for part, count in counter.most_common():
+        if count < 2 or total + len(part) > size:
+            break
+        parts.append(part)
+        total += len(part)
+    return b''.join(reversed(parts))
+
+
+class CompressedSerializer(object):
+    """
+    Serializer compressing the output of another serializer, with a one byte header telling the format of each row
+
+    Rows without header, written before compression was enabled, are passed to the wrapped serializer as they are,
+    including the text rows of a text serializer. This works with pickle based serializers, whose output never starts
+    with one of the header bytes.
+    """
+    binary = True
+    methods = ('zlib', 'lzma')
+
+    def __init__(self, serializer, method='zlib', level=None, threshold=defaults.SCHEDULER_COMPRESSION_THRESHOLD,
+                 zdict=None, stats=None, spider=None):
+        """
+        Initialize
+
+        :param serializer: The wrapped serializer
+        :param method: zlib or lzma
+        :param level: Compression level, or lzma preset, None for the default of the method
+        :param threshold: Size in bytes below which the data is stored uncompressed
+        :param zdict: zlib preset dictionary, improving the compression of small payloads.
+            It must not change while rows compressed with it are in the table
+        :param stats: Stats collector receiving the sizes and the times
+        :param spider: The spider of the stats
+        """
+        if method not in self.methods:
+            raise ValueError(f'compression method must be one of {self.methods}: {method}')
+        self.serializer = serializer
+        self.method = method
+        self.level = level
+        self.threshold = threshold
+        self.zdict = zdict
+        self.stats = stats
+        self.spider = spider
+
+    @classmethod
+    def from_settings(cls, serializer, settings, stats=None, spider=None):
+        """
+        Wrap a serializer according to the SCHEDULER_COMPRESSION settings
+
+        :param serializer: The wrapped serializer
+        :param settings: The settings
+        :param stats: Stats collector
+        :param spider: The spider of the stats
+        :return: Instance of the current class
+        """
+        zdict = None
+        path = settings.get('SCHEDULER_COMPRESSION_ZDICT')
+        if path:
+            with open(path, 'rb') as f:
+                zdict = f.read()
+        level = settings.get('SCHEDULER_COMPRESSION_LEVEL')
+        return cls(
+            serializer,
+            method=settings.get('SCHEDULER_COMPRESSION'),
+            level=None if level is None else int(level),
+            threshold=settings.getint('SCHEDULER_COMPRESSION_THRESHOLD', defaults.SCHEDULER_COMPRESSION_THRESHOLD),
+            zdict=zdict,
+            stats=stats,
+            spider=spider,
+        )
+
+    def _compress(self, data):
+        if self.method == 'lzma':
+            return LZMA + lzma.compress(data, preset=self.level)
+        level = -1 if self.level is None else self.level
+        if self.zdict:
+            compressor = zlib.compressobj(level, zdict=self.zdict)
+            return ZLIB_DICT + compressor.compress(data) + compressor.flush()
+        return ZLIB + zlib.compress(data, level)
+
+    def _decompress(self, data):
+        header, data = data[:1], data[1:]
+        if header == RAW:
+            return data
+        if header == ZLIB:
+            return zlib.decompress(data)
+        if header == ZLIB_DICT:
+            if not self.zdict:
+                raise ValueError('data compressed with a zlib dictionary, SCHEDULER_COMPRESSION_ZDICT is not set')
+            decompressor = zlib.decompressobj(zdict=self.zdict)
+            return decompressor.decompress(data) + decompressor.flush()
+        if header == LZMA:
+            return lzma.decompress(data)
+        raise ValueError(f'unknown compression header: {header!r}')
+
+    def dumps(self, obj):
+        start = time.perf_counter()
+        data = self.serializer.dumps(obj)
+        if isinstance(data, str):
+            data = data.encode()
+        if len(data) < self.threshold:
+            result = RAW + data
+        else:
+            result = self._compress(data)
+            if len(result) > len(data):
+                result = RAW + data
+        self._inc_stats('encode', start, len(data), len(result))
+        return result
+
+    def loads(self, data):
+        start = time.perf_counter()
+        # a text row written before compression was enabled
+        data = data.encode() if isinstance(data, str) else bytes(data)
+        if data[:1] in (RAW, ZLIB, LZMA, ZLIB_DICT):
+            data = self._decompress(data)
+        if not getattr(self.serializer, 'binary', False):
+            data = data.decode()
+        result = self.serializer.loads(data)
+        self._inc_stats('decode', start)
+        return result
+
+    def _inc_stats(self, action, start, size=None, compressed_size=None):
+        if self.stats is None:
+            return
+        self.stats.inc_value(f'scheduler/compression/{action}_time', time.perf_counter() - start, spider=self.spider)
+        if size is None:
+            return
+        self.stats.inc_value('scheduler/compression/bytes', size, spider=self.spider)
+        self.stats.inc_value('scheduler/compression/compressed_bytes', compressed_size, spider=self.spider)
+        compressed = self.stats.get_value('scheduler/compression/compressed_bytes', spider=self.spider)
+        if compressed:
+            ratio = self.stats.get_value('scheduler/compression/bytes', spider=self.spider) / compressed
+            self.stats.set_value('scheduler/compression/ratio', round(ratio, 3), spider=self.spider)
@@ -1,9 +1,19 @@
+import contextlib
 import copy
+import functools
+import select
+import threading
+import time
 from abc import ABCMeta, abstractmethod
+from urllib.parse import urlparse
 
-from peewee import DateTimeField, CharField, BigAutoField, Model, IntegerField, SQL, BooleanField
-from playhouse.db_url import connect
+from peewee import DateTimeField, CharField, BigAutoField, Model, IntegerField, SQL, BooleanField, BlobField, \
+    chunked, fn, MySQLDatabase, PostgresqlDatabase, SqliteDatabase, BigIntegerField, Entity, NodeList
+from playhouse.db_url import schemes, parseresult_to_dict
+from playhouse.pool import PooledDatabase
+from playhouse.shortcuts import ReconnectMixin
 
+from scrapy_db import defaults
 from scrapy_db.utils import execute_with_timeout
 
 
@@ -23,13 +33,14 @@ class BaseDB(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def pop(self, timeout=0, desc=True):
+    def pop(self, timeout=0, desc=True, batch_size=None):
         """
         Remove an element from the queue, support FIFO and LIFO
 
         :param timeout: Timeout parameter
         :param desc: FIFO or LIFO, default is FIFO
-        :return: The element removed from the queue
+        :param batch_size: Number of elements to remove at once, None to remove a single element
+        :return: The element removed from the queue, or the list of elements if batch_size is given
         """
         pass
 
@@ -43,12 +54,15 @@ class BaseDB(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def pop_by_score(self, timeout=0):
+    def pop_by_score(self, timeout=0, batch_size=None, score=None, slot=None):
         """
-        Remove an element from the queue by score
+        Remove the element with the lowest score from the queue, the oldest one among equal scores
 
         :param timeout: Timeout parameter
-        :return: The element removed from the queue
+        :param batch_size: Number of elements to remove at once, None to remove a single element
+        :param score: Only remove elements with this score
+        :param slot: Only remove elements of this download slot, for queues with a slot field
+        :return: The element removed from the queue, or the list of elements if batch_size is given
         """
         pass
 
@@ -69,26 +83,346 @@ def get_model_class_for_db(name, attrs) -> Model:
     :return: The model class
     """
     attrs_ = copy.deepcopy(_attributes)
-    attrs_.update(attrs)
+    # fields are bound to the model they are created with, each model needs its own instances
+    attrs_.update(copy.deepcopy(attrs))
     return type(f'{name.capitalize()}Model', (Model,), attrs_)  # noqa
 
 
+class LongBlobField(BlobField):
+    """
+    A BlobField stored as LONGBLOB on MySQL, where a BLOB holds at most 64 KiB
+    """
+
+    def ddl_datatype(self, ctx):
+        if isinstance(self.model._meta.database, MySQLDatabase):  # noqa
+            return SQL('LONGBLOB')
+        return super().ddl_datatype(ctx)
+
+
 # A dictionary that stores the fields of the model class
 _params = {
     'dupelifter': {
         'key_': CharField(),
     },
+    'dupelifter_unique': {
+        'key_': CharField(unique=True),
+    },
+    'bloom': {
+        'slice_': IntegerField(),
+        'chunk': IntegerField(),
+        'data': BlobField(),
+    },
+    'fragment': {
+        'hash_': CharField(max_length=32, unique=True),
+        'data': LongBlobField(),
+    },
     'start_url': {
         'start_url': CharField(),
         'deleted': BooleanField(default=False, constraints=[SQL('DEFAULT 0')])
     },
     'queue': {
         'key_': CharField(max_length=10000),
-        'score': IntegerField(index=True, default=0, constraints=[SQL('DEFAULT 0')]),
+        'score': IntegerField(default=0, constraints=[SQL('DEFAULT 0')]),
         'deleted': BooleanField(default=False, constraints=[SQL('DEFAULT 0')])
     }
 }
 
+# The composite indexes matching the queries run on each kind of table
+_indexes = {
+    'dupelifter': [('key_',)],
+    'bloom': [('slice_', 'chunk')],
+    'start_url': [('deleted', 'id')],
+    'queue': [('deleted', 'score', 'id'), ('deleted', 'id')],
+}
+
+# The indexes created by earlier versions and covered by the composite ones, dropped from existing tables
+_legacy_indexes = {
+    'queue': [('score',)],
+}
+
+# The fields added to a queue whose popped rows are leased until acknowledged
+_lease_fields = {
+    'lease_expire': BigIntegerField(null=True, index=True),
+    'worker': CharField(null=True),
+    'attempts': IntegerField(default=0, constraints=[SQL('DEFAULT 0')]),
+}
+
+# The fields replacing the text ones of a queue whose serializer returns bytes
+_binary_fields = {
+    'key_': LongBlobField(),
+}
+
+# The indexes of a leased queue, pending rows have no lease
+_lease_indexes = [('deleted', 'lease_expire', 'score', 'id'), ('deleted', 'lease_expire', 'id')]
+
+# The field of a queue recording the download slot of each request
+_slot_fields = {
+    'slot': CharField(default='', constraints=[SQL("DEFAULT ''")]),
+}
+
+# The index of the pops of a single slot, added to the queue or lease indexes
+_slot_indexes = [('deleted', 'slot', 'score', 'id')]
+_slot_lease_indexes = [('deleted', 'lease_expire', 'slot', 'score', 'id')]
+
+
+def create_missing_indexes(model):
+    """
+    Create the indexes of a model missing from its table, for databases without CREATE INDEX IF NOT EXISTS
+
+    :param model: The model class
+    :return: None
+    """
+    database = model._meta.database  # noqa
+    existing = {index.name for index in database.get_indexes(model._meta.table_name)}  # noqa
+    for index in model._meta.fields_to_index():  # noqa
+        if index._name not in existing:  # noqa
+            database.execute(model._schema._create_index(index, safe=False))  # noqa
+
+
+def drop_legacy_indexes(model, legacy):
+    """
+    Drop the non unique indexes of a table on exactly the given columns, so that writes do not maintain them
+
+    :param model: The model class
+    :param legacy: The list of the column tuples of the indexes to drop
+    :return: None
+    """
+    database = model._meta.database  # noqa
+    table = model._meta.table_name  # noqa
+    for index in database.get_indexes(table):
+        if not index.unique and tuple(index.columns) in legacy:
+            query = NodeList((SQL('DROP INDEX'), Entity(index.name)))
+            if isinstance(database, MySQLDatabase):
+                query = NodeList((query, SQL('ON'), Entity(table)))
+            database.execute(query)
+
+
+def check_unique_indexes(model):
+    """
+    Check that the unique fields of a model have a unique index in its table, which an existing table created
+    without them lacks, as inserts relying on conflicts would silently add duplicates
+
+    :param model: The model class
+    :return: None
+    """
+    columns = [f.column_name for f in model._meta.sorted_fields if f.unique]  # noqa
+    if not columns:
+        return
+    table = model._meta.table_name  # noqa
+    indexed = {tuple(index.columns) for index in model._meta.database.get_indexes(table) if index.unique}  # noqa
+    for column in columns:
+        if (column,) not in indexed:
+            raise RuntimeError(f'Table {table} has no unique index on {column}, it was created before the index '
+                               f'was required. Drop the table, or remove its duplicates and create the index.')
+
+
+def check_binary_columns(model):
+    """
+    Check that the blob fields of a model are binary columns in its table, which an existing table created
+    with a text column lacks. SQLite stores bytes in any column and is not checked
+
+    :param model: The model class
+    :return: None
+    """
+    database = model._meta.database  # noqa
+    if isinstance(database, SqliteDatabase):
+        return
+    fields = [f.column_name for f in model._meta.sorted_fields if isinstance(f, BlobField)]  # noqa
+    if not fields:
+        return
+    table = model._meta.table_name  # noqa
+    types = {c.name: c.data_type.lower() for c in database.get_columns(table)}
+    for column in fields:
+        if column in types and not any(t in types[column] for t in ('blob', 'bytea', 'binary')):
+            raise RuntimeError(f'Column {column} of table {table} is {types[column]}, it was created for a text '
+                               f'serializer. Convert it to a binary column, LONGBLOB on MySQL or BYTEA on PostgreSQL, '
+                               f'or use another table.')
+
+
+class PoolStatsMixin(object):
+    """
+    Record the connections checked out of the pool and the time spent waiting for them
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_time = 0.0
+        self.max_checkout_time = 0.0
+
+    def connect(self, reuse_if_open=False):
+        start = time.perf_counter()
+        result = super().connect(reuse_if_open)
+        elapsed = time.perf_counter() - start
+        self.checkouts += 1
+        self.checkout_time += elapsed
+        self.max_checkout_time = max(self.max_checkout_time, elapsed)
+        return result
+
+
+# The databases shared by the models, keyed by DB_URL
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(settings, url=None):
+    """
+    Return the database of DB_URL, created on first use and shared by every model built with the same url
+
+    The pool parameters of the first settings using an url apply to every model built with it.
+
+    :param settings: The settings
+    :param url: The url of the database, DB_URL if None
+    :return: The database
+    """
+    if url is None:
+        url = settings.get('DB_URL')
+    assert url is not None
+    with _databases_lock:
+        if url not in _databases:
+            _databases[url] = _create_database(settings, url)
+        return _databases[url]
+
+
+def shard_tables(settings, name):
+    """
+    Get the shards of a table, SCHEDULER_SHARD_TABLES tables on each database of SCHEDULER_SHARD_URLS
+
+    :param settings: The settings
+    :param name: The name of the table, suffixed with the index of the table on its database if there are several
+    :return: The list of the url and the table name of each shard
+    """
+    urls = settings.getlist('SCHEDULER_SHARD_URLS', defaults.SCHEDULER_SHARD_URLS) or [settings.get('DB_URL')]
+    tables = settings.getint('SCHEDULER_SHARD_TABLES', defaults.SCHEDULER_SHARD_TABLES)
+    if tables < 1:
+        raise ValueError(f'SCHEDULER_SHARD_TABLES must be at least 1: {tables}')
+    return [(url, name if tables == 1 else f'{name}_{i}') for url in urls for i in range(tables)]
+
+
+def _getbool(settings, name, default):
+    value = settings.get(name, default)
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true')
+    return bool(value)
+
+
+def _create_database(settings, url):
+    parsed = urlparse(url)
+    scheme = parsed.scheme
+    kwargs = parseresult_to_dict(parsed)
+    # an in-memory SQLite database lives as long as its connection, it is never pooled
+    pool = _getbool(settings, 'DB_POOL', defaults.DB_POOL) and kwargs.get('database') != ':memory:'
+    if pool and not scheme.endswith('+pool') and f'{scheme}+pool' in schemes:
+        scheme = f'{scheme}+pool'
+    database_class = schemes.get(scheme)
+    if database_class is None:
+        raise RuntimeError(f'Unrecognized or unsupported scheme: "{parsed.scheme}".')
+    bases = (database_class,)
+    if issubclass(database_class, PooledDatabase):
+        bases = (PoolStatsMixin,) + bases
+        kwargs.setdefault('max_connections',
+                          int(settings.get('DB_POOL_MAX_CONNECTIONS', defaults.DB_POOL_MAX_CONNECTIONS)))
+        kwargs.setdefault('stale_timeout', int(settings.get('DB_POOL_STALE_TIMEOUT', defaults.DB_POOL_STALE_TIMEOUT)))
+        kwargs.setdefault('timeout', int(settings.get('DB_POOL_TIMEOUT', defaults.DB_POOL_TIMEOUT)))
+        if issubclass(database_class, SqliteDatabase):
+            # a connection returned to the pool is checked out again by any thread, one at a time
+            kwargs.setdefault('check_same_thread', False)
+    if _getbool(settings, 'DB_RECONNECT', defaults.DB_RECONNECT) and issubclass(database_class, MySQLDatabase):
+        bases = (ReconnectMixin,) + bases
+    if len(bases) > 1:
+        database_class = type(database_class.__name__, bases, {})
+    return database_class(**kwargs)
+
+
+def pool_stats():
+    """
+    Return the statistics of the connection pools, summed over all urls
+
+    :return: A dictionary of statistics, empty without pooled database
+    """
+    stats = {}
+    for database in list(_databases.values()):
+        if not isinstance(database, PoolStatsMixin):
+            continue
+        stats['checkouts'] = stats.get('checkouts', 0) + database.checkouts
+        stats['checkout_time'] = stats.get('checkout_time', 0) + database.checkout_time
+        stats['max_checkout_time'] = max(stats.get('max_checkout_time', 0), database.max_checkout_time)
+        stats['in_use'] = stats.get('in_use', 0) + len(database._in_use)  # noqa
+        stats['idle'] = stats.get('idle', 0) + len(database._connections)  # noqa
+    return stats
+
+
+def release_connections():
+    """
+    Return the connection of the current thread to the pool of every pooled database, unless a transaction is open
+
+    A pooled database keeps one connection per thread until the thread closes it, this ends a unit of work run
+    outside of DBModel, such as a call in a worker thread.
+
+    :return: None
+    """
+    for database in list(_databases.values()):
+        if isinstance(database, PooledDatabase) and not database.is_closed() and not database.in_transaction():
+            database.close()
+
+
+def close_databases():
+    """
+    Return the connection of the current thread to the pool and close the idle connections of every pooled database
+
+    The databases reconnect on next use.
+
+    :return: None
+    """
+    release_connections()
+    for database in list(_databases.values()):
+        if isinstance(database, PooledDatabase):
+            database.close_idle()
+
+
+@contextlib.contextmanager
+def connection_scope(database):
+    """
+    Hold a connection of a pooled database for a unit of work, returned to the pool at its end unless the thread
+    held one already
+
+    :param database: The database
+    :return: Context manager yielding whether the connection was checked out for this unit of work
+    """
+    if not isinstance(database, PooledDatabase) or not database.is_closed():
+        yield False
+        return
+    database.connect()
+    try:
+        yield True
+    finally:
+        if not database.is_closed():
+            database.close()
+
+
+def db_connection(fun):
+    """
+    Run a method of DBModel in a connection_scope, so that a thread does not keep a pooled connection between calls
+
+    :param fun: The function to be executed
+    :return: The inner function
+    """
+
+    @functools.wraps(fun)
+    def inner(self, *args, **kwargs):
+        if self.db is None:
+            return fun(self, *args, **kwargs)
+        with connection_scope(self.db._meta.database) as scoped:  # noqa
+            try:
+                return fun(self, *args, **kwargs)
+            finally:
+                if scoped and self._listening:
+                    # the connection goes back to the pool, the next unit of work may get another one
+                    self.db._meta.database.execute_sql(f'UNLISTEN "{self.db._meta.table_name}"')  # noqa
+                    self._listening = False
+
+    return inner
+
 
 def db_require(fun):
     """
@@ -98,6 +432,7 @@ def db_require(fun):
     :return: The inner function
     """
 
+    @functools.wraps(fun)
     def inner(self, *args, **kwargs):
         if self.db is None:
             raise ValueError('db is None!')
@@ -107,73 +442,393 @@ def db_require(fun):
 
 
 class DBModel(BaseDB):
-    def __init__(self, db=None):
+    retentions = ('soft', 'delete', 'compact')
+
+    def __init__(self, db=None, lease_time=0, worker_id=None, max_attempts=0, notify=False,
+                 retention=defaults.DB_RETENTION,
+                 compact_interval=defaults.DB_COMPACT_INTERVAL,
+                 compact_chunk_size=defaults.DB_COMPACT_CHUNK_SIZE,
+                 compact_max_chunks=defaults.DB_COMPACT_MAX_CHUNKS):
+        """
+        Initialize
+
+        :param db: The model class
+        :param lease_time: Seconds a popped row stays leased before it is requeued, 0 to remove popped rows directly
+        :param worker_id: The worker recorded on the leased rows
+        :param max_attempts: Number of leases after which an expired row is removed instead of requeued, 0 for no limit
+        :param notify: Whether pushes send a PostgreSQL NOTIFY waking up the pops waiting for rows
+        :param retention: DB_RETENTION, how removed rows are handled: marked deleted (soft),
+            deleted (delete), or marked deleted and periodically deleted (compact)
+        :param compact_interval: DB_COMPACT_INTERVAL, seconds between two compactions
+        :param compact_chunk_size: DB_COMPACT_CHUNK_SIZE, maximum number of rows deleted per statement
+        :param compact_max_chunks: DB_COMPACT_MAX_CHUNKS, maximum number of statements of a compaction run by a pop
+        """
+        if retention not in self.retentions:
+            raise ValueError(f'retention must be one of {self.retentions}: {retention}')
         self.db: Model = db
+        self.lease_time = lease_time
+        self.worker_id = worker_id
+        self.max_attempts = max_attempts
+        self.notify = notify
+        self._listening = False
+        self.retention = retention
+        self.compact_interval = compact_interval
+        self.compact_chunk_size = compact_chunk_size
+        self.compact_max_chunks = compact_max_chunks
+        self._compacted = 0
 
     @classmethod
-    def build_model_from_settings(cls, settings, name, key):
+    def build_model_from_settings(cls, settings, name, key, fields=None, indexes=None, url=None, **kwargs):
         """
         Initialize an instance of the current class based on the settings and name
 
+        Missing tables and indexes are created, so this is safe to call on every start.
+
         :param settings: The settings
         :param name: The name
         :param key: The key in the field dictionary
+        :param fields: Fields added to or replacing the ones of the key
+        :param indexes: Composite indexes replacing the ones of the key
+        :param url: The url of the database, DB_URL if None
+        :param kwargs: Arguments of the current class
         :return: An instance of the model class
         """
         attrs = _params.get(key)
         if not attrs:
             raise ValueError(f'key {key} not found in params!')
+        if fields:
+            attrs = dict(attrs, **fields)
+        kwargs.setdefault('retention', settings.get('DB_RETENTION', defaults.DB_RETENTION))
+        kwargs.setdefault('compact_interval', float(settings.get('DB_COMPACT_INTERVAL', defaults.DB_COMPACT_INTERVAL)))
+        kwargs.setdefault('compact_chunk_size',
+                          int(settings.get('DB_COMPACT_CHUNK_SIZE', defaults.DB_COMPACT_CHUNK_SIZE)))
+        kwargs.setdefault('compact_max_chunks',
+                          int(settings.get('DB_COMPACT_MAX_CHUNKS', defaults.DB_COMPACT_MAX_CHUNKS)))
         model = get_model_class_for_db(name, attrs)
-        url = settings.get('DB_URL')
-        assert url is not None
-        model._meta.database = connect(url)  # noqa
-        model._meta.table_name = name  # noqa
-        model.create_table()
-        return cls(model)
-
+        model._meta.database = get_database(settings, url)  # noqa
+        model._meta.set_table_name(name)  # noqa
+        for columns in (_indexes.get(key, []) if indexes is None else indexes):
+            index_fields = [getattr(model, c) for c in columns]
+            if len(index_fields) == 1:
+                # named apart from the index of a unique field on the same column, which would be skipped otherwise
+                model.add_index(model.index(*index_fields, name=f'{name}_{columns[0]}_idx'))
+            else:
+                model.add_index(*index_fields)
+        with connection_scope(model._meta.database):  # noqa
+            model.create_table()
+            if not model._meta.database.safe_create_index:  # noqa
+                create_missing_indexes(model)
+            if key in _legacy_indexes:
+                drop_legacy_indexes(model, _legacy_indexes[key])
+            check_unique_indexes(model)
+            check_binary_columns(model)
+        return cls(model, **kwargs)
+
+    @db_connection
     @db_require
     def push(self, **value):
         self.db.create(**value)
+        self._notify()
+
+    def _notifies(self):
+        return self.notify and isinstance(self.db._meta.database, PostgresqlDatabase)  # noqa
+
+    def _notify(self):
+        if self._notifies():
+            self.db._meta.database.execute_sql(f'NOTIFY "{self.db._meta.table_name}"')  # noqa
+
+    def wait_for_push(self, timeout):
+        """
+        Wait until a row is pushed or the timeout has elapsed, called by execute_with_timeout between two pops
+
+        With notify on PostgreSQL the wait ends on the NOTIFY sent by the push, other databases sleep.
+
+        :param timeout: Maximum number of seconds to wait
+        :return: None
+        """
+        if not self._notifies():
+            time.sleep(timeout)
+            return
+        database = self.db._meta.database  # noqa
+        connection = database.connection()
+        if not self._listening:
+            database.execute_sql(f'LISTEN "{self.db._meta.table_name}"')  # noqa
+            self._listening = True
+        if not connection.notifies:
+            select.select([connection], [], [], timeout)
+            connection.poll()
+        del connection.notifies[:]
+
+    @db_connection
+    @db_require
+    def push_many(self, rows, batch_size=1000, ignore_conflicts=False):
+        """
+        Insert rows with multi-row INSERT statements in one transaction
+
+        :param rows: The rows to insert, all with the same fields
+        :param batch_size: Maximum number of rows per statement
+        :param ignore_conflicts: Skip the rows violating a unique index instead of failing
+        :return: None
+        """
+        with self.db._meta.database.atomic():  # noqa
+            for batch in chunked(rows, batch_size):
+                query = self.db.insert_many(batch)
+                if ignore_conflicts:
+                    query = query.on_conflict_ignore()
+                query.execute()
+        self._notify()
+
+    @db_connection
+    @db_require
+    def push_unique(self, **value):
+        """
+        Insert a row unless it violates a unique index, in a single statement
+
+        :param value: The row to insert
+        :return: True if the row was inserted, False if it already existed
+        """
+        query = self.db.insert(**value).on_conflict_ignore()
+        return self.db._meta.database.execute(query).rowcount > 0  # noqa
 
+    @db_connection
     @db_require
     def drop_table(self):
         self.db.drop_table()
 
+    @db_connection
     @execute_with_timeout
     @db_require
     def pop(self, timeout=0, desc=True, batch_size=None):
-        if not batch_size:
-            result = self.db.select().where(self.db.deleted == 0).order_by(
-                self.db.id.desc() if desc else self.db.id.asc()).limit(1).first()
-            if result:
-                self._delete(result)
-            return result
+        query = self.db.select().where(self._pending()).order_by(
+            self.db.id.desc() if desc else self.db.id.asc())
+        return self._claim(query, batch_size)
+
+    def _pending(self):
+        """
+        The condition matching the rows waiting in the queue
+
+        :return: The where expression
+        """
+        if self.lease_time:
+            return (self.db.deleted == 0) & self.db.lease_expire.is_null()
+        return self.db.deleted == 0
+
+    def _claim(self, query, batch_size=None):
+        """
+        Remove the first rows of a query from the queue, atomically so that concurrent processes never get the same row
+
+        MySQL and PostgreSQL lock the selected rows with FOR UPDATE SKIP LOCKED, so other processes skip them
+        instead of waiting. SQLite takes the write lock before selecting with BEGIN IMMEDIATE.
+
+        :param query: The query selecting the rows in order
+        :param batch_size: Number of rows to remove, None to remove a single row
+        :return: The list of rows if batch_size is given, otherwise the row or None
+        """
+        database = self.db._meta.database  # noqa
+        if isinstance(database, (MySQLDatabase, PostgresqlDatabase)):
+            query = query.for_update('FOR UPDATE SKIP LOCKED')
+            transaction = database.atomic()
+        elif isinstance(database, SqliteDatabase):
+            transaction = database.atomic('IMMEDIATE')
         else:
-            result = self.db.select().where(self.db.deleted == 0).order_by(
-                self.db.id.desc() if desc else self.db.id.asc()).limit(batch_size)
-            if result.count() > 0:
-                self._delete(*copy.deepcopy(list(result)))
+            transaction = database.atomic()
+        with transaction:
+            result = list(query.limit(batch_size or 1))
+            if self.lease_time:
+                self._lease(*result)
+            else:
+                self._delete(*result)
+        self._compact_if_due()
+        if batch_size:
             return result
+        return result[0] if result else None
 
     def _delete(self, *results):
         if results:
-            self.db.update(deleted=1).where(self.db.id.in_([a.id for a in results])).execute()
+            self._remove(self.db.id.in_([a.id for a in results]))
+
+    def _remove(self, condition):
+        """
+        Remove the matching rows from the queue, by deleting them or by marking them deleted depending on retention
+
+        :param condition: The where expression
+        :return: The number of rows
+        """
+        if self.retention == 'delete':
+            return self.db.delete().where(condition).execute()
+        values = {'deleted': 1}
+        if self.lease_time:
+            values['lease_expire'] = None
+        return self.db.update(**values).where(condition).execute()
+
+    def _compact_if_due(self):
+        if self.retention == 'compact' and time.time() - self._compacted >= self.compact_interval:
+            self._compacted = time.time()
+            # a pop never purges a large backlog of deleted rows at once
+            self.compact(self.compact_max_chunks)
+
+    @db_connection
+    @db_require
+    def compact(self, max_chunks=None):
+        """
+        Delete the rows marked deleted, compact_chunk_size rows per statement
+
+        :param max_chunks: Maximum number of statements, None to delete every row marked deleted
+        :return: The number of deleted rows
+        """
+        total = 0
+        chunks = 0
+        while max_chunks is None or chunks < max_chunks:
+            ids = [r.id for r in self.db.select(self.db.id).where(self.db.deleted == 1).limit(self.compact_chunk_size)]
+            if ids:
+                total += self.db.delete().where(self.db.id.in_(ids)).execute()
+            chunks += 1
+            if len(ids) < self.compact_chunk_size:
+                break
+        return total
+
+    def _lease(self, *results):
+        if results:
+            self.db.update(lease_expire=int(time.time()) + self.lease_time, worker=self.worker_id,
+                           attempts=self.db.attempts + 1).where(self.db.id.in_([a.id for a in results])).execute()
 
+    @db_connection
     @db_require
-    def fetch_data(self, batch_size=1):
-        result = self.db.select().where(self.db.deleted == 0).order_by(self.db.id.desc()).limit(batch_size)
-        if result.count() > 0:
-            self._delete(*copy.deepcopy(list(result)))
-        return list(result)
+    def ack(self, *ids):
+        """
+        Remove leased rows from the queue once they have been processed
+
+        :param ids: The ids of the rows
+        :return: None
+        """
+        if ids:
+            self._remove(self.db.id.in_(ids))
 
+    @db_connection
+    @db_require
+    def requeue_expired(self):
+        """
+        Put the rows whose lease has expired back into the queue, or remove them after max_attempts leases
+
+        :return: The number of requeued rows
+        """
+        expired = (self.db.deleted == 0) & (self.db.lease_expire < int(time.time()))
+        if self.max_attempts:
+            self._remove(expired & (self.db.attempts >= self.max_attempts))
+        return self.db.update(lease_expire=None, worker=None).where(expired).execute()
+
+    @db_connection
+    @db_require
+    def fetch_data(self, batch_size=1, after=None):
+        """
+        Remove a batch of rows from the table
+
+        :param batch_size: Number of rows to remove
+        :param after: Only remove rows with a greater id, in ascending id order, to page through the table.
+            None removes the newest rows
+        :return: The list of rows
+        """
+        if after is None:
+            query = self.db.select().where(self._pending()).order_by(self.db.id.desc())
+        else:
+            query = self.db.select().where(self._pending() & (self.db.id > after)).order_by(self.db.id.asc())
+        return self._claim(query, batch_size)
+
+    @db_connection
     @db_require
     def __len__(self):
-        return self.db.select().where(self.db.deleted == 0).count()
+        return self.db.select().where(self._pending()).count()
+
+    @db_require
+    def scan(self, *fields, batch_size=1000):
+        """
+        Iterate over the rows not marked deleted, leased ones included, in id order with one query per batch
+
+        :param fields: The names of the fields read, besides the id
+        :param batch_size: Number of rows per query
+        :return: The generator of rows
+        """
+        after = 0
+        while True:
+            with connection_scope(self.db._meta.database):  # noqa
+                rows = list(self.db.select(self.db.id, *[getattr(self.db, f) for f in fields]).where(
+                    (self.db.deleted == 0) & (self.db.id > after)).order_by(self.db.id).limit(batch_size))
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            after = rows[-1].id
+
+    @db_connection
+    @db_require
+    def exists(self):
+        """
+        Check whether the queue has at least one element, without counting them
+
+        :return: Whether the queue is not empty
+        """
+        return self.db.select(self.db.id).where(self._pending()).exists()
 
+    @db_connection
     @execute_with_timeout
     @db_require
-    def pop_by_score(self, timeout=0):
-        result = self.db.select().where(self.db.deleted == 0).order_by(self.db.score.desc()).limit(1).first()
-        if result:
-            self._delete(result)
-        return result if result else None
+    def pop_by_score(self, timeout=0, batch_size=None, score=None, slot=None):
+        condition = self._pending()
+        if slot is not None:
+            condition &= self.db.slot == slot
+        if score is not None:
+            condition &= self.db.score == score
+        # the (deleted, score, id) index serves the order, and the seek of a single score
+        query = self.db.select().where(condition).order_by(self.db.score.asc(), self.db.id.asc())
+        return self._claim(query, batch_size)
+
+    @db_connection
+    @db_require
+    def count_by_score(self):
+        """
+        Count the elements in the queue for each score
+
+        :return: A dictionary of the number of elements by score
+        """
+        query = self.db.select(self.db.score, fn.COUNT(self.db.id).alias('count')).where(
+            self._pending()).group_by(self.db.score)
+        return {row.score: row.count for row in query}
+
+    @db_connection
+    @db_require
+    def count_by_slot(self):
+        """
+        Count the elements in the queue for each download slot, for queues with a slot field
+
+        :return: A dictionary of the number of elements by slot
+        """
+        query = self.db.select(self.db.slot, fn.COUNT(self.db.id).alias('count')).where(
+            self._pending()).group_by(self.db.slot)
+        return {row.slot: row.count for row in query}
+
+    @db_connection
+    @db_require
+    def restore(self, *rows):
+        """
+        Put popped rows back into the queue
+
+        With compact retention, the rows deleted by a compaction since they were popped are inserted again.
+
+        :param rows: The rows
+        :return: None
+        """
+        if not rows:
+            return
+        ids = [r.id for r in rows]
+        if self.lease_time:
+            self.db.update(lease_expire=None, worker=None, attempts=self.db.attempts - 1).where(
+                self.db.id.in_(ids)).execute()
+        elif self.retention == 'delete':
+            self.push_many([r.__data__ for r in rows])
+        else:
+            self.db.update(deleted=0).where(self.db.id.in_(ids)).execute()
+            if self.retention == 'compact':
+                # pending rows are never compacted, the rows still missing were deleted
+                existing = {r.id for r in self.db.select(self.db.id).where(self.db.id.in_(ids))}
+                missing = [r.__data__ for r in rows if r.id not in existing]
+                if missing:
+                    self.push_many(missing)
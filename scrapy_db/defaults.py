@@ -1,19 +1,146 @@
 STATS_TABLE = '%(spider)s_stats'
 
+# Models built with the same DB_URL share one database object, pooled when the database supports it
+DB_POOL = True
+# Maximum number of pooled connections per DB_URL, each database operation checks one out and returns it
+DB_POOL_MAX_CONNECTIONS = 8
+# Seconds after which an idle pooled connection is closed instead of reused
+DB_POOL_STALE_TIMEOUT = 300
+# Seconds to wait for a free connection when DB_POOL_MAX_CONNECTIONS are in use, 0 to wait forever
+DB_POOL_TIMEOUT = 10
+# Reconnect and retry a statement once when the server closed the connection, MySQL only
+DB_RECONNECT = True
+
+# Record the count, time and latency histogram of the queue and dupefilter database operations
+# in the stats under scheduler/db/ and dupefilter/db/. The pops waiting for a push are recorded apart, as pop_wait
+DB_STATS_ENABLED = False
+# Seconds between two log lines of the database operation stats, 0 to disable
+DB_STATS_LOG_INTERVAL = 0
+# Path of a function called with the database operation stats and the spider every DB_STATS_LOG_INTERVAL seconds
+# and when the scheduler closes
+DB_STATS_EXPORT = None
+
+# How popped queue and start url rows are removed: soft marks them deleted, delete deletes them,
+# compact marks them deleted and deletes them every DB_COMPACT_INTERVAL seconds
+DB_RETENTION = 'soft'
+DB_COMPACT_INTERVAL = 60
+# Maximum number of rows deleted by one statement during a compaction
+DB_COMPACT_CHUNK_SIZE = 1000
+# Maximum number of statements of a compaction run by a pop, the rows left are deleted by the next compactions
+DB_COMPACT_MAX_CHUNKS = 10
+
 SCHEDULER_QUEUE_TABLE = '%(spider)s_requests'
 SCHEDULER_QUEUE_CLASS = 'scrapy_db.queue.PriorityQueue'
 
+# Databases scrapy_db.queue.ShardedQueue and scrapy_db.dupefilter.DBShardedDupeFilter spread the requests
+# and the fingerprints over, DB_URL if empty
+SCHEDULER_SHARD_URLS = []
+# Number of shard tables on each database, named after the queue or dupefilter table with the shard index appended
+SCHEDULER_SHARD_TABLES = 1
+# Route the queued requests to a shard by fingerprint, or by domain to keep the requests of a host together.
+# The dupefilter always routes by fingerprint, so a fingerprint only shares the shard index of its request with
+# 'fingerprint'
+SCHEDULER_SHARD_KEY = 'fingerprint'
+# Queue class of each shard of scrapy_db.queue.ShardedQueue
+SCHEDULER_SHARD_QUEUE_CLASS = 'scrapy_db.queue.PriorityQueue'
+
 SCHEDULER_DUPEFILTER_TABLE = '%(spider)s_dupefilter'
 SCHEDULER_DUPEFILTER_CLASS = 'scrapy_db.dupefilter.DBDupeFilter'
+# Use a unique index on the fingerprint and check-and-insert in one statement
+SCHEDULER_DUPEFILTER_UNIQUE = False
+# Number of fingerprints kept in memory in front of the table, 0 to disable
+SCHEDULER_DUPEFILTER_CACHE_SIZE = 0
+# Eviction policy of the fingerprint cache, lru or fifo
+SCHEDULER_DUPEFILTER_CACHE_POLICY = 'lru'
+
+# Number of fingerprint tables of scrapy_db.dupefilter.DBPartitionedDupeFilter per shard, each holding a range of
+# fingerprint prefixes, at most 65536. It must not change while fingerprints are stored
+SCHEDULER_DUPEFILTER_PARTITIONS = 16
+
+# Table holding the bit arrays of scrapy_db.dupefilter.DBBloomDupeFilter
+SCHEDULER_DUPEFILTER_BLOOM_TABLE = '%(spider)s_dupefilter_bloom'
+# Number of fingerprints of the first Bloom filter slice, each following slice is twice as large
+SCHEDULER_DUPEFILTER_BLOOM_CAPACITY = 1000000
+# Target false positive rate of the whole Bloom filter
+SCHEDULER_DUPEFILTER_BLOOM_ERROR_RATE = 0.001
+# Size in bytes of the bit array chunks stored in one row, MySQL BLOB holds at most 65535 bytes
+SCHEDULER_DUPEFILTER_BLOOM_CHUNK_SIZE = 32768
 
 SCHEDULER_PERSIST = True
 START_URLS_TABLE = '%(spider)s_start_urls'
+# Format of the start urls: literal parses Python dict literals, json parses JSON objects. Both accept plain urls
+START_URLS_FORMAT = 'literal'
+# Number of rows inserted per transaction by scrapy_db.loader and the seed command
+SEED_CHUNK_SIZE = 10000
+# Read more start urls as soon as fewer requests than this are downloading and the scheduler is empty,
+# instead of waiting for the spider to be idle. 0 reads them when the spider is idle only
+START_URLS_LOW_WATERMARK = 0
 
 # Maximum idle time if the queue is empty
 MAX_IDLE_TIME = 0
 
-# Timeout period if the queue is empty during scheduling
+# Seconds scrapy_db.scheduler.AsyncScheduler waits in its database thread for a push when the queue is empty.
+# scrapy_db.scheduler.Scheduler runs on the reactor and never waits
 SCHEDULER_IDLE_BEFORE_CLOSE = 0
+# Send a NOTIFY on every push so that pops waiting for SCHEDULER_IDLE_BEFORE_CLOSE wake up at once, PostgreSQL only
+SCHEDULER_NOTIFY_ON_PUSH = False
+
+# Number of requests buffered in memory and inserted with one statement, 1 to insert every request immediately
+SCHEDULER_PUSH_BATCH_SIZE = 1
+# Maximum number of seconds a request stays in the push buffer
+SCHEDULER_PUSH_FLUSH_INTERVAL = 1.0
+# Number of requests claimed from the table at once and served from memory,
+# unserved requests are put back when the scheduler closes
+SCHEDULER_POP_BATCH_SIZE = 1
+
+# Seconds between two counts of the pending requests in the queue table, the number of pending requests is
+# tracked locally in between. 0 counts them every time
+SCHEDULER_PENDING_SYNC_INTERVAL = 10
+
+# Seconds a popped request stays leased to this worker until its response is received or its download failed,
+# expired leases go back to the queue. 0 removes requests from the queue as soon as they are popped.
+# Requests dropped by a downloader middleware before their download, such as the ones filtered by robots.txt
+# or offsite, are not acknowledged: they are delivered again when their lease expires,
+# up to SCHEDULER_LEASE_MAX_ATTEMPTS times
+SCHEDULER_LEASE_TIME = 0
+# Seconds between two requeues of the expired leases
+SCHEDULER_LEASE_SWEEP_INTERVAL = 60
+# Number of leases after which an expired request is dropped instead of requeued, 0 for no limit
+SCHEDULER_LEASE_MAX_ATTEMPTS = 3
+# Identifier recorded on leased rows, defaults to hostname:pid
+SCHEDULER_WORKER_ID = None
+
+# Compress the serialized requests of the queue with zlib or lzma, None to store them as they are.
+# The requests are stored in a BLOB column, rows written before compression was enabled are still read.
+# On MySQL and PostgreSQL the text column of an existing queue table must be converted first,
+# for example with ALTER TABLE ... MODIFY key_ LONGBLOB, the queue refuses to start otherwise
+SCHEDULER_COMPRESSION = None
+# Compression level, or lzma preset, None for the default of the method
+SCHEDULER_COMPRESSION_LEVEL = None
+# Size in bytes below which a serialized request is stored uncompressed
+SCHEDULER_COMPRESSION_THRESHOLD = 256
+# Path of a zlib preset dictionary built by scrapy_db.compression.train_zdict, it must not change
+# while requests compressed with it are queued
+SCHEDULER_COMPRESSION_ZDICT = None
+
+# Store the headers, cookies and meta values of the queued requests once in SCHEDULER_INTERN_TABLE,
+# the queue rows only reference them. The queue table must be created with interning enabled
+SCHEDULER_INTERN = False
+SCHEDULER_INTERN_TABLE = '%(spider)s_requests_fragments'
+# Fields of the requests interned, meta values are interned one by one
+SCHEDULER_INTERN_FIELDS = ['headers', 'cookies', 'meta']
+# Size in bytes below which a field is kept in the queue row
+SCHEDULER_INTERN_MIN_SIZE = 64
+# Number of fragments kept in memory
+SCHEDULER_INTERN_CACHE_SIZE = 10000
+# Seconds between two collections of the fragments no queued request references, 0 to keep every fragment.
+# Each collection reads the rows of the queue table, a fragment is only deleted once unused for this long
+SCHEDULER_INTERN_GC_INTERVAL = 3600
+
+# Number of requests scrapy_db.scheduler.AsyncScheduler pops in advance.
+# With this scheduler, the start urls of DBSpider and DBCrawlSpider are read in its database thread as well
+SCHEDULER_ASYNC_BUFFER_SIZE = 32
 
-# Scheduler Serialization Class
+# Scheduler Serialization Class, a module or a class. scrapy_db.utils.BinaryPickle and scrapy_db.utils.MsgpackSerializer
+# store requests as bytes in a BLOB column, the queue table must be created with them
 SCHEDULER_SERIALIZER = 'scrapy_db.utils.CustomPickle'
@@ -1,11 +1,16 @@
 import logging
+import struct
 import time
 
+from peewee import chunked
 from scrapy.dupefilters import BaseDupeFilter
 from scrapy.utils.request import fingerprint
 
 from . import defaults
-from .db import DBModel
+from .bloom import BloomSlice, ScalableBloomFilter
+from .db import DBModel, shard_tables
+from .stats import DBStats, timer
+from .utils import BoundedCache
 
 
 class DBDupeFilter(BaseDupeFilter):
@@ -15,17 +20,50 @@ class DBDupeFilter(BaseDupeFilter):
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, table, debug=False):
+    def __init__(self, table, debug=False, unique=False, cache=None, stats=None, db_stats=None):
         """
         Initialize
 
         :param table: Table name
         :param debug: DUPEFILTER_DEBUG, whether to print duplicate values
+        :param unique: SCHEDULER_DUPEFILTER_UNIQUE, whether the table has a unique index on the fingerprint
+        :param cache: In-memory cache of fingerprints already seen by this process
+        :param stats: Stats collector receiving the cache hit/miss counters
+        :param db_stats: DBStats recording the timings of the table operations, None to disable them
         """
         self.table: DBModel = table
         self.debug = debug
+        self.unique = unique
+        self.cache: BoundedCache = cache
+        self.stats = stats
+        self.db_stats: DBStats = db_stats
         self.log_dupes = True
 
+    @staticmethod
+    def _model_key(settings):
+        """
+        Get the key of the fields used for the fingerprint table
+
+        :param settings: Spider settings
+        :return: The key in the field dictionary and whether it is the unique one
+        """
+        unique = settings.getbool('SCHEDULER_DUPEFILTER_UNIQUE', defaults.SCHEDULER_DUPEFILTER_UNIQUE)
+        return ('dupelifter_unique' if unique else 'dupelifter'), unique
+
+    @staticmethod
+    def _cache_from_settings(settings):
+        """
+        Create the fingerprint cache through settings
+
+        :param settings: Spider settings
+        :return: The cache, or None if it is disabled
+        """
+        size = settings.getint('SCHEDULER_DUPEFILTER_CACHE_SIZE', defaults.SCHEDULER_DUPEFILTER_CACHE_SIZE)
+        if size <= 0:
+            return None
+        policy = settings.get('SCHEDULER_DUPEFILTER_CACHE_POLICY', defaults.SCHEDULER_DUPEFILTER_CACHE_POLICY)
+        return BoundedCache(size, policy)
+
     @classmethod
     def from_settings(cls, settings):
         """
@@ -35,9 +73,22 @@ class DBDupeFilter(BaseDupeFilter):
         :return: Instance of the current class
         """
         key = defaults.SCHEDULER_DUPEFILTER_TABLE % {'spider': int(time.time())}
-        table = DBModel.build_model_from_settings(settings, key, 'dupelifter')
+        model_key, unique = cls._model_key(settings)
+        table = cls._table_from_settings(settings, key, model_key)
         debug = settings.getbool('DUPEFILTER_DEBUG')
-        return cls(table=table, debug=debug)
+        return cls(table, debug=debug, unique=unique, cache=cls._cache_from_settings(settings))
+
+    @classmethod
+    def _table_from_settings(cls, settings, name, model_key):
+        """
+        Create the fingerprint table through settings
+
+        :param settings: Spider settings
+        :param name: Table name
+        :param model_key: The key in the field dictionary
+        :return: The table
+        """
+        return DBModel.build_model_from_settings(settings, name, model_key)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -47,7 +98,10 @@ class DBDupeFilter(BaseDupeFilter):
         :param crawler: Crawler object
         :return: Instance of the current class
         """
-        return cls.from_settings(crawler.settings)
+        instance = cls.from_settings(crawler.settings)
+        instance.stats = crawler.stats
+        instance.db_stats = DBStats.from_settings(crawler.settings, crawler.stats, 'dupefilter/db')
+        return instance
 
     def request_seen(self, request):
         """
@@ -58,11 +112,74 @@ class DBDupeFilter(BaseDupeFilter):
         """
         # request_fingerprint remove warnings
         fp = fingerprint(request).hex()
-        added = self.table.db.select().where(self.table.db.key_ == fp).count()
+        if self.cache is not None:
+            if fp in self.cache:
+                self._inc_stats('dupefilter/cache/hit')
+                return True
+            self._inc_stats('dupefilter/cache/miss')
+        with timer(self.db_stats, 'request_seen'):
+            seen = self._fingerprint_seen(fp)
+        if self.cache is not None:
+            self.cache.add(fp)
+        return seen
+
+    def _fingerprint_seen(self, fp):
+        """
+        Check the fingerprint against the table and record it
+
+        :param fp: Fingerprint of the request
+        :return: Whether the fingerprint was already in the table
+        """
+        table = self._table_for(fp)
+        if self.unique:
+            return not table.push_unique(**{'key_': fp})
+        added = table.db.select().where(table.db.key_ == fp).count()
         if added == 0:
-            self.table.push(**{'key_': fp})
+            table.push(**{'key_': fp})
         return added != 0
 
+    def _table_for(self, fp):
+        """
+        Get the table holding a fingerprint
+
+        :param fp: Fingerprint of the request
+        :return: The table
+        """
+        return self.table
+
+    def filter_seen(self, requests):
+        """
+        Check and record the fingerprints of many requests at once, with one query and one insert per chunk
+
+        :param requests: Request objects
+        :return: The requests not seen before, in order
+        """
+        fingerprints = {}
+        for request in requests:
+            if not request.dont_filter:
+                fingerprints.setdefault(fingerprint(request).hex(), request)
+        tables = {}
+        for fp in fingerprints:
+            tables.setdefault(self._table_for(fp), []).append(fp)
+        new = []
+        for table, fps in tables.items():
+            model = table.db
+            seen = set()
+            for batch in chunked(fps, 500):
+                seen.update(row.key_ for row in model.select(model.key_).where(model.key_.in_(batch)))
+            fps = [fp for fp in fps if fp not in seen]
+            table.push_many([{'key_': fp} for fp in fps], ignore_conflicts=self.unique)
+            new.extend(fps)
+        if self.cache is not None:
+            for fp in fingerprints:
+                self.cache.add(fp)
+        new = {id(fingerprints[fp]) for fp in new}
+        return [r for r in requests if r.dont_filter or id(r) in new]
+
+    def _inc_stats(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
+
     @classmethod
     def from_spider(cls, spider):
         """
@@ -73,9 +190,12 @@ class DBDupeFilter(BaseDupeFilter):
         """
         settings = spider.settings
         key = settings.get("SCHEDULER_DUPEFILTER_KEY", defaults.SCHEDULER_DUPEFILTER_TABLE) % {'spider': spider.name}
-        table = DBModel.build_model_from_settings(settings, key, 'dupelifter')
+        model_key, unique = cls._model_key(settings)
+        table = cls._table_from_settings(settings, key, model_key)
         debug = settings.getbool('DUPEFILTER_DEBUG')
-        return cls(table, debug=debug)
+        stats = getattr(getattr(spider, 'crawler', None), 'stats', None)
+        return cls(table, debug=debug, unique=unique, cache=cls._cache_from_settings(settings), stats=stats,
+                   db_stats=DBStats.from_settings(settings, stats, 'dupefilter/db', spider))
 
     def close(self, reason=''):
         """
@@ -86,12 +206,22 @@ class DBDupeFilter(BaseDupeFilter):
         """
         self.clear()
 
+    def checkpoint(self):
+        """
+        Write fingerprints kept in memory back to the table, called when the scheduler closes with SCHEDULER_PERSIST
+
+        :return: None
+        """
+        pass
+
     def clear(self):
         """
         Clear fingerprint data
 
         :return: None
         """
+        if self.cache is not None:
+            self.cache.clear()
         self.table.drop_table()
 
     def log(self, request, spider):
@@ -111,3 +241,231 @@ class DBDupeFilter(BaseDupeFilter):
                    " (see DUPEFILTER_DEBUG to show all duplicates)")
             self.logger.debug(msg, {'request': request}, extra={'spider': spider})
             self.log_dupes = False
+
+
+class DBShardedDupeFilter(DBDupeFilter):
+    """
+    Duplicate filter spreading the fingerprints over the shards of scrapy_db.queue.ShardedQueue,
+    SCHEDULER_SHARD_TABLES tables on each database of SCHEDULER_SHARD_URLS
+
+    A fingerprint always goes to a shard by its own value. With SCHEDULER_SHARD_KEY = 'fingerprint' this is the shard
+    of the same index as its request in the queue, with 'domain' the two are unrelated.
+    """
+
+    def __init__(self, tables, **kwargs):
+        """
+        Initialize
+
+        :param tables: Tables of the shards
+        :param kwargs: Arguments of DBDupeFilter
+        """
+        super().__init__(tables[0], **kwargs)
+        self.tables = tables
+
+    @classmethod
+    def _table_from_settings(cls, settings, name, model_key):
+        return [DBModel.build_model_from_settings(settings, table, model_key, url=url)
+                for url, table in shard_tables(settings, name)]
+
+    def _table_for(self, fp):
+        return self.tables[int(fp[:8], 16) % len(self.tables)]
+
+    def clear(self):
+        """
+        Clear fingerprint data of every shard
+
+        :return: None
+        """
+        if self.cache is not None:
+            self.cache.clear()
+        for table in self.tables:
+            table.drop_table()
+
+
+class DBPartitionedDupeFilter(DBShardedDupeFilter):
+    """
+    Duplicate filter spreading the fingerprints of each shard over SCHEDULER_DUPEFILTER_PARTITIONS tables,
+    each one holding a range of fingerprint prefixes, so that the index of every table stays small
+
+    The tables are named after the dupefilter table with _p<partition> appended, clearing drops them one by one.
+    """
+    # Number of leading hex digits of the fingerprint keying the partitions
+    _prefix_digits = 4
+
+    def __init__(self, tables, partitions=defaults.SCHEDULER_DUPEFILTER_PARTITIONS, **kwargs):
+        """
+        Initialize
+
+        :param tables: Tables of the partitions, the partitions of the first shard first
+        :param partitions: SCHEDULER_DUPEFILTER_PARTITIONS, number of partitions of a shard
+        :param kwargs: Arguments of DBDupeFilter
+        """
+        super().__init__(tables, **kwargs)
+        self.partitions = partitions
+
+    @classmethod
+    def _partitions(cls, settings):
+        partitions = settings.getint('SCHEDULER_DUPEFILTER_PARTITIONS', defaults.SCHEDULER_DUPEFILTER_PARTITIONS)
+        if not 1 <= partitions <= 16 ** cls._prefix_digits:
+            raise ValueError(f'SCHEDULER_DUPEFILTER_PARTITIONS must be between 1 and {16 ** cls._prefix_digits}: '
+                             f'{partitions}')
+        return partitions
+
+    @classmethod
+    def _table_from_settings(cls, settings, name, model_key):
+        return [DBModel.build_model_from_settings(settings, f'{table}_p{i}', model_key, url=url)
+                for url, table in shard_tables(settings, name) for i in range(cls._partitions(settings))]
+
+    @classmethod
+    def from_settings(cls, settings):
+        instance = super().from_settings(settings)
+        instance.partitions = cls._partitions(settings)
+        return instance
+
+    @classmethod
+    def from_spider(cls, spider):
+        instance = super().from_spider(spider)
+        instance.partitions = cls._partitions(spider.settings)
+        return instance
+
+    def _table_for(self, fp):
+        shard = int(fp[:8], 16) % (len(self.tables) // self.partitions)
+        partition = int(fp[:self._prefix_digits], 16) * self.partitions >> (4 * self._prefix_digits)
+        return self.tables[shard * self.partitions + partition]
+
+
+class DBBloomDupeFilter(DBDupeFilter):
+    """
+    Duplicate filter keeping fingerprints in a scalable Bloom filter
+
+    The bit arrays are loaded from the table on the first request and written back in chunks on close,
+    so the cost of a request does not depend on the number of fingerprints.
+    """
+
+    # capacity, count, error rate and chunk size of a slice, stored in the row with chunk -1
+    _meta = struct.Struct('>QQdI')
+    # Number of chunk rows written per INSERT
+    _rows_per_insert = 64
+
+    def __init__(self, table, debug=False,
+                 capacity=defaults.SCHEDULER_DUPEFILTER_BLOOM_CAPACITY,
+                 error_rate=defaults.SCHEDULER_DUPEFILTER_BLOOM_ERROR_RATE,
+                 chunk_size=defaults.SCHEDULER_DUPEFILTER_BLOOM_CHUNK_SIZE,
+                 stats=None, db_stats=None):
+        """
+        Initialize
+
+        :param table: Table of bit array chunks
+        :param debug: DUPEFILTER_DEBUG, whether to print duplicate values
+        :param capacity: SCHEDULER_DUPEFILTER_BLOOM_CAPACITY, capacity of the first slice
+        :param error_rate: SCHEDULER_DUPEFILTER_BLOOM_ERROR_RATE, target false positive rate
+        :param chunk_size: SCHEDULER_DUPEFILTER_BLOOM_CHUNK_SIZE, size in bytes of a stored chunk
+        :param stats: Stats collector
+        :param db_stats: DBStats recording the timings of the table operations
+        """
+        super().__init__(table, debug=debug, stats=stats, db_stats=db_stats)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self._filter = None
+
+    @classmethod
+    def _from_settings(cls, settings, key, stats=None, spider=None):
+        table = DBModel.build_model_from_settings(settings, key, 'bloom')
+        return cls(table,
+                   debug=settings.getbool('DUPEFILTER_DEBUG'),
+                   capacity=settings.getint('SCHEDULER_DUPEFILTER_BLOOM_CAPACITY',
+                                            defaults.SCHEDULER_DUPEFILTER_BLOOM_CAPACITY),
+                   error_rate=settings.getfloat('SCHEDULER_DUPEFILTER_BLOOM_ERROR_RATE',
+                                                defaults.SCHEDULER_DUPEFILTER_BLOOM_ERROR_RATE),
+                   chunk_size=settings.getint('SCHEDULER_DUPEFILTER_BLOOM_CHUNK_SIZE',
+                                              defaults.SCHEDULER_DUPEFILTER_BLOOM_CHUNK_SIZE),
+                   stats=stats,
+                   db_stats=DBStats.from_settings(settings, stats, 'dupefilter/db', spider))
+
+    @classmethod
+    def from_settings(cls, settings):
+        key = defaults.SCHEDULER_DUPEFILTER_BLOOM_TABLE % {'spider': int(time.time())}
+        return cls._from_settings(settings, key)
+
+    @classmethod
+    def from_spider(cls, spider):
+        settings = spider.settings
+        key = settings.get('SCHEDULER_DUPEFILTER_BLOOM_TABLE',
+                           defaults.SCHEDULER_DUPEFILTER_BLOOM_TABLE) % {'spider': spider.name}
+        crawler = getattr(spider, 'crawler', None)
+        return cls._from_settings(settings, key, stats=getattr(crawler, 'stats', None), spider=spider)
+
+    @property
+    def filter(self):
+        """
+        The Bloom filter, loaded from the table on first access
+        """
+        if self._filter is None:
+            with timer(self.db_stats, 'load'):
+                self._filter = self._load()
+        return self._filter
+
+    def _load(self):
+        bloom = ScalableBloomFilter(self.capacity, self.error_rate, self.chunk_size)
+        model = self.table.db
+        for row in model.select().order_by(model.slice_, model.chunk):
+            if row.chunk < 0:
+                capacity, count, error_rate, chunk_size = self._meta.unpack(bytes(row.data))
+                bloom.slices.append(BloomSlice(capacity, error_rate, chunk_size, count))
+            else:
+                bloom.slices[row.slice_].set_chunk(row.chunk, row.data)
+        self.logger.debug(f'Loaded {len(bloom)} fingerprints in {len(bloom.slices)} bloom filter slices')
+        return bloom
+
+    def request_seen(self, request):
+        return not self.filter.add(fingerprint(request))
+
+    def filter_seen(self, requests):
+        return [r for r in requests if r.dont_filter or not self.request_seen(r)]
+
+    def checkpoint(self):
+        """
+        Write the modified chunks of the bit arrays to the table
+
+        :return: None
+        """
+        if self._filter is None:
+            return
+        with timer(self.db_stats, 'checkpoint'):
+            self._checkpoint()
+
+    def _checkpoint(self):
+        model = self.table.db
+        model.create_table()
+        with model._meta.database.atomic():  # noqa
+            for i, s in enumerate(self._filter.slices):
+                if not s.dirty:
+                    continue
+                chunks = sorted(s.dirty)
+                for batch in chunked([-1] + chunks, self._rows_per_insert):
+                    model.delete().where((model.slice_ == i) & model.chunk.in_(batch)).execute()
+                rows = [{'slice_': i, 'chunk': -1,
+                         'data': self._meta.pack(s.capacity, s.count, s.error_rate, s.chunk_size)}]
+                rows.extend({'slice_': i, 'chunk': c, 'data': s.get_chunk(c)} for c in chunks)
+                for batch in chunked(rows, self._rows_per_insert):
+                    model.insert_many(batch).execute()
+                s.dirty.clear()
+
+    def close(self, reason=''):
+        """
+        Write the Bloom filter to the table during shutdown
+
+        :param reason: Shutdown reason
+        :return: None
+        """
+        self.checkpoint()
+
+    def clear(self):
+        """
+        Clear fingerprint data
+
+        :return: None
+        """
+        self.table.drop_table()
+        self._filter = ScalableBloomFilter(self.capacity, self.error_rate, self.chunk_size)
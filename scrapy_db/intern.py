@@ -0,0 +1,175 @@
+import copy
+import datetime
+import hashlib
+import pickle
+import time
+
+from scrapy_db import defaults
+from scrapy_db.utils import BoundedCache
+
+# The key of a serialized request holding the hashes of its interned fields
+INTERN_KEY = '_interned'
+
+
+class FragmentNotFound(LookupError):
+    """
+    A request references a fragment missing from the fragments table
+    """
+
+
+class Interner(object):
+    """
+    Store the headers, cookies and meta values shared by many requests once, in a table keyed by their hash
+
+    The serialized requests only hold the hashes, the fragments are loaded back through an in-memory cache.
+    Meta values are interned one by one, since meta mixes values shared by all requests and per-request ones.
+
+    The update_time of a fragment records its last use, refreshed at most every half gc_interval, so that collect
+    keeps the fragments of the requests being pushed.
+    """
+
+    def __init__(self, table, fields=None, min_size=defaults.SCHEDULER_INTERN_MIN_SIZE,
+                 cache_size=defaults.SCHEDULER_INTERN_CACHE_SIZE, gc_interval=defaults.SCHEDULER_INTERN_GC_INTERVAL):
+        """
+        Initialize
+
+        :param table: DBModel of the fragments table
+        :param fields: Fields of request.to_dict() to intern
+        :param min_size: Size in bytes below which a fragment is kept in the request
+        :param cache_size: Number of fragments kept in memory
+        :param gc_interval: Seconds between two collections of the unreferenced fragments, 0 to keep every fragment
+        """
+        self.table = table
+        self.fields = defaults.SCHEDULER_INTERN_FIELDS if fields is None else fields
+        self.min_size = min_size
+        self.cache = BoundedCache(cache_size)
+        self.gc_interval = gc_interval
+
+    def _store(self, value):
+        """
+        Store a fragment unless it is small
+
+        :param value: The fragment
+        :return: The hash of the fragment, or None if it is kept in the request
+        """
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) < self.min_size:
+            return None
+        key = hashlib.blake2b(data, digest_size=16).hexdigest()
+        cached = self.cache.get(key)
+        now = time.time()
+        if cached is None or self.gc_interval and now - cached[1] >= self.gc_interval / 2:
+            self._save(key, data)
+            self.cache.add(key, (value, now))
+        return key
+
+    def _save(self, key, data):
+        if not self.gc_interval:
+            self.table.push_unique(hash_=key, data=data)
+            return
+        used = datetime.datetime.now()
+        if not self.table.db.update(update_time=used).where(self.table.db.hash_ == key).execute():
+            self.table.push_unique(hash_=key, data=data, update_time=used)
+
+    def _load(self, key):
+        cached = self.cache.get(key)
+        if cached is None:
+            row = self.table.db.get_or_none(self.table.db.hash_ == key)
+            if row is None:
+                raise FragmentNotFound(f'fragment {key} not found in {self.table.db._meta.table_name}')  # noqa
+            # loaded fragments are not known to be used recently, a push refreshes them
+            cached = (pickle.loads(row.data), 0)
+            self.cache.add(key, cached)
+        # fragments are shared by the requests using them, each request gets its own copy
+        return copy.deepcopy(cached[0])
+
+    def intern(self, obj):
+        """
+        Replace the fields of a request dictionary by the hashes of the stored fragments
+
+        :param obj: The dictionary returned by request.to_dict()
+        :return: The dictionary to serialize
+        """
+        refs = {}
+        for field in self.fields:
+            value = obj.get(field)
+            if not value:
+                continue
+            if field == 'meta':
+                meta_refs = {}
+                for name, item in value.items():
+                    key = self._store(item)
+                    if key is not None:
+                        meta_refs[name] = key
+                if meta_refs:
+                    obj['meta'] = {name: item for name, item in value.items() if name not in meta_refs}
+                    refs['meta'] = meta_refs
+                continue
+            key = self._store(value)
+            if key is not None:
+                refs[field] = key
+                del obj[field]
+        if refs:
+            obj[INTERN_KEY] = refs
+        return obj
+
+    def restore(self, obj):
+        """
+        Put back the fragments of a dictionary returned by intern
+
+        :param obj: The deserialized dictionary
+        :return: The dictionary of request.to_dict()
+        """
+        refs = obj.pop(INTERN_KEY, None)
+        if not refs:
+            return obj
+        for field, key in refs.items():
+            if field == 'meta':
+                meta = obj.get('meta') or {}
+                meta.update({name: self._load(k) for name, k in key.items()})
+                obj['meta'] = meta
+            else:
+                obj[field] = self._load(key)
+        return obj
+
+    @staticmethod
+    def references(obj):
+        """
+        Get the hashes of the fragments referenced by a dictionary returned by intern
+
+        :param obj: The deserialized dictionary
+        :return: The generator of hashes
+        """
+        for field, key in (obj.get(INTERN_KEY) or {}).items():
+            if field == 'meta':
+                yield from key.values()
+            else:
+                yield key
+
+    def collect(self, referenced, started, batch_size=1000):
+        """
+        Delete the fragments that are not referenced and were not used in the gc_interval seconds before the
+        references were read, as the requests being pushed meanwhile may use them
+
+        :param referenced: The set of the hashes referenced by the queued requests
+        :param started: The time the reading of the references started
+        :param batch_size: Number of fragments read per query
+        :return: The number of deleted fragments
+        """
+        db = self.table.db
+        before = datetime.datetime.fromtimestamp(started - self.gc_interval)
+        deleted = 0
+        after = 0
+        while True:
+            rows = list(db.select(db.id, db.hash_).where((db.id > after) & (db.update_time < before)).order_by(
+                db.id).limit(batch_size))
+            ids = [row.id for row in rows if row.hash_ not in referenced]
+            if ids:
+                deleted += db.delete().where(db.id.in_(ids) & (db.update_time < before)).execute()
+            if len(rows) < batch_size:
+                return deleted
+            after = rows[-1].id
+
+    def clear(self):
+        self.cache.clear()
+        self.table.db.delete().execute()
@@ -0,0 +1,139 @@
+import itertools
+import json
+import time
+
+from scrapy import Request, Spider
+from scrapy.utils.misc import load_object
+
+from . import defaults
+from .db import DBModel, close_databases
+from .scheduler import Scheduler
+
+
+def _chunks(lines, chunk_size):
+    """
+    Split the non-blank lines of a stream into lists, without reading the whole stream
+
+    :param lines: Iterable of lines
+    :param chunk_size: Number of lines per list
+    :return: Generator of lists of stripped lines
+    """
+    lines = (line.strip() for line in lines)
+    lines = (line for line in lines if line)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def request_from_line(line, spider=None):
+    """
+    Make a request from a plain url, or from a JSON object of Request arguments
+
+    The callback and errback are names of spider methods, resolved like request_from_dict does.
+
+    :param line: The line
+    :param spider: The spider whose methods are the callbacks
+    :return: Request object
+    """
+    if not line.startswith('{'):
+        return Request(line)
+    kwargs = json.loads(line)
+    for name in ('callback', 'errback'):
+        if kwargs.get(name) is None:
+            continue
+        method = getattr(spider, kwargs[name], None) if spider is not None else None
+        if not callable(method):
+            raise ValueError(f'{name} {kwargs[name]!r} is not a method of spider {spider}: {line}')
+        kwargs[name] = method
+    return Request(**kwargs)
+
+
+def _spider(settings, spider_name):
+    """
+    Create the spider of the project with this name, whose methods are the callbacks of the loaded requests
+
+    :param settings: The settings
+    :param spider_name: The name of the spider
+    :return: The spider, a bare Spider if the project has none with this name
+    """
+    spider_loader = load_object(settings['SPIDER_LOADER_CLASS']).from_settings(settings.frozencopy())
+    try:
+        spider = spider_loader.load(spider_name)()
+    except KeyError:
+        spider = Spider(spider_name)
+    spider.settings = settings
+    return spider
+
+
+def load_start_urls(lines, settings, spider_name, chunk_size=defaults.SEED_CHUNK_SIZE, progress=None):
+    """
+    Insert start urls into the start urls table of a spider, with multi-row inserts in one transaction per chunk
+
+    The lines are stored as they are, plain urls or payloads in START_URLS_FORMAT.
+
+    :param lines: Iterable of lines, such as an open file
+    :param settings: The settings
+    :param spider_name: The name of the spider
+    :param chunk_size: Number of rows per transaction
+    :param progress: Function called with the number of rows loaded and the elapsed seconds after each chunk
+    :return: The number of rows loaded
+    """
+    table_name = settings.get('START_URLS_TABLE', defaults.START_URLS_TABLE) % {'spider': spider_name}
+    db = DBModel.build_model_from_settings(settings, table_name, 'start_url')
+    start = time.time()
+    count = 0
+    try:
+        for chunk in _chunks(lines, chunk_size):
+            db.push_many([{'start_url': line} for line in chunk])
+            count += len(chunk)
+            if progress is not None:
+                progress(count, time.time() - start)
+    finally:
+        close_databases()
+    return count
+
+
+def load_requests(lines, settings, spider_name, chunk_size=defaults.SEED_CHUNK_SIZE, progress=None):
+    """
+    Push requests into the request queue of a spider, registering their fingerprints in its dupefilter
+
+    The queue and the dupefilter are the ones the scheduler of the crawl would use. Requests already seen
+    by the dupefilter are skipped, unless they have dont_filter set.
+
+    :param lines: Iterable of plain urls or JSON objects of Request arguments, with callback and errback as
+        names of methods of the spider
+    :param settings: The settings
+    :param spider_name: The name of the spider
+    :param chunk_size: Number of requests per transaction
+    :param progress: Function called with the number of requests queued and the elapsed seconds after each chunk
+    :return: The number of requests queued
+    """
+    settings = settings.copy()
+    settings.set('SCHEDULER_PERSIST', True)
+    settings.set('SCHEDULER_FLUSH_ON_START', False)
+    # the queue buffers every request of a chunk and inserts them together
+    settings.set('SCHEDULER_PUSH_BATCH_SIZE', chunk_size)
+    settings.set('SCHEDULER_PUSH_FLUSH_INTERVAL', float('inf'))
+    spider = _spider(settings, spider_name)
+    scheduler = Scheduler.from_settings(settings)
+    scheduler.open(spider)
+    start = time.time()
+    count = 0
+    try:
+        for chunk in _chunks(lines, chunk_size):
+            requests = [request_from_line(line, spider) for line in chunk]
+            if hasattr(scheduler.df, 'filter_seen'):
+                requests = scheduler.df.filter_seen(requests)
+            else:
+                requests = [r for r in requests if r.dont_filter or not scheduler.df.request_seen(r)]
+            for request in requests:
+                scheduler.queue.push(request)
+            scheduler.queue.flush()
+            count += len(requests)
+            if progress is not None:
+                progress(count, time.time() - start)
+    finally:
+        scheduler.close('finished')
+    return count
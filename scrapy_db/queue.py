@@ -1,15 +1,41 @@
-from scrapy.utils.request import request_from_dict
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import socket
+import time
+import zlib
+from collections import deque
 
-from scrapy_db.db import DBModel
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import load_object
+from scrapy.utils.request import fingerprint, request_from_dict
+
+from scrapy_db import defaults
+from scrapy_db.compression import CompressedSerializer
+from scrapy_db.db import DBModel, _lease_fields, _lease_indexes, _binary_fields, _indexes, _slot_fields, \
+    _slot_indexes, _slot_lease_indexes, shard_tables
+from scrapy_db.intern import Interner, FragmentNotFound
+from scrapy_db.stats import DBStats, timer
 from scrapy_db.utils import CustomPickle
 
+logger = logging.getLogger(__name__)
+
+# The meta key holding the id of the leased row a request was popped from
+LEASE_META_KEY = 'db_lease_id'
+# The meta key holding the index of the shard a leased request was popped from
+SHARD_META_KEY = 'db_shard'
+
 
 class Base(object):
     """
     Basic queue class
     """
+    # Whether the rows record the download slot of their request
+    slot_aware = False
 
-    def __init__(self, spider, table_name, key, serializer=None):
+    def __init__(self, spider, table_name, key, serializer=None, db_url=None, intern_table=None):
         """
         Initialize spider queue object
 
@@ -17,6 +43,8 @@ class Base(object):
         :param table_name: table name
         :param key: current object key
         :param serializer: serialization
+        :param db_url: url of the database of the table, DB_URL if None
+        :param intern_table: name of the fragments table, SCHEDULER_INTERN_TABLE if None
         """
         if serializer is None:
             serializer = CustomPickle
@@ -24,9 +52,65 @@ class Base(object):
             raise TypeError(f"serializer does not implement 'loads' function: {serializer}")
         if not hasattr(serializer, 'dumps'):
             raise TypeError(f"serializer does not implement 'dumps' function: {serializer}")
-        self.db = DBModel.build_model_from_settings(spider.settings, table_name % {'spider': spider.name}, key)
+        settings = spider.settings
+        stats = getattr(getattr(spider, 'crawler', None), 'stats', None)
+        if settings.get('SCHEDULER_COMPRESSION'):
+            serializer = CompressedSerializer.from_settings(serializer, settings, stats=stats, spider=spider)
+        self.db_stats = DBStats.from_settings(settings, stats, 'scheduler/db', spider)
+        self.lease_time = settings.getint('SCHEDULER_LEASE_TIME', defaults.SCHEDULER_LEASE_TIME)
+        self.lease_sweep_interval = settings.getfloat('SCHEDULER_LEASE_SWEEP_INTERVAL',
+                                                      defaults.SCHEDULER_LEASE_SWEEP_INTERVAL)
+        self._lease_swept = 0
+        kwargs = {'notify': settings.getbool('SCHEDULER_NOTIFY_ON_PUSH', defaults.SCHEDULER_NOTIFY_ON_PUSH)}
+        fields = {}
+        if getattr(serializer, 'binary', False):
+            # serializers returning bytes are stored in a BLOB (BYTEA) column without text encoding
+            fields.update(_binary_fields)
+        if self.lease_time:
+            fields.update(_lease_fields)
+            kwargs.update({
+                'indexes': _lease_indexes,
+                'lease_time': self.lease_time,
+                'worker_id': settings.get('SCHEDULER_WORKER_ID') or f'{socket.gethostname()}:{os.getpid()}',
+                'max_attempts': settings.getint('SCHEDULER_LEASE_MAX_ATTEMPTS',
+                                                defaults.SCHEDULER_LEASE_MAX_ATTEMPTS),
+            })
+        if self.slot_aware:
+            fields.update(_slot_fields)
+            if self.lease_time:
+                kwargs['indexes'] = _lease_indexes + _slot_lease_indexes
+            else:
+                kwargs['indexes'] = _indexes['queue'] + _slot_indexes
+        if fields:
+            kwargs['fields'] = fields
+        self.db = DBModel.build_model_from_settings(settings, table_name % {'spider': spider.name}, key, url=db_url,
+                                                    **kwargs)
         self.spider = spider
         self.serializer = serializer
+        self.push_batch_size = settings.getint('SCHEDULER_PUSH_BATCH_SIZE', defaults.SCHEDULER_PUSH_BATCH_SIZE)
+        self.push_flush_interval = settings.getfloat('SCHEDULER_PUSH_FLUSH_INTERVAL',
+                                                     defaults.SCHEDULER_PUSH_FLUSH_INTERVAL)
+        self.pop_batch_size = max(1, settings.getint('SCHEDULER_POP_BATCH_SIZE', defaults.SCHEDULER_POP_BATCH_SIZE))
+        self._pushes = []
+        self._pushes_since = 0
+        self._prefetched = deque()
+        self.pending_sync_interval = settings.getfloat('SCHEDULER_PENDING_SYNC_INTERVAL',
+                                                       defaults.SCHEDULER_PENDING_SYNC_INTERVAL)
+        self._pending = None
+        self._pending_synced = 0
+        self.interner = None
+        self._fragments_collected = time.time()
+        if settings.getbool('SCHEDULER_INTERN', defaults.SCHEDULER_INTERN):
+            if intern_table is None:
+                intern_table = settings.get('SCHEDULER_INTERN_TABLE', defaults.SCHEDULER_INTERN_TABLE)
+            self.interner = Interner(
+                DBModel.build_model_from_settings(settings, intern_table % {'spider': spider.name}, 'fragment',
+                                                  url=db_url),
+                fields=settings.getlist('SCHEDULER_INTERN_FIELDS', defaults.SCHEDULER_INTERN_FIELDS),
+                min_size=settings.getint('SCHEDULER_INTERN_MIN_SIZE', defaults.SCHEDULER_INTERN_MIN_SIZE),
+                cache_size=settings.getint('SCHEDULER_INTERN_CACHE_SIZE', defaults.SCHEDULER_INTERN_CACHE_SIZE),
+                gc_interval=settings.getfloat('SCHEDULER_INTERN_GC_INTERVAL', defaults.SCHEDULER_INTERN_GC_INTERVAL),
+            )
 
     def _encode_request(self, request):
         """
@@ -36,7 +120,10 @@ class Base(object):
         :return: encode result
         """
         obj = request.to_dict(spider=self.spider)
-        return self.serializer.dumps(obj)
+        with timer(self.db_stats, 'encode'):
+            if self.interner is not None:
+                obj = self.interner.intern(obj)
+            return self.serializer.dumps(obj)
 
     def _decode_request(self, encoded_request):
         """
@@ -45,46 +132,573 @@ class Base(object):
         :param encoded_request: request to be decoded
         :return: decoding result
         """
-        obj = self.serializer.loads(encoded_request)
-        return request_from_dict(obj, spider=self.spider)
+        with timer(self.db_stats, 'decode'):
+            obj = self.serializer.loads(encoded_request)
+            if self.interner is not None:
+                obj = self.interner.restore(obj)
+            return request_from_dict(obj, spider=self.spider)
+
+    def _db_len(self):
+        """
+        Get the number of pending rows, tracked locally and counted again every SCHEDULER_PENDING_SYNC_INTERVAL seconds
+
+        :return: the approximate number of pending rows
+        """
+        if self._pending is None or time.time() - self._pending_synced >= self.pending_sync_interval:
+            with timer(self.db_stats, 'count'):
+                self._pending = len(self.db)
+            self._pending_synced = time.time()
+        return self._pending
+
+    def _count(self, delta):
+        if self._pending is not None:
+            self._pending = max(0, self._pending + delta)
 
     def __len__(self):
-        return len(self.db)
+        return self._db_len() + len(self._pushes) + len(self._prefetched)
+
+    def has_pending(self):
+        """
+        Check whether the queue has requests, without counting the rows of the table
+
+        :return: whether the queue is not empty
+        """
+        if self._pushes or self._prefetched:
+            return True
+        if self._pending and time.time() - self._pending_synced < self.pending_sync_interval:
+            return True
+        with timer(self.db_stats, 'exists'):
+            return self.db.exists()
+
+    def _push(self, **row):
+        """
+        Insert a row, or buffer it when SCHEDULER_PUSH_BATCH_SIZE is greater than 1
+
+        :param row: row to insert
+        :return: None
+        """
+        if self.push_batch_size <= 1:
+            with timer(self.db_stats, 'push'):
+                self.db.push(**row)
+            self._count(1)
+            return
+        if not self._pushes:
+            self._pushes_since = time.time()
+        self._pushes.append(row)
+        if len(self._pushes) >= self.push_batch_size:
+            self.flush()
+        else:
+            self._flush_if_due()
+
+    def _flush_if_due(self):
+        if self._pushes and time.time() - self._pushes_since >= self.push_flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Insert the buffered rows
+
+        :return: None
+        """
+        if self._pushes:
+            rows, self._pushes = self._pushes, []
+            with timer(self.db_stats, 'push_many'):
+                self.db.push_many(rows)
+            self._count(len(rows))
+
+    def _pop_rows(self, timeout=0):
+        raise NotImplementedError
+
+    def _pop(self, timeout=0):
+        """
+        Pop up to SCHEDULER_POP_BATCH_SIZE rows, inserting the buffered rows before reporting an empty queue
+
+        The pop stats time the claims that do not wait, a wait for a push is recorded as pop_wait.
+
+        :param timeout: timeout parameter
+        :return: the list of rows
+        """
+        self._flush_if_due()
+        self._sweep_if_due()
+        self._collect_fragments_if_due()
+        with timer(self.db_stats, 'pop'):
+            result = self._pop_rows()
+        if not result and self._pushes:
+            self.flush()
+            with timer(self.db_stats, 'pop'):
+                result = self._pop_rows()
+        if not result and timeout:
+            with timer(self.db_stats, 'pop_wait'):
+                result = self._pop_rows(timeout)
+        return result
+
+    def _sweep_if_due(self):
+        if self.lease_time and time.time() - self._lease_swept >= self.lease_sweep_interval:
+            self._lease_swept = time.time()
+            with timer(self.db_stats, 'requeue_expired'):
+                self._count(self.db.requeue_expired())
+
+    def _collect_fragments_if_due(self):
+        if (self.interner is not None and self.interner.gc_interval
+                and time.time() - self._fragments_collected >= self.interner.gc_interval):
+            self._fragments_collected = time.time()
+            with timer(self.db_stats, 'collect_fragments'):
+                self.collect_fragments()
+
+    def collect_fragments(self):
+        """
+        Delete the fragments of the interner that no request of the table references
+
+        The fragments table must not be shared with another queue table.
+
+        :return: the number of deleted fragments
+        """
+        started = time.time()
+        # the rows held in memory by other processes are covered by the time the fragments were last used
+        held = [row['key_'] for row in self._pushes] + [row.key_ for row, _ in self._prefetched]
+        referenced = set()
+        for data in itertools.chain(held, (row.key_ for row in self.db.scan('key_'))):
+            referenced.update(self.interner.references(self.serializer.loads(data)))
+        return self.interner.collect(referenced, started)
+
+    def ack(self, request):
+        """
+        Remove the leased row a request was popped from, once it has been processed
+
+        :param request: request object
+        :return: None
+        """
+        lease_id = request.meta.pop(LEASE_META_KEY, None)
+        if lease_id is not None:
+            with timer(self.db_stats, 'ack'):
+                self.db.ack(lease_id)
+
+    def _decode_row(self, row):
+        request = self._decode_request(row.key_)
+        if self.lease_time:
+            request.meta[LEASE_META_KEY] = row.id
+        return request
 
     def push(self, request):
-        self.db.push(**{'key_': self._encode_request(request)})
+        # a leased request pushed again, by a retry or a redirect, continues in its new row
+        self.ack(request)
+        self._push(**{'key_': self._encode_request(request)})
 
     def pop(self, timeout=0):
-        raise NotImplementedError
+        while not self._prefetched:
+            rows = self._pop(timeout) or []
+            if not rows:
+                break
+            self._count(-len(rows))
+            for row in rows:
+                try:
+                    self._prefetched.append((row, self._decode_row(row)))
+                except FragmentNotFound as e:
+                    self._drop_row(row, e)
+            timeout = 0
+        if self._prefetched:
+            return self._prefetched.popleft()[1]
+
+    def _drop_row(self, row, error):
+        """
+        Drop a row whose request cannot be decoded, so that it is not popped again
+
+        :param row: the row
+        :param error: the decoding error
+        :return: None
+        """
+        logger.error('Dropped the request of row %(id)s of %(table)s: %(error)s',
+                     {'id': row.id, 'table': self.db.db._meta.table_name, 'error': error})  # noqa
+        if self.lease_time:
+            self.db.ack(row.id)
+
+    def close(self):
+        """
+        Write back everything kept in memory
+
+        :return: None
+        """
+        self.flush()
+        if self._prefetched:
+            self.db.restore(*[row for row, _ in self._prefetched])
+            self._count(len(self._prefetched))
+            self._prefetched.clear()
 
     def clear(self):
+        self._pushes = []
+        self._prefetched.clear()
+        self._pending = None
+        if self.interner is not None:
+            self.interner.clear()
         self.db.drop_table()
 
 
 class FifoQueue(Base):
 
-    def pop(self, timeout=0):
-        result = self.db.pop(timeout, desc=False)
-        if result:
-            return self._decode_request(result.key_)
+    def _pop_rows(self, timeout=0):
+        return self.db.pop(timeout, desc=False, batch_size=self.pop_batch_size)
 
 
 class PriorityQueue(Base):
 
     def push(self, request):
+        self.ack(request)
         data = self._encode_request(request)
         score = -request.priority
-        self.db.push(**{'key_': data, 'score': score})
+        self._push(**{'key_': data, 'score': score})
 
-    def pop(self, timeout=0):
-        result = self.db.pop_by_score(timeout)
-        if result:
-            return self._decode_request(result.key_)
+    def _pop_rows(self, timeout=0):
+        return self.db.pop_by_score(timeout, batch_size=self.pop_batch_size)
+
+
+class CountedPriorityQueue(PriorityQueue):
+    """
+    Priority queue keeping counts of its requests in memory, increased by the pushes of this process once inserted
+    and dropped when requests are put back, to be read again from the table
+    """
+
+    def _count_row(self, row):
+        """
+        Count an inserted row
+
+        :param row: the inserted row
+        :return: None
+        """
+        raise NotImplementedError
+
+    def _reset_counts(self):
+        raise NotImplementedError
+
+    def _push(self, **row):
+        super()._push(**row)
+        if self.push_batch_size <= 1:
+            self._count_row(row)
+
+    def flush(self):
+        rows = self._pushes
+        super().flush()
+        for row in rows:
+            self._count_row(row)
+
+    def close(self):
+        super().close()
+        # the requests put back are not counted
+        self._reset_counts()
+
+    def clear(self):
+        super().clear()
+        self._reset_counts()
+
+
+class BucketPriorityQueue(CountedPriorityQueue):
+    """
+    Priority queue keeping the number of requests of each priority in memory,
+    so that each pop is an indexed seek in the highest non-empty priority, FIFO within a priority
+
+    The counts are decreased by the pops of this process and read again from the table every
+    SCHEDULER_PENDING_SYNC_INTERVAL seconds and when no bucket is left, to account for other processes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._buckets = None
+        self._buckets_synced = 0
+
+    def _sync_buckets(self):
+        with timer(self.db_stats, 'count_by_score'):
+            self._buckets = self.db.count_by_score()
+        self._buckets_synced = time.time()
+
+    def _count_row(self, row):
+        if self._buckets is not None:
+            self._buckets[row['score']] = self._buckets.get(row['score'], 0) + 1
+
+    def _reset_counts(self):
+        self._buckets = None
+
+    def _pop_buckets(self):
+        while self._buckets:
+            score = min(self._buckets)
+            rows = self.db.pop_by_score(0, batch_size=self.pop_batch_size, score=score)
+            left = self._buckets[score] - len(rows)
+            if rows and left > 0:
+                self._buckets[score] = left
+            else:
+                # a bucket found empty was emptied by another process
+                del self._buckets[score]
+            if rows:
+                return rows
+        return []
+
+    def _pop_rows(self, timeout=0):
+        synced = self._buckets is None or time.time() - self._buckets_synced >= self.pending_sync_interval
+        if synced:
+            self._sync_buckets()
+        rows = self._pop_buckets()
+        if not rows and not synced:
+            self._sync_buckets()
+            rows = self._pop_buckets()
+        if not rows and timeout:
+            rows = super()._pop_rows(timeout)
+        return rows
+
+
+class DownloaderAwarePriorityQueue(CountedPriorityQueue):
+    """
+    Priority queue spreading the pops round-robin over the download slots with free capacity,
+    like scrapy.pqueues.DownloaderAwarePriorityQueue, so that one large domain does not hold back the others
+
+    Each row records the slot of its request. The number of requests of each slot is kept in memory and read again
+    from the table every SCHEDULER_PENDING_SYNC_INTERVAL seconds and when no slot is left. When every slot is busy,
+    the slot with the fewest active downloads is served. Requests are popped one at a time.
+    """
+    slot_aware = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = None
+        # the keys of _slots in order, kept sorted so that the slot after the last served one is found by bisection
+        self._slot_order = []
+        self._slots_synced = 0
+        self._last_slot = None
+
+    @property
+    def downloader(self):
+        engine = getattr(getattr(self.spider, 'crawler', None), 'engine', None)
+        return getattr(engine, 'downloader', None)
+
+    def _slot_key(self, request):
+        downloader = self.downloader
+        if downloader is not None:
+            if hasattr(downloader, 'get_slot_key'):
+                return downloader.get_slot_key(request)
+            return downloader._get_slot_key(request, self.spider)  # noqa
+        return request.meta.get('download_slot') or urlparse_cached(request).hostname or ''
+
+    def _active_downloads(self, slot):
+        """
+        Get the active downloads and the concurrency of a slot
+
+        :param slot: Slot key
+        :return: The number of active downloads and the concurrency, None if unknown
+        """
+        downloader = self.downloader
+        if downloader is None or slot not in downloader.slots:
+            return 0, None
+        s = downloader.slots[slot]
+        return len(s.active), s.concurrency
+
+    def push(self, request):
+        self.ack(request)
+        self._push(**{'key_': self._encode_request(request), 'score': -request.priority,
+                      'slot': self._slot_key(request)})
+
+    def _count_slot(self, slot, count=1):
+        if self._slots is None:
+            return
+        if slot not in self._slots:
+            bisect.insort(self._slot_order, slot)
+        self._slots[slot] = self._slots.get(slot, 0) + count
+        if self._slots[slot] <= 0:
+            self._drop_slot(slot)
+
+    def _drop_slot(self, slot):
+        del self._slots[slot]
+        del self._slot_order[bisect.bisect_left(self._slot_order, slot)]
+
+    def _count_row(self, row):
+        self._count_slot(row['slot'])
+
+    def _reset_counts(self):
+        self._slots = None
+        self._slot_order = []
+
+    def _sync_slots(self):
+        with timer(self.db_stats, 'count_by_slot'):
+            self._slots = self.db.count_by_slot()
+        self._slot_order = sorted(self._slots)
+        self._slots_synced = time.time()
+
+    def _next_slots(self):
+        """
+        Generate the slots to try: the free ones round-robin after the last served slot, then the busy ones by load
+
+        The busy slots are only ordered once every free slot has been tried.
+
+        :return: The generator of slots
+        """
+        order = self._slot_order
+        start = 0 if self._last_slot is None else bisect.bisect_right(order, self._last_slot)
+        busy = []
+        for i in range(len(order)):
+            slot = order[(start + i) % len(order)]
+            active, concurrency = self._active_downloads(slot)
+            if concurrency is None or active < concurrency:
+                yield slot
+            else:
+                busy.append((active, slot))
+        heapq.heapify(busy)
+        while busy:
+            yield heapq.heappop(busy)[1]
+
+    def _pop_slots(self):
+        empty = []
+        try:
+            for slot in self._next_slots():
+                rows = self.db.pop_by_score(0, batch_size=1, slot=slot)
+                if rows:
+                    self._last_slot = slot
+                    self._count_slot(slot, -1)
+                    return rows
+                # a slot found empty was emptied by another process
+                empty.append(slot)
+        finally:
+            # dropped once the slots are not iterated anymore
+            for slot in empty:
+                self._drop_slot(slot)
+        return []
+
+    def _pop_rows(self, timeout=0):
+        synced = self._slots is None or time.time() - self._slots_synced >= self.pending_sync_interval
+        if synced:
+            self._sync_slots()
+        rows = self._pop_slots()
+        if not rows and not synced:
+            self._sync_slots()
+            rows = self._pop_slots()
+        if not rows and timeout:
+            rows = self.db.pop_by_score(timeout, batch_size=1)
+        return rows
 
 
 class LifoQueue(Base):
 
+    def _pop_rows(self, timeout=0):
+        return self.db.pop(timeout, batch_size=self.pop_batch_size)
+
+
+class ShardedQueue(object):
+    """
+    Queue spreading the requests over SCHEDULER_SHARD_TABLES tables on each database of SCHEDULER_SHARD_URLS,
+    each one a SCHEDULER_SHARD_QUEUE_CLASS queue, so that the processes of a crawl do not all contend on one table
+
+    A request goes to the shard of its fingerprint, or of its domain with SCHEDULER_SHARD_KEY = 'domain'.
+    Pops go round-robin over the shards. A shard found empty is skipped for SCHEDULER_PENDING_SYNC_INTERVAL seconds,
+    unless this process pushes to it or it reports pending requests.
+    """
+    shard_keys = ('fingerprint', 'domain')
+
+    def __init__(self, spider, table_name, key, serializer=None):
+        """
+        Initialize spider queue object
+
+        :param spider: spider object
+        :param table_name: table name of the shards
+        :param key: current object key
+        :param serializer: serialization
+        """
+        settings = spider.settings
+        self.shard_key = settings.get('SCHEDULER_SHARD_KEY', defaults.SCHEDULER_SHARD_KEY)
+        if self.shard_key not in self.shard_keys:
+            raise ValueError(f'SCHEDULER_SHARD_KEY must be one of {self.shard_keys}: {self.shard_key}')
+        queue_cls = load_object(settings.get('SCHEDULER_SHARD_QUEUE_CLASS', defaults.SCHEDULER_SHARD_QUEUE_CLASS))
+        intern_table = settings.get('SCHEDULER_INTERN_TABLE', defaults.SCHEDULER_INTERN_TABLE)
+        # each shard has its own fragments table, whose unreferenced fragments it collects
+        self.shards = [queue_cls(spider, name, key, serializer=serializer, db_url=url, intern_table=intern_name)
+                       for (url, name), (_, intern_name) in zip(
+                           shard_tables(settings, table_name % {'spider': spider.name}),
+                           shard_tables(settings, intern_table % {'spider': spider.name}))]
+        self.spider = spider
+        self.lease_time = self.shards[0].lease_time
+        self.empty_interval = settings.getfloat('SCHEDULER_PENDING_SYNC_INTERVAL',
+                                                defaults.SCHEDULER_PENDING_SYNC_INTERVAL)
+        # the time each shard was last found empty
+        self._empty = {}
+        self._next = 0
+
+    def _shard_index(self, request):
+        """
+        Get the shard of a request, the same for every process
+
+        :param request: request object
+        :return: the index of the shard
+        """
+        if len(self.shards) == 1:
+            return 0
+        if self.shard_key == 'domain':
+            value = zlib.crc32((urlparse_cached(request).hostname or '').encode())
+        else:
+            value = int.from_bytes(fingerprint(request)[:4], 'big')
+        return value % len(self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def has_pending(self):
+        for i, shard in enumerate(self.shards):
+            if shard.has_pending():
+                self._empty.pop(i, None)
+                return True
+        return False
+
+    def push(self, request):
+        self.ack(request)
+        i = self._shard_index(request)
+        self.shards[i].push(request)
+        self._empty.pop(i, None)
+
+    def _popped(self, request, i):
+        if self.lease_time:
+            request.meta[SHARD_META_KEY] = i
+        return request
+
     def pop(self, timeout=0):
-        result = self.db.pop(timeout)
-        if result:
-            return self._decode_request(result.key_)
+        """
+        Pop a request from the next shard that has one
+
+        :param timeout: Seconds to wait when every shard is empty. Only the next shard is waited on, a request pushed
+            to another shard meanwhile is left for a later pop
+        :return: The request, or None
+        """
+        now = time.time()
+        for j in range(len(self.shards)):
+            i = (self._next + j) % len(self.shards)
+            if now - self._empty.get(i, float('-inf')) < self.empty_interval:
+                continue
+            request = self.shards[i].pop()
+            if request is not None:
+                self._next = (i + 1) % len(self.shards)
+                return self._popped(request, i)
+            self._empty[i] = now
+        if timeout:
+            # wait on the next shard only
+            i = self._next
+            self._next = (i + 1) % len(self.shards)
+            request = self.shards[i].pop(timeout)
+            if request is not None:
+                self._empty.pop(i, None)
+                return self._popped(request, i)
+
+    def ack(self, request):
+        """
+        Remove the leased row a request was popped from, in the shard it was popped from
+
+        :param request: request object
+        :return: None
+        """
+        i = request.meta.pop(SHARD_META_KEY, None)
+        if i is not None:
+            self.shards[i].ack(request)
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def clear(self):
+        self._empty.clear()
+        for shard in self.shards:
+            shard.clear()
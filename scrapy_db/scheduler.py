@@ -1,8 +1,19 @@
 import importlib
+import logging
+from collections import deque
 
+from scrapy import signals
 from scrapy.utils.misc import load_object
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.threadpool import ThreadPool
 
 from . import defaults
+from .db import close_databases, pool_stats, release_connections
+from .queue import LEASE_META_KEY
+from .stats import collect, log_stats
+from .utils import POLL_MAX_INTERVAL
+
+logger = logging.getLogger(__name__)
 
 
 class Scheduler(object):
@@ -19,7 +30,9 @@ class Scheduler(object):
                  dupefilter_table=defaults.SCHEDULER_DUPEFILTER_TABLE,
                  dupefilter_cls=defaults.SCHEDULER_DUPEFILTER_CLASS,
                  idle_before_close=0,
-                 serializer=None):
+                 serializer=None,
+                 stats_log_interval=defaults.DB_STATS_LOG_INTERVAL,
+                 stats_export=None):
         """
         Initialize scheduler.
 
@@ -29,8 +42,10 @@ class Scheduler(object):
         :param queue_cls: class of the queue
         :param dupefilter_table: name of the duplicate filter table
         :param dupefilter_cls: class of the duplicate filter
-        :param idle_before_close: maximum timeout when idle
+        :param idle_before_close: seconds AsyncScheduler waits in its database thread for a push to an empty queue
         :param serializer: serialization tool
+        :param stats_log_interval: seconds between two log lines of the database operation stats, 0 to disable
+        :param stats_export: function called with the database operation stats and the spider
         """
         self.df = None
         self.queue = None
@@ -46,7 +61,11 @@ class Scheduler(object):
         self.dupefilter_table = dupefilter_table
         self.idle_before_close = idle_before_close
         self.serializer = serializer
+        self.stats_log_interval = stats_log_interval
+        self.stats_export = stats_export
+        self._stats_task = None
         self.stats = None
+        self.crawler = None
 
     def __len__(self):
         return len(self.queue)
@@ -57,6 +76,7 @@ class Scheduler(object):
             'persist': settings.getbool('SCHEDULER_PERSIST'),
             'flush_on_start': settings.getbool('SCHEDULER_FLUSH_ON_START'),
             'idle_before_close': settings.getint('SCHEDULER_IDLE_BEFORE_CLOSE'),
+            'stats_log_interval': settings.getfloat('DB_STATS_LOG_INTERVAL', defaults.DB_STATS_LOG_INTERVAL),
         }
 
         optional = {
@@ -72,7 +92,13 @@ class Scheduler(object):
                 kwargs[name] = val
 
         if isinstance(kwargs.get('serializer'), str):
-            kwargs['serializer'] = importlib.import_module(kwargs['serializer'])
+            try:
+                kwargs['serializer'] = importlib.import_module(kwargs['serializer'])
+            except ImportError:
+                # the path of a class, such as scrapy_db.utils.CustomPickle
+                kwargs['serializer'] = load_object(kwargs['serializer'])
+        if settings.get('DB_STATS_EXPORT'):
+            kwargs['stats_export'] = load_object(settings.get('DB_STATS_EXPORT'))
 
         return cls(**kwargs)
 
@@ -86,9 +112,11 @@ class Scheduler(object):
         """
         instance = cls.from_settings(crawler.settings)
         instance.stats = crawler.stats
+        instance.crawler = crawler
         return instance
 
     def open(self, spider):
+        self.spider = spider
         try:
             self.queue = load_object(self.queue_cls)(
                 spider=spider,
@@ -101,14 +129,41 @@ class Scheduler(object):
 
         self.df = load_object(self.dupefilter_cls).from_spider(spider)
 
+        if self.crawler is not None and getattr(self.queue, 'lease_time', 0):
+            self.crawler.signals.connect(self._response_received, signal=signals.response_received)
+            # also sent when the download failed, the request is not received as a response
+            self.crawler.signals.connect(self._request_left_downloader, signal=signals.request_left_downloader)
+
         if self.flush_on_start:
             self.flush()
-        if len(self.queue):
-            spider.log(f"Resuming crawl ({len(self.queue)} requests scheduled)")
+        self._log_pending()
+
+        if self.stats and self.stats_log_interval > 0:
+            self._stats_task = task.LoopingCall(log_stats, self.stats, self.stats_export, spider)
+            self._stats_task.start(self.stats_log_interval, now=False)
+
+    def _log_pending(self):
+        pending = len(self.queue)
+        if pending:
+            self.spider.log(f"Resuming crawl ({pending} requests scheduled)")
 
     def close(self, reason=''):
+        self.queue.close()
         if not self.persist:
             self.flush()
+        elif hasattr(self.df, 'checkpoint'):
+            self.df.checkpoint()
+        if self.stats:
+            for key, value in pool_stats().items():
+                self.stats.set_value(f'db/pool/{key}', value, spider=self.spider)
+        close_databases()
+        self._stop_stats_task()
+        if self.stats and self.stats_export is not None:
+            self.stats_export(collect(self.stats), self.spider)
+
+    def _stop_stats_task(self):
+        if self._stats_task is not None and self._stats_task.running:
+            self._stats_task.stop()
 
     def flush(self):
         self.df.clear()
@@ -124,11 +179,186 @@ class Scheduler(object):
         return True
 
     def next_request(self):
-        block_pop_timeout = self.idle_before_close
-        request = self.queue.pop(block_pop_timeout)
+        # waiting for a push here would block the reactor, the engine asks again on its next heartbeat
+        request = self.queue.pop()
         if request and self.stats:
             self.stats.inc_value('scheduler/dequeued/db', spider=self.spider)
         return request
 
+    def _response_received(self, response, request, spider):
+        self._ack(request)
+
+    def _request_left_downloader(self, request, spider):
+        self._ack(request)
+
+    def _ack(self, request):
+        self.queue.ack(request)
+
+    def has_pending_requests(self):
+        return self.queue.has_pending()
+
+
+class AsyncScheduler(Scheduler):
+    """
+    Scheduler running every database operation in a dedicated thread, so that slow queries do not stall downloads
+
+    enqueue_request returns at once and always returns True, the dupefilter runs in the background.
+    next_request is served from a buffer of requests refilled in the background when it runs low.
+    A refill finding the queue empty waits for a push for SCHEDULER_IDLE_BEFORE_CLOSE seconds,
+    at most POLL_MAX_INTERVAL at a time so that the operations submitted meanwhile are not held back.
+    """
+
+    def __init__(self, *args, buffer_size=defaults.SCHEDULER_ASYNC_BUFFER_SIZE, **kwargs):
+        """
+        Initialize scheduler.
+
+        :param buffer_size: number of requests popped in advance for next_request
+        """
+        super().__init__(*args, **kwargs)
+        self.buffer_size = buffer_size
+        self._buffer = deque()
+        self._enqueuing = 0
+        self._refilling = False
+        self._refill_d = None
+        self._closing = False
+        self._has_pending = False
+        self._threadpool = None
+        self._shutdown_trigger = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        instance = super().from_settings(settings)
+        instance.buffer_size = settings.getint('SCHEDULER_ASYNC_BUFFER_SIZE', defaults.SCHEDULER_ASYNC_BUFFER_SIZE)
+        return instance
+
+    def run_in_thread(self, func, *args):
+        """
+        Run a function in the database thread, such as the reads of the start urls of scrapy_db.spiders.DBBase
+
+        :param func: function to run
+        :param args: arguments of the function
+        :return: Deferred firing with the result of the function
+        """
+        return threads.deferToThreadPool(reactor, self._threadpool, self._call, func, *args)
+
+    @staticmethod
+    def _call(func, *args):
+        try:
+            return func(*args)
+        finally:
+            # the queries run outside of DBModel, such as the ones of the dupefilters, keep their connection
+            release_connections()
+
+    def open(self, spider):
+        # a single thread runs the operations in the order they are submitted and never shares the queue
+        self._threadpool = ThreadPool(minthreads=1, maxthreads=1, name='scrapy_db')
+        self._threadpool.start()
+        # a scheduler never closed must not keep the process alive
+        self._shutdown_trigger = reactor.addSystemEventTrigger('before', 'shutdown', self._threadpool.stop)
+        super().open(spider)
+        # unknown until the first refill reports it
+        self._has_pending = True
+        self._refill()
+
+    def _log_pending(self):
+        self.run_in_thread(super()._log_pending).addErrback(self._log_failure, 'Failed to count requests')
+
+    def close(self, reason=''):
+        # the looping call belongs to the reactor thread
+        self._stop_stats_task()
+        self._closing = True
+        # the requests of a refill in flight are claimed already, they join the buffer before it is put back
+        d = self._refill_d if self._refilling else defer.succeed(None)
+        d.addCallback(self._close_after_refill, reason)
+        d.addBoth(self._stop_threadpool)
+        return d
+
+    def _close_after_refill(self, _, reason):
+        requests, self._buffer = list(self._buffer), deque()
+        return self.run_in_thread(self._close, requests, reason)
+
+    def _close(self, requests, reason):
+        # requests popped in advance go back to the queue
+        for request in requests:
+            self.queue.push(request)
+        super().close(reason)
+
+    def _stop_threadpool(self, result):
+        reactor.removeSystemEventTrigger(self._shutdown_trigger)
+        self._shutdown_trigger = None
+        self._threadpool.stop()
+        return result
+
+    def enqueue_request(self, request):
+        self._enqueuing += 1
+        d = self.run_in_thread(super().enqueue_request, request)
+        d.addErrback(self._log_failure, 'Failed to enqueue request %(request)s', {'request': request})
+        d.addBoth(self._enqueued)
+        return True
+
+    def _enqueued(self, result):
+        self._enqueuing -= 1
+        if result:
+            self._has_pending = True
+
+    def next_request(self):
+        request = self._buffer.popleft() if self._buffer else None
+        if len(self._buffer) <= self.buffer_size // 2:
+            self._refill()
+        if request and self.stats:
+            self.stats.inc_value('scheduler/dequeued/db', spider=self.spider)
+        return request
+
+    def _refill(self):
+        if self._refilling or self._closing or self._threadpool is None:
+            return
+        self._refilling = True
+        timeout = 0
+        if not self._buffer and not self._enqueuing:
+            timeout = min(self.idle_before_close, POLL_MAX_INTERVAL)
+        count = self.buffer_size - len(self._buffer)
+        d = self._refill_d = self.run_in_thread(self._pop_requests, count, timeout)
+        d.addCallback(self._refilled)
+        d.addErrback(self._log_failure, 'Failed to pop requests')
+        d.addBoth(self._refill_done)
+
+    def _pop_requests(self, count, timeout=0):
+        requests = []
+        while len(requests) < count:
+            request = self.queue.pop(0 if requests else timeout)
+            if request is None:
+                break
+            requests.append(request)
+        return requests, self.queue.has_pending()
+
+    def _refilled(self, result):
+        requests, self._has_pending = result
+        self._buffer.extend(requests)
+        if requests:
+            self._wake_up_engine()
+
+    def _refill_done(self, _):
+        self._refilling = False
+        self._refill_d = None
+
+    def _wake_up_engine(self):
+        engine = getattr(self.crawler, 'engine', None)
+        slot = getattr(engine, '_slot', None) or getattr(engine, 'slot', None)
+        if slot is not None:
+            slot.nextcall.schedule()
+
+    def _ack(self, request):
+        if LEASE_META_KEY not in request.meta:
+            # acknowledged already, when the response of a downloaded request is received
+            return
+        self.run_in_thread(self.queue.ack, request).addErrback(
+            self._log_failure, 'Failed to acknowledge request %(request)s', {'request': request})
+
+    @staticmethod
+    def _log_failure(failure, msg, *args):
+        logger.error(msg, *args, exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+
     def has_pending_requests(self):
-        return len(self) > 0
+        if not self._buffer:
+            self._refill()
+        return bool(self._buffer) or self._enqueuing > 0 or self._has_pending
@@ -1,11 +1,14 @@
+import json
 import time
 
-from scrapy import signals, FormRequest
+from scrapy import signals, FormRequest, Request
 from scrapy.exceptions import DontCloseSpider
 from scrapy.spiders import Spider, CrawlSpider
+from scrapy.utils.misc import load_object
 
 from . import defaults
 from .db import DBModel
+from .scheduler import AsyncScheduler
 from .utils import TextColor, is_dict
 
 
@@ -20,6 +23,17 @@ class DBBase(object):
 
     spider_idle_start_time = int(time.time())
     max_idle_time = None
+    low_watermark = None
+    start_urls_format = None
+    # whether the start urls are read in a thread, with scrapy_db.scheduler.AsyncScheduler
+    start_urls_async = None
+
+    # id of the last start url read, the next ones are read after it
+    _start_url_cursor = 0
+    # whether the last read found no start url, until the spider is idle
+    _start_urls_exhausted = False
+    # whether a read of start urls runs in a thread
+    _reading_start_urls = False
 
     def start_requests(self):
         return self.next_requests()
@@ -68,11 +82,50 @@ class DBBase(object):
         except (TypeError, ValueError):
             raise ValueError("max_idle_time must be an integer")
 
+        if self.start_urls_format is None:
+            self.start_urls_format = settings.get('START_URLS_FORMAT', defaults.START_URLS_FORMAT)
+
+        if self.start_urls_format not in ('literal', 'json'):
+            raise ValueError("start_urls_format must be literal or json")
+
+        if self.low_watermark is None:
+            self.low_watermark = settings.getint('START_URLS_LOW_WATERMARK', defaults.START_URLS_LOW_WATERMARK)
+
+        try:
+            self.low_watermark = int(self.low_watermark)
+        except (TypeError, ValueError):
+            raise ValueError("low_watermark must be an integer")
+
+        if self.start_urls_async is None:
+            scheduler_cls = settings.get('SCHEDULER')
+            self.start_urls_async = bool(scheduler_cls) and issubclass(load_object(scheduler_cls), AsyncScheduler)
+
+        if self.low_watermark > 0:
+            crawler.signals.connect(self.request_left_downloader, signal=signals.request_left_downloader)
         crawler.signals.connect(self.spider_idle, signal=signals.spider_idle)
 
+    def _read_start_urls(self):
+        """
+        Claim the next batch of start url rows
+
+        :return: The list of rows
+        """
+        # keyset pagination, each read seeks the (deleted, id) index after the last row read
+        datas = self.db.fetch_data(self.db_batch_size, after=self._start_url_cursor)
+        if not datas and self._start_url_cursor:
+            # rows put back behind the cursor
+            self._start_url_cursor = 0
+            datas = self.db.fetch_data(self.db_batch_size, after=0)
+        if datas:
+            self._start_url_cursor = datas[-1].id
+        self._start_urls_exhausted = not datas
+        return datas
+
     def next_requests(self):
+        return self._requests_from_data(self._read_start_urls())
+
+    def _requests_from_data(self, datas):
         found = 0
-        datas = self.db.fetch_data(self.db_batch_size)
         for data in datas:
             reqs = self.make_request_from_data(data)
             if reqs:
@@ -86,7 +139,10 @@ class DBBase(object):
 
     def make_request_from_data(self, data):
         d = data.start_url
-        parameter = is_dict(d)
+        if self.start_urls_format == 'json':
+            return self._make_request_from_json(d)
+        # only a dict literal needs to be evaluated
+        parameter = d if isinstance(d, str) and not d.lstrip().startswith('{') else is_dict(d)
         if isinstance(parameter, str):
             self.logger.warning(f"{TextColor.WARNING}WARNING: String request is deprecated, please use JSON data format. \
                 Detail information, please check https://github.com/rmax/scrapy-redis#features{TextColor.ENDC}")
@@ -102,12 +158,96 @@ class DBBase(object):
 
         return FormRequest(url, dont_filter=True, method=method, formdata=parameter, meta=metadata)
 
+    def _make_request_from_json(self, d):
+        """
+        Make a request from a plain url, or from a JSON object with url, method, meta and form data keys
+
+        :param d: The start url data
+        :return: The request, or an empty list if the data is invalid
+        """
+        if not d.lstrip().startswith('{'):
+            # plain url, no parsing and no form encoding
+            return Request(d, dont_filter=True)
+        try:
+            parameter = json.loads(d)
+        except ValueError:
+            self.logger.warning(f"{TextColor.WARNING}The data from db is not valid JSON: {d}{TextColor.ENDC}")
+            return []
+        url = parameter.pop('url', None)
+        if url is None:
+            self.logger.warning(f"{TextColor.WARNING}The data from db has no url key in push data{TextColor.ENDC}")
+            return []
+        method = parameter.pop('method', 'GET').upper()
+        metadata = parameter.pop('meta', None)
+        if parameter:
+            return FormRequest(url, dont_filter=True, method=method, formdata=parameter, meta=metadata)
+        return Request(url, dont_filter=True, method=method, meta=metadata)
+
     def schedule_next_requests(self):
+        if self.start_urls_async:
+            self._schedule_next_requests_async()
+            return
         for req in self.next_requests():
-            self.crawler.engine.crawl(req, spider=self)
+            self.crawler.engine.crawl(req)
+
+    def _scheduler(self):
+        engine = self.crawler.engine
+        slot = getattr(engine, '_slot', None) or getattr(engine, 'slot', None)
+        return getattr(slot, 'scheduler', None)
+
+    def _schedule_next_requests_async(self):
+        """
+        Read the start urls in the database thread of the scheduler and schedule their requests on the reactor,
+        one read at a time
+
+        :return: None
+        """
+        if self._reading_start_urls:
+            return
+        scheduler = self._scheduler()
+        if not isinstance(scheduler, AsyncScheduler):
+            # without the database thread of an AsyncScheduler, the start urls are read like in synchronous mode
+            for req in self.next_requests():
+                self.crawler.engine.crawl(req)
+            return
+        self._reading_start_urls = True
+        d = scheduler.run_in_thread(self._read_start_urls)
+        d.addCallback(self._crawl_start_urls)
+        d.addErrback(lambda f: self.logger.error('Failed to read start urls',
+                                                 exc_info=(f.type, f.value, f.getTracebackObject())))
+        d.addBoth(self._start_urls_read)
+
+    def _crawl_start_urls(self, datas):
+        if datas:
+            # the table is not empty, the spider is not idle
+            self.spider_idle_start_time = int(time.time())
+        for req in self._requests_from_data(datas):
+            self.crawler.engine.crawl(req)
+
+    def _start_urls_read(self, _):
+        self._reading_start_urls = False
+
+    def request_left_downloader(self, request, spider):
+        """
+        Read more start urls when fewer than low_watermark requests are downloading and none is scheduled
+
+        :param request: Request object
+        :param spider: Spider object
+        :return: None
+        """
+        if self._start_urls_exhausted:
+            return
+        if len(self.crawler.engine.downloader.active) >= self.low_watermark:
+            return
+        scheduler = self._scheduler()
+        if scheduler is not None and scheduler.has_pending_requests():
+            return
+        self.schedule_next_requests()
 
     def spider_idle(self):
-        if self.db is not None and len(self.db) > 0:
+        self._start_urls_exhausted = False
+        # the asynchronous read resets the idle time when it finds start urls
+        if not self.start_urls_async and self.db is not None and self.db.exists():
             self.spider_idle_start_time = int(time.time())
 
         self.schedule_next_requests()
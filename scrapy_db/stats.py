@@ -0,0 +1,118 @@
+import contextlib
+import logging
+import time
+
+from scrapy_db import defaults
+
+logger = logging.getLogger(__name__)
+
+# The upper bounds of the latency histogram buckets, in seconds, with their key suffix
+LATENCY_BUCKETS = ((0.001, 'le_1ms'), (0.01, 'le_10ms'), (0.1, 'le_100ms'), (1, 'le_1s'), (float('inf'), 'gt_1s'))
+
+# The prefixes of the keys recorded by DBStats
+PREFIXES = ('scheduler/db/', 'dupefilter/db/')
+
+_disabled = contextlib.nullcontext()
+
+
+class DBStats(object):
+    """
+    Record the count, the total time and a latency histogram of database operations in the stats collector
+
+    For an operation op, the keys are <prefix>/<op>/count, <prefix>/<op>/time in seconds and
+    <prefix>/<op>/latency/<bucket>.
+    """
+
+    def __init__(self, stats, prefix, spider=None):
+        """
+        Initialize
+
+        :param stats: Stats collector
+        :param prefix: Prefix of the keys, scheduler/db or dupefilter/db
+        :param spider: The spider of the stats
+        """
+        self.stats = stats
+        self.prefix = prefix
+        self.spider = spider
+
+    @classmethod
+    def from_settings(cls, settings, stats, prefix, spider=None):
+        """
+        Create an instance if DB_STATS_ENABLED is set
+
+        :param settings: The settings
+        :param stats: Stats collector
+        :param prefix: Prefix of the keys
+        :param spider: The spider of the stats
+        :return: Instance of the current class, or None if instrumentation is disabled or there is no stats collector
+        """
+        if stats is None or not settings.getbool('DB_STATS_ENABLED', defaults.DB_STATS_ENABLED):
+            return None
+        return cls(stats, prefix, spider)
+
+    def record(self, op, seconds):
+        """
+        Record one operation
+
+        :param op: Name of the operation
+        :param seconds: Duration of the operation
+        :return: None
+        """
+        key = f'{self.prefix}/{op}'
+        self.stats.inc_value(f'{key}/count', spider=self.spider)
+        self.stats.inc_value(f'{key}/time', seconds, spider=self.spider)
+        for bound, name in LATENCY_BUCKETS:
+            if seconds <= bound:
+                self.stats.inc_value(f'{key}/latency/{name}', spider=self.spider)
+                break
+
+    @contextlib.contextmanager
+    def timer(self, op):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(op, time.perf_counter() - start)
+
+
+def timer(db_stats, op):
+    """
+    Time a block with db_stats, doing nothing when instrumentation is disabled
+
+    :param db_stats: DBStats instance or None
+    :param op: Name of the operation
+    :return: Context manager
+    """
+    if db_stats is None:
+        return _disabled
+    return db_stats.timer(op)
+
+
+def collect(stats):
+    """
+    Get the database operation stats
+
+    :param stats: Stats collector
+    :return: The stats whose key starts with scheduler/db/ or dupefilter/db/
+    """
+    return {k: v for k, v in stats.get_stats().items() if k.startswith(PREFIXES)}
+
+
+def log_stats(stats, hook=None, spider=None):
+    """
+    Log one line per database operation and pass the stats to the export hook, called every DB_STATS_LOG_INTERVAL
+
+    :param stats: Stats collector
+    :param hook: Function called with the database operation stats and the spider
+    :param spider: The spider
+    :return: None
+    """
+    values = collect(stats)
+    for key in sorted(k for k in values if k.endswith('/count')):
+        op = key[:-len('/count')]
+        count = values[key]
+        total = values.get(f'{op}/time', 0)
+        logger.info('%(op)s: %(count)d ops, %(avg).3f ms avg, %(total).3f s total',
+                    {'op': op, 'count': count, 'avg': total / count * 1000 if count else 0, 'total': total})
+    if hook is not None:
+        hook(values, spider)
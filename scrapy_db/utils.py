@@ -1,7 +1,16 @@
 import base64
+import functools
+import inspect
 import pickle
+import random
 import time
 from ast import literal_eval
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class TextColor:
@@ -43,17 +52,121 @@ class HexPickle(object):
         return pickle.dumps(*args, **kwargs).hex()
 
 
+class BinaryPickle(object):
+    """
+    Pickle without text encoding, for queues storing requests in a BLOB column
+    """
+    binary = True
+
+    @staticmethod
+    def loads(data):
+        return pickle.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class MsgpackSerializer(object):
+    """
+    MessagePack serializer for queues storing requests in a BLOB column, requires the msgpack package
+
+    Faster and smaller than pickle, but the meta and cb_kwargs of the requests may only hold
+    None, booleans, numbers, strings, bytes, lists and dicts. Tuples are loaded as lists.
+    """
+    binary = True
+
+    @staticmethod
+    def _require():
+        if msgpack is None:
+            raise ImportError('MsgpackSerializer requires the msgpack package, install scrapy-db[msgpack]')
+
+    @staticmethod
+    def loads(data):
+        MsgpackSerializer._require()
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    @staticmethod
+    def dumps(obj):
+        MsgpackSerializer._require()
+        return msgpack.packb(obj, use_bin_type=True)
+
+
+class BoundedCache(object):
+    """
+    A size-limited in-memory mapping, evicting the least recently used (lru) or the oldest (fifo) key
+    """
+    policies = ('lru', 'fifo')
+
+    def __init__(self, size, policy='lru'):
+        if size <= 0:
+            raise ValueError(f'cache size must be positive: {size}')
+        if policy not in self.policies:
+            raise ValueError(f'cache policy must be one of {self.policies}: {policy}')
+        self.size = size
+        self.policy = policy
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        if key not in self._data:
+            return False
+        if self.policy == 'lru':
+            self._data.move_to_end(key)
+        return True
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self._data[key]
+
+    def add(self, key, value=True):
+        self._data[key] = value
+        if self.policy == 'lru':
+            self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+# Bounds in seconds of the wait between two calls of a function decorated with execute_with_timeout
+POLL_MIN_INTERVAL = 0.01
+POLL_MAX_INTERVAL = 1.0
+
+
 def execute_with_timeout(func):
+    """
+    Call the function until it returns a result or its timeout argument has elapsed
+
+    The wait between two calls doubles from POLL_MIN_INTERVAL to POLL_MAX_INTERVAL, with jitter so that idle
+    workers do not poll in step. If the function is a method of an object with a wait_for_push(timeout) method,
+    it is used instead of sleeping so that the object can be woken up as soon as something is pushed.
+
+    :param func: The function to be executed
+    :return: The inner function
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
     def inner(*args, **kwargs):
-        timeout_ = kwargs.get('timeout', 0)
+        timeout_ = signature.bind_partial(*args, **kwargs).arguments.get('timeout', 0)
 
-        if timeout_ == 0:
+        if not timeout_:
             return func(*args, **kwargs)
-        t = time.time()
+        wait = getattr(args[0], 'wait_for_push', time.sleep) if args else time.sleep
+        deadline = time.time() + timeout_
+        interval = POLL_MIN_INTERVAL
         while True:
-            if time.time() - t >= timeout_:
-                break
             if r := func(*args, **kwargs):
                 return r
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            wait(min(remaining, interval * random.uniform(0.5, 1)))
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
 
     return inner
@@ -11,7 +11,7 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     author="libra146",
     author_email="shumeipai146@gmail.com",
-    packages=setuptools.find_packages(include=["scrapy_db"]),
+    packages=setuptools.find_packages(include=["scrapy_db", "scrapy_db.*"]),
     license="GPL-3.0-only",
     url="https://github.com/libra146/scrapy-db",
     project_urls={
@@ -33,12 +33,21 @@ setuptools.setup(
         "peewee>=3.16.0",
         "pymysql>=1.0.3",
     ],
+    entry_points={
+        "scrapy.commands": [
+            "seed = scrapy_db.commands.seed:Command",
+        ],
+    },
     extras_require={
+        "msgpack": [
+            "msgpack>=1.0.0",
+        ],
         "test": [
             "pytest>=7.3.2",
             "pytest-mock>=3.10.0",
             "codecov>=2.1.13",
             "pytest-cov>=4.1.0",
+            "msgpack>=1.0.0",
         ]
     },
 )
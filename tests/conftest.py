@@ -1,4 +1,5 @@
 import datetime
+import time
 from unittest import mock
 
 import pytest
@@ -25,3 +26,34 @@ def get_queue_db():
 def get_dupelifter_db():
     db = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:'}, 'test_dupelifter', 'dupelifter')
     return db
+
+
+@pytest.fixture(scope='session')
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def get_dupelifter_unique_db():
+    db = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:'}, 'test_dupelifter_unique',
+                                           'dupelifter_unique')
+    return db
+
+
+@pytest.fixture
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def get_bloom_db():
+    db = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:'}, 'test_bloom', 'bloom')
+    return db
+
+
+def run_reactor_until(condition, timeout=10):
+    """
+    Deliver the results of the threads to the reactor, without running it, until the condition is true
+
+    :param condition: function returning whether to stop
+    :param timeout: seconds after which the test fails
+    :return: None
+    """
+    from twisted.internet import reactor
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        reactor.runUntilCurrent()
+        time.sleep(0.01)
@@ -0,0 +1,43 @@
+import pytest
+
+from scrapy_db.bloom import BloomSlice, ScalableBloomFilter
+
+
+def test_bloom_slice():
+    s = BloomSlice(100, 0.01, 16)
+    assert s.num_bits == 959
+    assert s.num_hashes == 7
+    assert s.num_chunks == 8
+
+    key = ScalableBloomFilter.digest(b'value')
+    assert key not in s
+    s.add(key)
+    assert key in s
+    assert s.count == 1
+    assert s.dirty
+
+    other = BloomSlice(100, 0.01, 16)
+    for i in range(s.num_chunks):
+        other.set_chunk(i, s.get_chunk(i))
+    assert key in other
+    assert other.bits == s.bits
+
+    with pytest.raises(ValueError):
+        BloomSlice(0, 0.01, 16)
+    with pytest.raises(ValueError):
+        BloomSlice(10, 1, 16)
+
+
+def test_scalable_bloom_filter():
+    bloom = ScalableBloomFilter(100, 0.01, 64)
+    values = [str(i).encode() for i in range(1000)]
+    added = sum(bloom.add(v) for v in values)
+    # the filter grew past the first slice while staying under the error rate
+    assert len(bloom.slices) == 4
+    assert added >= 990
+    assert len(bloom) == added
+    assert all(v in bloom for v in values)
+    assert not bloom.add(values[0])
+
+    false_positives = sum(str(i).encode() in bloom for i in range(1000, 11000))
+    assert false_positives < 150
@@ -0,0 +1,125 @@
+import pickle
+import zlib
+from unittest import mock
+
+import pytest
+from peewee import CharField, ColumnMetadata, MySQLDatabase
+from scrapy import Request
+from scrapy.statscollectors import MemoryStatsCollector
+
+from scrapy_db.compression import CompressedSerializer, train_zdict
+from scrapy_db.db import LongBlobField, check_binary_columns
+from scrapy_db.queue import FifoQueue
+from scrapy_db.utils import BinaryPickle, CustomPickle
+from tests.conftest import _attributes
+from tests.test_queue import get_spider
+
+data = {'url': 'https://example.com', 'headers': {b'Cookie': [b'session=' + b'a' * 500]}}
+
+
+@pytest.mark.parametrize('method, header', [
+    ('zlib', b'\x01'),
+    ('lzma', b'\x02'),
+])
+def test_compressed_serializer(method, header):
+    serializer = CompressedSerializer(BinaryPickle, method=method)
+    result = serializer.dumps(data)
+    assert result[:1] == header
+    assert len(result) < len(BinaryPickle.dumps(data))
+    assert serializer.loads(result) == data
+
+    small = {'url': 'https://example.com'}
+    result = serializer.dumps(small)
+    assert result[:1] == b'\x00'
+    assert serializer.loads(result) == small
+
+    # rows stored before compression was enabled
+    assert serializer.loads(BinaryPickle.dumps(data)) == data
+
+    with pytest.raises(ValueError):
+        CompressedSerializer(BinaryPickle, method='gzip')
+
+
+def test_text_serializer():
+    serializer = CompressedSerializer(CustomPickle, threshold=0)
+    result = serializer.dumps(data)
+    assert isinstance(result, bytes)
+    assert serializer.loads(result) == data
+    assert serializer.loads(CustomPickle.dumps(data).encode()) == data
+
+
+def test_zdict():
+    samples = [pickle.dumps({'url': f'https://example.com/{i}', 'headers': {b'User-Agent': [b'Mozilla/5.0 test']}})
+               for i in range(100)]
+    zdict = train_zdict(samples, size=1024)
+    assert 0 < len(zdict) <= 1024
+    serializer = CompressedSerializer(BinaryPickle, threshold=0, zdict=zdict)
+    plain = CompressedSerializer(BinaryPickle, threshold=0)
+    obj = {'url': 'https://example.com/1000', 'headers': {b'User-Agent': [b'Mozilla/5.0 test']}}
+    result = serializer.dumps(obj)
+    assert result[:1] == b'\x03'
+    assert len(result) < len(plain.dumps(obj))
+    assert serializer.loads(result) == obj
+    assert serializer.loads(plain.dumps(obj)) == obj
+
+    with pytest.raises(ValueError):
+        plain.loads(result)
+    with pytest.raises(zlib.error):
+        CompressedSerializer(BinaryPickle, zdict=b'other').loads(result)
+
+
+def test_stats():
+    stats = MemoryStatsCollector(mock.Mock())
+    serializer = CompressedSerializer(BinaryPickle, stats=stats)
+    serializer.loads(serializer.dumps(data))
+    assert stats.get_value('scheduler/compression/bytes') == len(BinaryPickle.dumps(data))
+    assert stats.get_value('scheduler/compression/compressed_bytes') < stats.get_value('scheduler/compression/bytes')
+    assert stats.get_value('scheduler/compression/ratio') > 1
+    assert stats.get_value('scheduler/compression/encode_time') > 0
+    assert stats.get_value('scheduler/compression/decode_time') > 0
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_queue_compression(tmp_path):
+    zdict = tmp_path / 'zdict'
+    zdict.write_bytes(b'https://example.com')
+    spider = get_spider(SCHEDULER_COMPRESSION='zlib', SCHEDULER_COMPRESSION_LEVEL=9,
+                        SCHEDULER_COMPRESSION_ZDICT=str(zdict))
+    spider.crawler = None
+    queue = FifoQueue(spider, 'test_compression_%(spider)s', 'queue')
+    assert isinstance(queue.serializer, CompressedSerializer)
+    assert queue.serializer.level == 9
+    assert queue.serializer.zdict == b'https://example.com'
+    assert queue.db.db.key_.field_type == 'BLOB'
+    request = Request(url='https://example.com', body=b'test' * 1000)
+    queue.push(request)
+    assert queue.pop().body == request.body
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_enable_compression_on_existing_table(tmp_path):
+    settings = {'DB_URL': f'sqlite:///{tmp_path}/upgrade.db'}
+    spider = get_spider(**settings)
+    spider.crawler = None
+    queue = FifoQueue(spider, 'test_upgrade_%(spider)s', 'queue')
+    queue.push(Request(url='https://example.com/old', body=b'old' * 1000))
+
+    spider = get_spider(SCHEDULER_COMPRESSION='zlib', SCHEDULER_COMPRESSION_THRESHOLD=0, **settings)
+    spider.crawler = None
+    queue = FifoQueue(spider, 'test_upgrade_%(spider)s', 'queue')
+    queue.push(Request(url='https://example.com/new', body=b'new' * 1000))
+    assert [queue.pop().url for _ in range(2)] == ['https://example.com/old', 'https://example.com/new']
+    assert queue.pop() is None
+
+
+def test_text_column_check():
+    model = mock.Mock()
+    model._meta.database = mock.Mock(spec=MySQLDatabase)
+    model._meta.table_name = 'test_requests'
+    model._meta.sorted_fields = [CharField(column_name='url'), LongBlobField(column_name='key_')]
+    model._meta.database.get_columns.return_value = [ColumnMetadata('key_', 'varchar', False, False, 'test', None)]
+    with pytest.raises(RuntimeError) as e:
+        check_binary_columns(model)
+    assert 'LONGBLOB' in str(e.value)
+    model._meta.database.get_columns.return_value = [ColumnMetadata('key_', 'longblob', False, False, 'test', None)]
+    check_binary_columns(model)
@@ -1,8 +1,14 @@
+import threading
 import time
+from unittest import mock
 
 import pytest
+from peewee import PostgresqlDatabase, MySQLDatabase
+from playhouse.pool import PooledDatabase
+from playhouse.shortcuts import ReconnectMixin
 
-from scrapy_db.db import DBModel, BaseDB
+from scrapy_db.db import DBModel, BaseDB, _lease_fields, get_database, pool_stats, close_databases
+from tests.conftest import _attributes
 
 
 def test_base_db():
@@ -33,6 +39,7 @@ def test_db_connection(get_queue_db):
 
     get_db.push(**{'key_': '444', 'score': 1})
     assert get_db.db.select().count() == 4
+    assert get_db.exists()
 
     data = get_db.pop()
     assert data.key_ == '444'
@@ -50,6 +57,7 @@ def test_db_connection(get_queue_db):
 
     get_db.pop()
     assert len(get_db) == 0
+    assert not get_db.exists()
     assert get_db.db.select().limit(1) == []
 
     t = time.time()
@@ -79,3 +87,259 @@ def test_db_connection(get_queue_db):
         get_db.db = None
         get_db.pop()
     assert 'db' in str(e.value)
+
+
+def test_push_unique(get_dupelifter_unique_db):
+    get_db = get_dupelifter_unique_db
+    assert get_db.push_unique(**{'key_': 'aaa'}) is True
+    assert get_db.push_unique(**{'key_': 'aaa'}) is False
+    assert get_db.push_unique(**{'key_': 'bbb'}) is True
+    assert get_db.db.select().count() == 2
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_push_many():
+    get_db = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:'}, 'test_push_many', 'queue')
+    get_db.push_many([{'key_': str(i), 'score': i} for i in range(5)], batch_size=2)
+    assert len(get_db) == 5
+    assert [r.key_ for r in get_db.db.select().order_by(get_db.db.id)] == ['0', '1', '2', '3', '4']
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_pop_by_score():
+    get_db = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:'}, 'test_pop_by_score', 'queue')
+    get_db.push_many([{'key_': f'{score}-{i}', 'score': score} for i in range(3) for score in (0, -5, 2)])
+    assert get_db.count_by_score() == {-5: 3, 0: 3, 2: 3}
+    assert [r.key_ for r in get_db.pop_by_score(batch_size=4)] == ['-5-0', '-5-1', '-5-2', '0-0']
+    assert [r.key_ for r in get_db.pop_by_score(batch_size=4, score=2)] == ['2-0', '2-1', '2-2']
+    assert get_db.pop_by_score(score=2) is None
+    assert get_db.count_by_score() == {0: 2}
+    get_db.drop_table()
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_pop_batch_and_restore():
+    get_db = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:'}, 'test_restore', 'queue')
+    get_db.push_many([{'key_': str(i), 'score': i} for i in range(4)])
+    result = get_db.pop_by_score(batch_size=3)
+    assert [r.key_ for r in result] == ['0', '1', '2']
+    assert len(get_db) == 1
+    assert get_db.pop(batch_size=3, timeout=0)[0].key_ == '3'
+    assert get_db.pop(batch_size=3) == []
+
+    get_db.restore(*result)
+    assert len(get_db) == 3
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_concurrent_claim(tmp_path):
+    get_db = DBModel.build_model_from_settings({'DB_URL': f'sqlite:///{tmp_path}/queue.db'}, 'test_claim', 'queue')
+    get_db.push_many([{'key_': str(i)} for i in range(200)])
+    claimed = []
+
+    def worker():
+        while True:
+            rows = get_db.pop(batch_size=3)
+            if not rows:
+                break
+            claimed.extend(r.key_ for r in rows)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(claimed, key=int) == [str(i) for i in range(200)]
+    assert len(get_db) == 0
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_lease():
+    get_db = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:'}, 'test_lease', 'queue',
+                                               fields=_lease_fields, lease_time=10, worker_id='w1', max_attempts=2)
+    get_db.push_many([{'key_': str(i)} for i in range(3)])
+    first, second = get_db.pop(desc=False, batch_size=2)
+    assert len(get_db) == 1
+    leased = get_db.db.get_by_id(first.id)
+    assert leased.worker == 'w1'
+    assert leased.attempts == 1
+    assert not leased.deleted
+
+    get_db.ack(first.id)
+    assert get_db.db.get_by_id(first.id).deleted
+
+    # nothing has expired yet
+    assert get_db.requeue_expired() == 0
+    with mock.patch('scrapy_db.db.time.time', return_value=time.time() + 11):
+        assert get_db.requeue_expired() == 1
+    assert len(get_db) == 2
+    assert get_db.pop(desc=False).id == second.id
+    with mock.patch('scrapy_db.db.time.time', return_value=time.time() + 11):
+        # the second lease expires, the row is dropped after max_attempts
+        assert get_db.requeue_expired() == 0
+    assert get_db.db.get_by_id(second.id).deleted
+
+    third = get_db.pop()
+    get_db.restore(third)
+    assert get_db.db.get_by_id(third.id).attempts == 0
+    assert len(get_db) == 1
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_retention():
+    with pytest.raises(ValueError):
+        DBModel(retention='archive')
+
+    get_db = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:', 'DB_RETENTION': 'delete'},
+                                               'test_retention_delete', 'queue')
+    get_db.push_many([{'key_': str(i)} for i in range(3)])
+    rows = get_db.pop(desc=False, batch_size=2)
+    assert get_db.db.select().count() == 1
+    get_db.restore(*rows)
+    assert [r.id for r in get_db.db.select().order_by(get_db.db.id)] == [1, 2, 3]
+    assert get_db.fetch_data(3)
+    assert get_db.db.select().count() == 0
+
+    get_db = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:', 'DB_RETENTION': 'compact',
+                                                'DB_COMPACT_INTERVAL': 60, 'DB_COMPACT_CHUNK_SIZE': 2},
+                                               'test_retention_compact', 'queue')
+    get_db.compact = mock.Mock(wraps=get_db.compact)
+    get_db.push_many([{'key_': str(i)} for i in range(6)])
+    get_db.pop()
+    assert get_db.compact.call_count == 1
+    assert get_db.db.select().count() == 5
+    get_db.pop(batch_size=4)
+    assert get_db.compact.call_count == 1
+    assert get_db.db.select().count() == 5
+    assert get_db.compact() == 4
+    assert get_db.db.select().count() == 1
+
+    # a compaction run by a pop deletes at most DB_COMPACT_MAX_CHUNKS chunks
+    get_db = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:', 'DB_RETENTION': 'compact',
+                                                'DB_COMPACT_INTERVAL': 0, 'DB_COMPACT_CHUNK_SIZE': 2,
+                                                'DB_COMPACT_MAX_CHUNKS': 2}, 'test_retention_compact_chunks',
+                                               'queue')
+    get_db.push_many([{'key_': str(i)} for i in range(10)])
+    get_db.db.update(deleted=1).where(get_db.db.id <= 8).execute()
+    get_db.pop()
+    assert get_db.db.select().count() == 6
+    get_db.pop()
+    assert get_db.db.select().count() == 2
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_indexes(tmp_path):
+    settings = {'DB_URL': f'sqlite:///{tmp_path}/index.db'}
+    get_db = DBModel.build_model_from_settings(settings, 'test_index', 'queue')
+    database = get_db.db._meta.database
+    names = {i.name: i.columns for i in database.get_indexes('test_index')}
+    assert ['deleted', 'score', 'id'] in names.values()
+    assert ['deleted', 'id'] in names.values()
+    plan = database.execute_sql('EXPLAIN QUERY PLAN ' + get_db.db.select().where(get_db.db.deleted == 0).order_by(
+        get_db.db.id).limit(1).sql()[0].replace('?', '0')).fetchall()
+    assert 'test_indexmodel_deleted_id' in str(plan)
+
+    # databases without CREATE INDEX IF NOT EXISTS get the missing indexes of existing tables
+    database.execute_sql('DROP INDEX test_indexmodel_deleted_id')
+    with mock.patch('peewee.SqliteDatabase.safe_create_index', False):
+        DBModel.build_model_from_settings(settings, 'test_index', 'queue')
+        DBModel.build_model_from_settings(settings, 'test_index', 'queue')
+    assert {i.name for i in database.get_indexes('test_index')} == set(names)
+
+    # the score index of earlier versions, covered by (deleted, score, id), is dropped
+    assert ['score'] not in names.values()
+    database.execute_sql('CREATE INDEX test_indexmodel_score ON test_index (score)')
+    DBModel.build_model_from_settings(settings, 'test_index', 'queue')
+    assert {i.name for i in database.get_indexes('test_index')} == set(names)
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_unique_index_upgrade(tmp_path):
+    settings = {'DB_URL': f'sqlite:///{tmp_path}/upgrade.db'}
+    get_db = DBModel.build_model_from_settings(settings, 'test_upgrade', 'dupelifter')
+    database = get_db.db._meta.database
+    assert {i.name: i.unique for i in database.get_indexes('test_upgrade')} == {'test_upgrade_key__idx': False}
+    # the unique index is added to the table
+    get_db = DBModel.build_model_from_settings(settings, 'test_upgrade', 'dupelifter_unique')
+    assert {i.name: i.unique for i in database.get_indexes('test_upgrade')} == {
+        'test_upgrade_key__idx': False, 'test_upgrademodel_key_': True}
+    assert get_db.push_unique(key_='abc') is True
+    assert get_db.push_unique(key_='abc') is False
+
+    # a non unique index with the name of the unique one, created by an earlier version, is not replaced
+    database.execute_sql('DROP INDEX test_upgrademodel_key_')
+    database.execute_sql('CREATE INDEX test_upgrademodel_key_ ON test_upgrade (key_)')
+    with pytest.raises(RuntimeError) as e:
+        DBModel.build_model_from_settings(settings, 'test_upgrade', 'dupelifter_unique')
+    assert 'no unique index on key_' in str(e.value)
+
+
+def test_wait_for_push(mocker):
+    database = mock.MagicMock(spec=PostgresqlDatabase)
+    connection = database.connection.return_value
+    connection.notifies = []
+    model = mock.Mock()
+    model._meta.database = database
+    model._meta.table_name = 'test_notify'
+    get_db = DBModel(model, notify=True)
+    select_ = mocker.patch('scrapy_db.db.select.select')
+    connection.poll.side_effect = lambda: connection.notifies.append('test_notify')
+
+    get_db.wait_for_push(1)
+    get_db.wait_for_push(1)
+    database.execute_sql.assert_called_once_with('LISTEN "test_notify"')
+    select_.assert_called_with([connection], [], [], 1)
+    assert select_.call_count == 2
+    assert connection.notifies == []
+
+    get_db.push(**{'key_': 'aaa'})
+    database.execute_sql.assert_called_with('NOTIFY "test_notify"')
+    get_db.push_many([{'key_': 'bbb'}])
+    assert database.execute_sql.call_count == 3
+
+    sleep = mocker.patch('scrapy_db.db.time.sleep')
+    get_db.notify = False
+    get_db.wait_for_push(0.5)
+    sleep.assert_called_with(0.5)
+    assert select_.call_count == 2
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_shared_database(tmp_path):
+    with mock.patch('scrapy_db.db._databases', {}):
+        settings = {'DB_URL': f'sqlite:///{tmp_path}/shared.db', 'DB_POOL_MAX_CONNECTIONS': 2, 'DB_POOL_TIMEOUT': 1}
+        queue = DBModel.build_model_from_settings(settings, 'test_shared_queue', 'queue')
+        dupefilter = DBModel.build_model_from_settings(settings, 'test_shared_dupefilter', 'dupelifter')
+        database = queue.db._meta.database
+        assert dupefilter.db._meta.database is database
+        assert isinstance(database, PooledDatabase)
+        assert database._max_connections == 2
+
+        # every unit of work checks a connection out and returns it to the pool
+        checkouts = pool_stats()['checkouts']
+        queue.push(key_='test')
+        stats = pool_stats()
+        assert stats['checkouts'] == checkouts + 1
+        assert stats['in_use'] == 0
+        assert stats['idle'] == 1
+        # a connection held by the thread is used by the units of work, and returned by close_databases
+        database.connect()
+        assert queue.pop().key_ == 'test'
+        assert pool_stats()['checkouts'] == checkouts + 2
+        assert pool_stats()['in_use'] == 1
+        close_databases()
+        assert pool_stats()['in_use'] == 0
+
+        # the threads using the models do not keep a connection each
+        threads = [threading.Thread(target=queue.push, kwargs={'key_': str(i)}) for i in range(4)]
+        for t in threads:
+            t.start()
+            t.join()
+        assert len(queue) == 4
+        assert pool_stats()['in_use'] == 0
+
+        assert not isinstance(get_database({'DB_URL': 'sqlite:///:memory:'}), PooledDatabase)
+        assert not isinstance(get_database({'DB_URL': f'sqlite:///{tmp_path}/plain.db', 'DB_POOL': False}),
+                              PooledDatabase)
+        mysql = get_database({'DB_URL': 'mysql://root@localhost/test'})
+        assert all(isinstance(mysql, c) for c in (MySQLDatabase, PooledDatabase, ReconnectMixin))
@@ -7,7 +7,10 @@ from scrapy.http import Request
 from scrapy.settings import Settings
 
 from scrapy_db.db import DBModel
-from scrapy_db.dupefilter import DBDupeFilter
+from scrapy_db.dupefilter import DBDupeFilter, DBBloomDupeFilter, DBShardedDupeFilter, \
+    DBPartitionedDupeFilter
+from scrapy_db.utils import BoundedCache
+from tests.conftest import _attributes
 
 
 @pytest.fixture(autouse=True)
@@ -106,3 +109,159 @@ def test_from_settings(settings, get_dupelifter_db):
         assert_dupefilter(df)
 
         assert f.called
+
+
+def test_unique_dupefilter(get_dupelifter_unique_db):
+    df = DBDupeFilter(get_dupelifter_unique_db, unique=True)
+    count = get_dupelifter_unique_db.db.select().count()
+    req = Request('https://example.com/unique')
+    assert not df.request_seen(req)
+    assert df.request_seen(req)
+    assert not df.request_seen(Request('https://example.com/unique', method='POST'))
+    assert get_dupelifter_unique_db.db.select().count() == count + 2
+
+
+def test_from_settings_unique(settings):
+    settings.set('SCHEDULER_DUPEFILTER_UNIQUE', True)
+    with mock.patch('scrapy_db.db.DBModel.build_model_from_settings') as f:
+        spider = mock.Mock()
+        spider.settings = settings
+        df = DBDupeFilter.from_spider(spider)
+        assert df.unique
+        assert f.call_args[0][2] == 'dupelifter_unique'
+
+        df = DBDupeFilter.from_settings(settings)
+        assert df.unique
+
+
+def test_cached_dupefilter(get_dupelifter_unique_db):
+    stats = mock.Mock()
+    df = DBDupeFilter(get_dupelifter_unique_db, unique=True, cache=BoundedCache(10), stats=stats)
+    df._fingerprint_seen = mock.Mock(wraps=df._fingerprint_seen)
+    req = Request('https://example.com/cached')
+    assert not df.request_seen(req)
+    assert df.request_seen(req)
+    assert df.request_seen(req)
+    assert df._fingerprint_seen.call_count == 1
+    stats.inc_value.assert_any_call('dupefilter/cache/miss')
+    stats.inc_value.assert_called_with('dupefilter/cache/hit')
+    assert stats.inc_value.call_count == 3
+
+    # the table stays the source of truth once the cache forgets a fingerprint
+    df.cache.clear()
+    assert df.request_seen(req)
+    assert df._fingerprint_seen.call_count == 2
+
+
+def test_cache_from_settings(settings):
+    settings.setdict({'SCHEDULER_DUPEFILTER_CACHE_SIZE': 5, 'SCHEDULER_DUPEFILTER_CACHE_POLICY': 'fifo'})
+    with mock.patch('scrapy_db.db.DBModel.build_model_from_settings'):
+        spider = mock.Mock()
+        spider.settings = settings
+        df = DBDupeFilter.from_spider(spider)
+        assert df.cache.size == 5
+        assert df.cache.policy == 'fifo'
+        assert df.stats is spider.crawler.stats
+
+        settings.set('SCHEDULER_DUPEFILTER_CACHE_SIZE', 0)
+        assert DBDupeFilter.from_settings(settings).cache is None
+
+
+def test_bloom_dupefilter(get_bloom_db):
+    df = DBBloomDupeFilter(get_bloom_db, capacity=10, error_rate=0.01, chunk_size=8)
+    assert df._filter is None
+    requests = [Request(f'https://example.com/{i}') for i in range(30)]
+    assert not any(df.request_seen(r) for r in requests)
+    assert all(df.request_seen(r) for r in requests)
+    assert get_bloom_db.db.select().count() == 0
+
+    df.close()
+    assert get_bloom_db.db.select().where(get_bloom_db.db.chunk == -1).count() == len(df.filter.slices) == 2
+    assert not any(s.dirty for s in df.filter.slices)
+
+    # a new filter on the same table loads the checkpoint lazily
+    resumed = DBBloomDupeFilter(get_bloom_db, capacity=10, error_rate=0.01, chunk_size=8)
+    assert all(resumed.request_seen(r) for r in requests)
+    assert not resumed.request_seen(Request('https://example.com/new'))
+    assert len(resumed.filter) == 31
+    resumed.checkpoint()
+    assert DBBloomDupeFilter(get_bloom_db, capacity=10, error_rate=0.01, chunk_size=8).request_seen(
+        Request('https://example.com/new'))
+
+    resumed.clear()
+    assert len(resumed.filter) == 0
+    resumed.checkpoint()
+    assert get_bloom_db.db.select().count() == 0
+
+
+def test_bloom_from_settings(settings):
+    settings.setdict({
+        'SCHEDULER_DUPEFILTER_BLOOM_CAPACITY': 50,
+        'SCHEDULER_DUPEFILTER_BLOOM_ERROR_RATE': 0.1,
+        'SCHEDULER_DUPEFILTER_BLOOM_CHUNK_SIZE': 4,
+    })
+    with mock.patch('scrapy_db.db.DBModel.build_model_from_settings') as f:
+        spider = mock.Mock()
+        spider.name = 'foo'
+        spider.settings = settings
+        df = DBBloomDupeFilter.from_spider(spider)
+        assert (df.capacity, df.error_rate, df.chunk_size) == (50, 0.1, 4)
+        assert df.stats is spider.crawler.stats
+        f.assert_called_with(settings, 'foo_dupefilter_bloom', 'bloom')
+
+        df = DBBloomDupeFilter.from_crawler(mock.Mock(settings=settings))
+        assert df.debug
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_sharded_dupefilter(tmp_path):
+    spider = mock.Mock()
+    spider.name = 'test'
+    spider.crawler = None
+    spider.settings = Settings({'DB_URL': 'sqlite:///:memory:', 'SCHEDULER_SHARD_TABLES': 2,
+                                'SCHEDULER_SHARD_URLS': [f'sqlite:///{tmp_path}/shard{i}.db' for i in range(2)]})
+    df = DBShardedDupeFilter.from_spider(spider)
+    assert len(df.tables) == 4
+    requests = [Request(f'https://example.com/{i}') for i in range(20)]
+    for request in requests[:10]:
+        assert not df.request_seen(request)
+        assert df.request_seen(request)
+    assert df.filter_seen(requests) == requests[10:]
+    assert sum(table.db.select().count() for table in df.tables) == 20
+    assert sum(1 for table in df.tables if table.db.select().count()) > 1
+    df.clear()
+    assert not any(table.db.table_exists() for table in df.tables)
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+@pytest.mark.parametrize('shards', [1, 2])
+def test_partitioned_dupefilter(shards):
+    spider = mock.Mock()
+    spider.name = f'test_{shards}'
+    spider.crawler = None
+    spider.settings = Settings({'DB_URL': 'sqlite:///:memory:', 'SCHEDULER_DUPEFILTER_PARTITIONS': 4,
+                                'SCHEDULER_SHARD_TABLES': shards})
+    df = DBPartitionedDupeFilter.from_spider(spider)
+    names = [table.db._meta.table_name for table in df.tables]
+    if shards == 1:
+        assert names == [f'test_1_dupefilter_p{i}' for i in range(4)]
+    else:
+        assert names == [f'test_2_dupefilter_{s}_p{i}' for s in range(2) for i in range(4)]
+    requests = [Request(f'https://example.com/{i}') for i in range(40)]
+    assert df.filter_seen(requests[:20]) == requests[:20]
+    for request in requests[20:]:
+        assert not df.request_seen(request)
+        assert df.request_seen(request)
+    for i, table in enumerate(df.tables):
+        # each partition holds a range of prefixes
+        for row in table.db.select():
+            assert int(row.key_[:4], 16) * 4 >> 16 == i % 4
+    assert sum(table.db.select().count() for table in df.tables) == 40
+    df.clear()
+    assert not any(table.db.table_exists() for table in df.tables)
+
+
+def test_partitions_from_settings():
+    with pytest.raises(ValueError):
+        DBPartitionedDupeFilter._partitions(Settings({'SCHEDULER_DUPEFILTER_PARTITIONS': 0}))
+    assert DBPartitionedDupeFilter._partitions(Settings()) == 16
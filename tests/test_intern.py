@@ -0,0 +1,114 @@
+import time
+from unittest import mock
+
+import pytest
+from scrapy import Request
+
+from scrapy_db.db import DBModel
+from scrapy_db.intern import Interner, INTERN_KEY, FragmentNotFound
+from scrapy_db.queue import FifoQueue
+from tests.conftest import _attributes
+from tests.test_queue import get_spider
+
+headers = {'User-Agent': 'Mozilla/5.0 ' * 10, 'Accept-Language': 'en'}
+meta = {'depth': 1, 'proxy_config': {'url': 'http://proxy.example.com:8080', 'user': 'test' * 20}}
+
+
+@pytest.fixture()
+def interner():
+    with mock.patch('scrapy_db.db._attributes', _attributes):
+        table = DBModel.build_model_from_settings({'DB_URL': 'sqlite:///:memory:'}, 'test_fragments', 'fragment')
+    yield Interner(table, cache_size=10)
+    table.drop_table()
+
+
+def test_interner(interner):
+    obj = Request(url='https://example.com/1', headers=headers, meta=meta).to_dict()
+    result = interner.intern(dict(obj))
+    assert 'headers' not in result
+    assert result['meta'] == {'depth': 1}
+    assert set(result[INTERN_KEY]) == {'headers', 'meta'}
+    assert set(result[INTERN_KEY]['meta']) == {'proxy_config'}
+    refs = result[INTERN_KEY]
+
+    other = interner.intern(Request(url='https://example.com/2', headers=headers, meta=meta).to_dict())
+    assert other[INTERN_KEY] == result[INTERN_KEY]
+    assert interner.table.db.select().count() == 2
+
+    interner.cache.clear()
+    restored = interner.restore(result)
+    assert restored == obj
+    restored['meta']['proxy_config']['user'] = 'changed'
+    assert interner.restore(other)['meta']['proxy_config'] == meta['proxy_config']
+
+    small = {'url': 'https://example.com', 'headers': {b'A': [b'b']}, 'meta': {}}
+    assert interner.intern(dict(small)) == small
+
+    interner.clear()
+    interner.cache.clear()
+    with pytest.raises(FragmentNotFound) as e:
+        interner.restore({'url': 'https://example.com', INTERN_KEY: refs})
+    assert 'not found in test_fragments' in str(e.value)
+
+
+def test_collect(interner):
+    interner.gc_interval = 60
+    used = interner.intern(Request(url='https://example.com/1', headers=headers).to_dict())
+    unused = interner.intern(Request(url='https://example.com/2', meta=meta).to_dict())
+    referenced = set(Interner.references(used))
+    assert referenced == {used[INTERN_KEY]['headers']}
+    assert set(Interner.references(unused)) == {unused[INTERN_KEY]['meta']['proxy_config']}
+    # recently used fragments are kept, the requests being pushed may use them
+    assert interner.collect(referenced, time.time()) == 0
+    assert interner.collect(referenced, time.time() + 61) == 1
+    assert [r.hash_ for r in interner.table.db.select()] == list(referenced)
+
+    # a cached fragment is used again after half the interval, and stored again if it was collected
+    key = unused[INTERN_KEY]['meta']['proxy_config']
+    interner.intern(Request(url='https://example.com/3', meta=meta).to_dict())
+    assert interner.table.db.select().count() == 1
+    with mock.patch('scrapy_db.intern.time.time', return_value=time.time() + 31):
+        interner.intern(Request(url='https://example.com/3', meta=meta).to_dict())
+    assert interner.table.db.get_or_none(interner.table.db.hash_ == key) is not None
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_queue_intern():
+    queue = FifoQueue(get_spider(SCHEDULER_INTERN=True, SCHEDULER_INTERN_CACHE_SIZE=5), 'test_intern_%(spider)s',
+                      'queue')
+    assert isinstance(queue.interner, Interner)
+    assert queue.interner.cache.size == 5
+    for i in range(3):
+        queue.push(Request(url=f'https://example.com/{i}', headers=headers, meta=meta))
+    assert queue.interner.table.db.select().count() == 2
+    for i in range(3):
+        request = queue.pop()
+        assert request.url == f'https://example.com/{i}'
+        assert request.headers['User-Agent'] == headers['User-Agent'].encode()
+        assert request.meta['proxy_config'] == meta['proxy_config']
+    queue.clear()
+    assert queue.interner.table.db.select().count() == 0
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_queue_collect_fragments(caplog):
+    queue = FifoQueue(get_spider(SCHEDULER_INTERN=True, SCHEDULER_INTERN_GC_INTERVAL=60, SCHEDULER_POP_BATCH_SIZE=2),
+                      'test_intern_gc_%(spider)s', 'queue')
+    queue.push(Request(url='https://example.com/0', meta=meta))
+    queue.push(Request(url='https://example.com/1', headers=headers))
+    queue.push(Request(url='https://example.com/2'))
+    assert queue.pop().url == 'https://example.com/0'
+    with mock.patch('scrapy_db.queue.time.time', return_value=time.time() + 61), \
+            mock.patch('scrapy_db.intern.time.time', return_value=time.time() + 61):
+        # the meta fragment is only referenced by the popped request
+        assert queue.collect_fragments() == 1
+    assert queue.interner.table.db.select().count() == 1
+
+    # a request whose fragments are missing is dropped, the next one is popped
+    queue.interner.table.db.delete().execute()
+    queue.interner.cache.clear()
+    queue.close()
+    assert queue.pop().url == 'https://example.com/2'
+    assert 'Dropped the request of row 2 of test_intern_gc_test' in caplog.text
+    assert queue.pop() is None
+    queue.clear()
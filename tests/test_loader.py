@@ -0,0 +1,85 @@
+import io
+from unittest import mock
+
+import pytest
+from scrapy import Request, Spider
+from scrapy.settings import Settings
+
+from scrapy_db.db import DBModel
+from scrapy_db.dupefilter import DBDupeFilter
+from scrapy_db.loader import load_start_urls, load_requests, request_from_line
+from scrapy_db.queue import FifoQueue
+from tests.conftest import _attributes
+from tests.test_queue import get_spider
+
+
+class SeedSpider(Spider):
+    name = 'seed'
+
+    def parse_item(self, response):
+        pass
+
+
+def get_settings(tmp_path, **kwargs):
+    return Settings({'DB_URL': f'sqlite:///{tmp_path}/seed.db', **kwargs})
+
+
+def test_request_from_line():
+    assert request_from_line('https://example.com').url == 'https://example.com'
+    request = request_from_line('{"url": "https://example.com", "method": "POST", "priority": 5}')
+    assert request.method == 'POST'
+    assert request.priority == 5
+
+    spider = SeedSpider()
+    request = request_from_line('{"url": "https://example.com", "callback": "parse_item", "errback": "parse"}', spider)
+    assert request.callback == spider.parse_item
+    assert request.errback == spider.parse
+    with pytest.raises(ValueError) as e:
+        request_from_line('{"url": "https://example.com", "callback": "parse_missing"}', spider)
+    assert 'parse_missing' in str(e.value)
+    with pytest.raises(ValueError):
+        request_from_line('{"url": "https://example.com", "callback": "parse_item"}')
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_load_start_urls(tmp_path):
+    progress = mock.Mock()
+    lines = io.StringIO(''.join(f'https://example.com/{i}\n' for i in range(25)) + '\n')
+    settings = get_settings(tmp_path)
+    assert load_start_urls(lines, settings, 'test', chunk_size=10, progress=progress) == 25
+    assert [c.args[0] for c in progress.call_args_list] == [10, 20, 25]
+    db = DBModel.build_model_from_settings(settings, 'test_start_urls', 'start_url')
+    assert [r.start_url for r in db.fetch_data(3, after=0)] == [f'https://example.com/{i}' for i in range(3)]
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_load_requests(tmp_path):
+    settings = get_settings(tmp_path, SCHEDULER_QUEUE_CLASS='scrapy_db.queue.FifoQueue',
+                            SCHEDULER_DUPEFILTER_UNIQUE=True)
+    lines = ['https://example.com/0', 'https://example.com/1', 'https://example.com/0',
+             '{"url": "https://example.com/0", "dont_filter": true}']
+    assert load_requests(lines, settings, 'test', chunk_size=3) == 3
+    assert load_requests(['https://example.com/1', 'https://example.com/2'], settings, 'test') == 1
+
+    spider = get_spider()
+    spider.settings = settings
+    queue = FifoQueue(spider, 'test_requests', 'queue')
+    assert [queue.pop().url for _ in range(4)] == [f'https://example.com/{i}' for i in (0, 1, 0, 2)]
+    assert queue.pop() is None
+    dupefilter = DBDupeFilter.from_spider(spider)
+    assert dupefilter.request_seen(Request('https://example.com/2'))
+    assert not dupefilter.request_seen(Request('https://example.com/3'))
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_load_requests_callback(tmp_path):
+    settings = get_settings(tmp_path, SCHEDULER_QUEUE_CLASS='scrapy_db.queue.FifoQueue',
+                            SPIDER_MODULES=['tests.test_loader'])
+    assert load_requests(['{"url": "https://example.com/0", "callback": "parse_item"}'], settings, 'seed') == 1
+
+    # the request is served with the method of the spider of the crawl
+    spider = SeedSpider()
+    spider.settings = settings
+    request = FifoQueue(spider, 'seed_requests', 'queue').pop()
+    assert request.url == 'https://example.com/0'
+    assert request.callback == spider.parse_item
@@ -1,25 +1,41 @@
+import time
 from unittest import mock
 
 import pytest
 from scrapy import Request
+from scrapy.settings import Settings
+from scrapy.utils.httpobj import urlparse_cached
 
-from scrapy_db.queue import Base, FifoQueue, PriorityQueue, LifoQueue
+from scrapy_db.db import DBModel
+from scrapy_db.queue import Base, FifoQueue, PriorityQueue, LifoQueue, LEASE_META_KEY, BucketPriorityQueue, \
+    DownloaderAwarePriorityQueue, ShardedQueue, SHARD_META_KEY
+from scrapy_db.utils import BinaryPickle
+from tests.conftest import _attributes
+
+
+def get_spider(**settings):
+    spider = mock.Mock()
+    spider.name = 'test'
+    spider.settings = Settings({'DB_URL': 'sqlite:///:memory:', **settings})
+    return spider
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def get_queue(q, **settings):
+    return q(get_spider(**settings), 'test_%(spider)s', 'queue')
 
 
 @mock.patch('scrapy_db.queue.DBModel')
-@mock.patch('scrapy_db.queue.len')
 @pytest.mark.parametrize('q', [
     Base,
     FifoQueue,
     PriorityQueue,
     LifoQueue,
 ])
-def test_fifo_queue(db, len_, q):
-    spider = mock.Mock()
-    spider.name = 'test'
-    spider.settings = mock.Mock()
+def test_fifo_queue(model, q):
+    spider = get_spider()
     queue = q(spider, 'test', 'queue')
-    queue.db = db
+    queue.db = mock.MagicMock()
     queue._encode_request = mock.Mock(wraps=queue._encode_request)
     queue._decode_request = mock.Mock(wraps=queue._decode_request)
 
@@ -60,7 +76,7 @@ def test_fifo_queue(db, len_, q):
 
     # test len
     queue.push(request)
-    len_.return_value = 1
+    queue.db.__len__.return_value = 1
     assert len(queue) == 1
 
     # test pop
@@ -70,8 +86,317 @@ def test_fifo_queue(db, len_, q):
     else:
         r = mock.Mock()
         r.key_ = encode_request
-        queue.db.pop_by_score.return_value = r
-        queue.db.pop.return_value = r
+        queue.db.pop_by_score.return_value = [r]
+        queue.db.pop.return_value = [r]
         result = queue.pop()
         assert result.url == decode_request.url
         assert result.meta == decode_request.meta
+
+
+@pytest.mark.parametrize('q', [
+    FifoQueue,
+    PriorityQueue,
+    LifoQueue,
+])
+def test_push_batch(q):
+    queue = get_queue(q, SCHEDULER_PUSH_BATCH_SIZE=3, SCHEDULER_PUSH_FLUSH_INTERVAL=60)
+    queue.db.push_many = mock.Mock(wraps=queue.db.push_many)
+    queue.push(Request('https://example.com/1'))
+    queue.push(Request('https://example.com/2'))
+    assert queue.db.db.select().count() == 0
+    assert len(queue) == 2
+
+    # a pop that would find the table empty inserts the buffer first
+    assert queue.pop().url.startswith('https://example.com/')
+    assert queue.db.push_many.call_count == 1
+    assert len(queue) == 1
+
+    for i in range(3):
+        queue.push(Request(f'https://example.com/{i + 3}'))
+    assert queue.db.push_many.call_count == 2
+    assert len(queue) == 4
+
+    queue.push(Request('https://example.com/6'))
+    queue.close()
+    assert queue.db.push_many.call_count == 3
+    assert queue.db.db.select().where(queue.db.db.deleted == 0).count() == 5
+
+    queue.push_flush_interval = 0
+    queue.push(Request('https://example.com/7'))
+    assert queue.db.push_many.call_count == 4
+    queue.clear()
+
+
+@pytest.mark.parametrize('q, order', [
+    (FifoQueue, [0, 1, 2, 3, 4]),
+    (PriorityQueue, [0, 1, 2, 3, 4]),
+    (BucketPriorityQueue, [0, 1, 2, 3, 4]),
+    (LifoQueue, [4, 3, 2, 1, 0]),
+])
+def test_pop_batch(q, order):
+    queue = get_queue(q, SCHEDULER_POP_BATCH_SIZE=3)
+    for i in range(5):
+        queue.push(Request(f'https://example.com/{i}'))
+    queue.db.pop = mock.Mock(wraps=queue.db.pop)
+    queue.db.pop_by_score = mock.Mock(wraps=queue.db.pop_by_score)
+
+    first = queue.pop()
+    assert queue.db.pop.call_count + queue.db.pop_by_score.call_count == 1
+    assert len(queue.db) == 2
+    assert len(queue) == 4
+    second = queue.pop()
+    assert queue.db.pop.call_count + queue.db.pop_by_score.call_count == 1
+
+    # claimed but unserved requests go back to the table on close
+    queue.close()
+    assert len(queue.db) == 3
+    urls = [first.url, second.url] + [queue.pop().url for _ in range(3)]
+    assert urls == [f'https://example.com/{i}' for i in order]
+    assert queue.pop() is None
+    queue.clear()
+
+
+def test_close_after_compaction():
+    queue = get_queue(FifoQueue, SCHEDULER_POP_BATCH_SIZE=5, DB_RETENTION='compact', DB_COMPACT_INTERVAL=0)
+    for i in range(10):
+        queue.push(Request(f'https://example.com/{i}'))
+    # the compaction run by the pop deletes the claimed rows, the unserved ones are inserted again on close
+    assert queue.pop().url == 'https://example.com/0'
+    assert queue.db.db.select().count() == 5
+    queue.close()
+    assert len(queue.db) == 9
+    assert [queue.pop().url for _ in range(9)] == [f'https://example.com/{i}' for i in range(1, 10)]
+    assert queue.pop() is None
+    queue.clear()
+
+
+@pytest.mark.parametrize('q', [
+    FifoQueue,
+    PriorityQueue,
+    LifoQueue,
+])
+def test_lease(q):
+    queue = get_queue(q, SCHEDULER_LEASE_TIME=30, SCHEDULER_WORKER_ID='worker')
+    assert queue.db.worker_id == 'worker'
+    queue.db.requeue_expired = mock.Mock(wraps=queue.db.requeue_expired)
+    queue.push(Request('https://example.com/1'))
+    queue.push(Request('https://example.com/2'))
+
+    request = queue.pop()
+    assert queue.db.requeue_expired.call_count == 1
+    lease_id = request.meta[LEASE_META_KEY]
+    assert len(queue) == 1
+    assert not queue.db.db.get_by_id(lease_id).deleted
+
+    queue.ack(request)
+    assert LEASE_META_KEY not in request.meta
+    assert queue.db.db.get_by_id(lease_id).deleted
+
+    # a leased request pushed again is acknowledged and stored in a new row
+    retry = queue.pop()
+    lease_id = retry.meta[LEASE_META_KEY]
+    queue.push(retry.replace(dont_filter=True))
+    assert queue.db.db.get_by_id(lease_id).deleted
+    assert queue.pop().meta[LEASE_META_KEY] != lease_id
+    assert queue.db.requeue_expired.call_count == 1
+    queue.clear()
+
+
+def test_lease_redelivery():
+    queue = get_queue(FifoQueue, SCHEDULER_LEASE_TIME=30, SCHEDULER_LEASE_MAX_ATTEMPTS=2)
+    queue.push(Request('https://example.com/dropped'))
+    # dropped by a downloader middleware, the request is never acknowledged
+    for attempt in range(2):
+        request = queue.pop()
+        assert request.url == 'https://example.com/dropped'
+        assert queue.pop() is None
+        with mock.patch('time.time', return_value=time.time() + 60):
+            queue.db.requeue_expired()
+    # redelivered until SCHEDULER_LEASE_MAX_ATTEMPTS
+    assert queue.pop() is None
+    queue.clear()
+
+
+def test_pending_count():
+    queue = get_queue(FifoQueue, SCHEDULER_PENDING_SYNC_INTERVAL=60, SCHEDULER_POP_BATCH_SIZE=2)
+    queue.db.exists = mock.Mock(wraps=queue.db.exists)
+    with mock.patch.object(DBModel, '__len__', autospec=True, side_effect=DBModel.__len__) as count:
+        assert len(queue) == 0
+        assert not queue.has_pending()
+        assert queue.db.exists.call_count == 1
+        for i in range(3):
+            queue.push(Request(f'https://example.com/{i}'))
+        assert len(queue) == 3
+        assert queue.has_pending()
+        queue.pop()
+        assert len(queue) == 2
+        queue.close()
+        assert len(queue) == 2
+        assert count.call_count == 1
+        assert queue.db.exists.call_count == 1
+
+        queue.pending_sync_interval = 0
+        assert len(queue) == 2
+        assert count.call_count == 2
+        assert queue.has_pending()
+        assert queue.db.exists.call_count == 2
+    queue.clear()
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_binary_serializer():
+    queue = FifoQueue(get_spider(), 'test_binary_%(spider)s', 'queue', serializer=BinaryPickle)
+    assert queue.db.db.key_.field_type == 'BLOB'
+    request = Request(url='https://example.com', method='POST', body=b'\xff' * 20000)
+    queue.push(request)
+    assert queue.pop().body == request.body
+
+
+@pytest.mark.parametrize('q', [PriorityQueue, BucketPriorityQueue])
+def test_priority_order(q):
+    queue = get_queue(q)
+    for i in range(3):
+        for priority in (0, 10, -5):
+            queue.push(Request(f'https://example.com/{priority}/{i}', priority=priority))
+    urls = [queue.pop().url for _ in range(9)]
+    assert urls == [f'https://example.com/{priority}/{i}' for priority in (10, 0, -5) for i in range(3)]
+    assert queue.pop() is None
+    queue.clear()
+
+
+def test_bucket_priority_queue():
+    queue = get_queue(BucketPriorityQueue, SCHEDULER_PENDING_SYNC_INTERVAL=60)
+    queue.push(Request('https://example.com/0'))
+    queue.db.count_by_score = mock.Mock(wraps=queue.db.count_by_score)
+    queue.db.pop_by_score = mock.Mock(wraps=queue.db.pop_by_score)
+    assert queue.pop().url == 'https://example.com/0'
+    assert queue.db.count_by_score.call_count == 1
+    assert queue._buckets == {}
+
+    queue.push(Request('https://example.com/1', priority=1))
+    queue.push(Request('https://example.com/2', priority=2))
+    assert queue._buckets == {-1: 1, -2: 1}
+    # pushed by another process
+    queue.db.push(key_=queue._encode_request(Request('https://example.com/3', priority=3)), score=-3)
+    assert queue.pop().url == 'https://example.com/2'
+    assert queue.pop().url == 'https://example.com/1'
+    assert queue.db.count_by_score.call_count == 1
+    assert queue.pop().url == 'https://example.com/3'
+    assert queue.db.count_by_score.call_count == 2
+    # emptied buckets are never probed
+    assert queue.db.pop_by_score.call_count == 4
+    assert queue.pop() is None
+    assert queue.db.count_by_score.call_count == 3
+    queue.clear()
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_downloader_aware_queue():
+    spider = get_spider()
+    downloader = spider.crawler.engine.downloader
+    downloader.get_slot_key.side_effect = lambda r: r.meta.get('download_slot') or urlparse_cached(r).hostname
+    downloader.slots = {}
+    queue = DownloaderAwarePriorityQueue(spider, 'test_slot_%(spider)s', 'queue')
+    for i in range(4):
+        queue.push(Request(f'https://big.example.com/{i}', priority=i))
+    queue.push(Request('https://a.example.com/0'))
+    queue.push(Request('https://b.example.com/0', meta={'download_slot': 'b'}))
+    assert queue.db.count_by_slot() == {'big.example.com': 4, 'a.example.com': 1, 'b': 1}
+
+    urls = [queue.pop().url for _ in range(3)]
+    assert urls == ['https://a.example.com/0', 'https://b.example.com/0', 'https://big.example.com/3']
+
+    # a full slot waits while another one has free capacity
+    queue.push(Request('https://a.example.com/1'))
+    downloader.slots = {'big.example.com': mock.Mock(active={1, 2}, concurrency=2),
+                        'a.example.com': mock.Mock(active=set(), concurrency=2)}
+    assert queue.pop().url == 'https://a.example.com/1'
+    # every slot busy, the least busy one is served
+    assert queue.pop().url == 'https://big.example.com/2'
+    assert queue._slots == {'big.example.com': 2}
+    assert queue._slot_order == ['big.example.com']
+
+    # the slots are kept in order as they are counted, not sorted on each pop
+    for slot in ('d', 'c', 'e'):
+        queue.push(Request(f'https://{slot}.example.com/0', meta={'download_slot': slot}))
+    assert queue._slot_order == ['big.example.com', 'c', 'd', 'e']
+    with mock.patch('scrapy_db.queue.sorted', create=True, side_effect=AssertionError):
+        assert queue.pop().url == 'https://c.example.com/0'
+        assert queue.pop().url == 'https://d.example.com/0'
+    assert queue._slot_order == ['big.example.com', 'e']
+    queue.close()
+    assert queue._slots is None
+    queue.clear()
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_downloader_aware_queue_without_engine():
+    spider = get_spider()
+    spider.crawler = None
+    queue = DownloaderAwarePriorityQueue(spider, 'test_slot_default_%(spider)s', 'queue')
+    queue.push(Request('https://example.com/0', meta={'download_slot': 'slot'}))
+    queue.push(Request('https://example.com/1'))
+    assert queue.db.count_by_slot() == {'slot': 1, 'example.com': 1}
+    assert queue.pop().url == 'https://example.com/1'
+    assert queue.pop().url == 'https://example.com/0'
+    assert queue.pop() is None
+    queue.clear()
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_sharded_queue():
+    spider = get_spider(SCHEDULER_SHARD_TABLES=3, SCHEDULER_PENDING_SYNC_INTERVAL=60, SCHEDULER_INTERN=True,
+                        SCHEDULER_INTERN_TABLE='test_shard_fragments_%(spider)s')
+    queue = ShardedQueue(spider, 'test_shard_%(spider)s', 'queue')
+    assert [shard.db.db._meta.table_name for shard in queue.shards] == [f'test_shard_test_{i}' for i in range(3)]
+    assert [shard.interner.table.db._meta.table_name for shard in queue.shards] == [
+        f'test_shard_fragments_test_{i}' for i in range(3)]
+    requests = [Request(f'https://example.com/{i}') for i in range(12)]
+    for request in requests:
+        queue.push(request)
+    assert len(queue) == 12
+    assert sum(1 for shard in queue.shards if len(shard)) > 1
+    # a request always goes to the same shard
+    for request in requests:
+        assert len(queue.shards[queue._shard_index(request)]) > 0
+        assert queue._shard_index(request) == queue._shard_index(request.copy())
+
+    urls = {queue.pop().url for _ in range(12)}
+    assert urls == {r.url for r in requests}
+    assert queue.pop() is None
+    assert set(queue._empty) == {0, 1, 2}
+    # a shard found empty is not queried again until this process pushes to it
+    queue.shards[0].db.push(key_=queue.shards[0]._encode_request(Request('https://example.com/other')))
+    assert queue.pop() is None
+    assert queue.has_pending()
+    assert queue.pop().url == 'https://example.com/other'
+    queue.clear()
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_sharded_queue_by_domain(tmp_path):
+    urls = [f'sqlite:///{tmp_path}/shard{i}.db' for i in range(2)]
+    spider = get_spider(SCHEDULER_SHARD_URLS=urls, SCHEDULER_SHARD_KEY='domain', SCHEDULER_LEASE_TIME=60,
+                        SCHEDULER_SHARD_QUEUE_CLASS='scrapy_db.queue.FifoQueue')
+    queue = ShardedQueue(spider, 'test_shard_domain_%(spider)s', 'queue')
+    assert [shard.db.db._meta.database.database for shard in queue.shards] == [u[len('sqlite:///'):] for u in urls]
+    for host in ('a', 'b', 'c', 'd'):
+        for i in range(2):
+            queue.push(Request(f'https://{host}.example.com/{i}'))
+    # the requests of a host are in one shard
+    shards = {}
+    for i, shard in enumerate(queue.shards):
+        for row in shard.db.db.select():
+            shards.setdefault(urlparse_cached(shard._decode_request(row.key_)).hostname, set()).add(i)
+    assert len(shards) == 4
+    assert all(len(s) == 1 for s in shards.values())
+
+    request = queue.pop()
+    i = request.meta[SHARD_META_KEY]
+    queue.ack(request)
+    assert SHARD_META_KEY not in request.meta
+    assert queue.shards[i].db.db.select().where(queue.shards[i].db.db.deleted == 1).count() == 1
+
+    with pytest.raises(ValueError):
+        ShardedQueue(get_spider(SCHEDULER_SHARD_KEY='host'), 'test_shard_domain_%(spider)s', 'queue')
+    queue.clear()
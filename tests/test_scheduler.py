@@ -1,11 +1,20 @@
 import importlib
+import threading
+import time
 from unittest import mock
 
 import pytest
-from scrapy import Request
+from playhouse.pool import PooledDatabase
+from scrapy import Request, signals
 from scrapy.settings import Settings
+from twisted.internet import defer
+from twisted.python.failure import Failure
 
-from scrapy_db.scheduler import Scheduler
+from scrapy_db.db import get_database
+from scrapy_db.queue import Base, FifoQueue
+from scrapy_db.scheduler import AsyncScheduler, Scheduler
+from scrapy_db.utils import BinaryPickle, POLL_MAX_INTERVAL
+from tests.conftest import _attributes, run_reactor_until
 
 
 @pytest.fixture()
@@ -38,6 +47,10 @@ def test_crawler(crawler):
     assert scheduler.queue_cls == 'class'
     assert scheduler.serializer == importlib.import_module('json')
 
+    crawler.settings.set('SCHEDULER_SERIALIZER', 'scrapy_db.utils.BinaryPickle')
+    scheduler = Scheduler.from_crawler(crawler)
+    assert scheduler.serializer is BinaryPickle
+
     crawler.settings.set('SCHEDULER_IDLE_BEFORE_CLOSE', -1)
     with pytest.raises(TypeError) as e:
         _ = Scheduler.from_crawler(crawler)
@@ -50,10 +63,25 @@ def test_queue_len(scheduler):
 
 
 def test_close(scheduler):
+    scheduler.queue = mock.Mock()
     scheduler.flush = mock.Mock()
     scheduler.persist = False
     scheduler.close()
     assert scheduler.flush.called
+    assert scheduler.queue.close.called
+
+    scheduler.df = mock.Mock()
+    scheduler.persist = True
+    scheduler.close()
+    assert scheduler.flush.call_count == 1
+    assert scheduler.df.checkpoint.called
+
+    scheduler.stats = mock.Mock()
+    with mock.patch('scrapy_db.scheduler.pool_stats', return_value={'checkouts': 3}), \
+            mock.patch('scrapy_db.scheduler.close_databases') as close_databases:
+        scheduler.close()
+    scheduler.stats.set_value.assert_called_with('db/pool/checkouts', 3, spider=scheduler.spider)
+    assert close_databases.called
 
 
 def test_flush(scheduler):
@@ -68,13 +96,13 @@ def test_flush(scheduler):
     assert scheduler.queue.clear.call_count == 3
 
 
-@mock.patch('scrapy_db.scheduler.len')
-def test_has_pending_requests(len_, scheduler):
-    len_.return_value = 4
+def test_has_pending_requests(scheduler):
+    scheduler.queue = mock.Mock()
+    scheduler.queue.has_pending.return_value = True
     assert scheduler.has_pending_requests() is True
-    len_.return_value = 0
+    scheduler.queue.has_pending.return_value = False
     assert scheduler.has_pending_requests() is False
-    assert len_.call_count == 2
+    assert scheduler.queue.has_pending.call_count == 2
 
 
 def test_next_request(scheduler):
@@ -87,12 +115,28 @@ def test_next_request(scheduler):
 
     assert scheduler.next_request().url == 'https://example.com'
     assert scheduler.queue.pop.called
-    scheduler.queue.pop.assert_called_with(30)
+    # the reactor never waits for a push
+    scheduler.queue.pop.assert_called_with()
 
     assert scheduler.stats.inc_value.called
     scheduler.stats.inc_value.assert_called_with('scheduler/dequeued/db', spider=scheduler.spider)
 
 
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_next_request_does_not_block(crawler):
+    crawler.settings.setdict({'SCHEDULER_IDLE_BEFORE_CLOSE': 2, 'SCHEDULER_QUEUE_TABLE': 'test_idle_%(spider)s',
+                              'SCHEDULER_QUEUE_CLASS': 'scrapy_db.queue.FifoQueue'})
+    scheduler = Scheduler.from_crawler(crawler)
+    assert scheduler.idle_before_close == 2
+    spider = mock.Mock(settings=crawler.settings, crawler=None)
+    spider.name = 'test'
+    scheduler.open(spider)
+    start = time.time()
+    assert scheduler.next_request() is None
+    assert time.time() - start < 0.5
+    scheduler.flush()
+
+
 @mock.patch('scrapy_db.scheduler.load_object')
 @mock.patch('scrapy_db.scheduler.len')
 def test_open(len_, load_object, scheduler, mocker):
@@ -131,3 +175,132 @@ def test_enqueue_request(scheduler):
     assert scheduler.enqueue_request(request) is True
     scheduler.stats.inc_value.assert_called_with('scheduler/enqueued/db', spider=spider)
     assert scheduler.queue.push.called
+
+
+@mock.patch('scrapy_db.scheduler.load_object')
+def test_lease_ack(load_object, scheduler):
+    scheduler.crawler = mock.Mock()
+    queue = load_object.return_value.return_value
+    queue.lease_time = 0
+    scheduler.open(mock.Mock())
+    assert not scheduler.crawler.signals.connect.called
+
+    queue.lease_time = 30
+    scheduler.open(mock.Mock())
+    scheduler.crawler.signals.connect.assert_has_calls([
+        mock.call(scheduler._response_received, signal=signals.response_received),
+        mock.call(scheduler._request_left_downloader, signal=signals.request_left_downloader),
+    ])
+    request = Request(url='https://example.com')
+    scheduler._response_received(mock.Mock(), request, mock.Mock())
+    queue.ack.assert_called_with(request)
+    # a failed download is acknowledged too
+    failed = Request(url='https://example.com/failed')
+    scheduler._request_left_downloader(failed, mock.Mock())
+    queue.ack.assert_called_with(failed)
+
+
+@mock.patch('scrapy_db.scheduler.ThreadPool')
+@mock.patch('scrapy_db.scheduler.load_object')
+def test_async_scheduler(load_object, thread_pool, crawler):
+    crawler.settings.set('SCHEDULER_ASYNC_BUFFER_SIZE', 2)
+    scheduler = AsyncScheduler.from_crawler(crawler)
+    assert scheduler.buffer_size == 2
+    scheduler.run_in_thread = defer.maybeDeferred
+    queue = load_object.return_value.return_value
+    queue.lease_time = 0
+    requests = [Request(url=f'https://example.com/{i}') for i in range(3)]
+    queue.pop.side_effect = requests + [None]
+    queue.has_pending.return_value = True
+    scheduler.open(mock.Mock())
+    assert thread_pool.return_value.start.called
+    assert scheduler._shutdown_trigger is not None
+    assert list(scheduler._buffer) == requests[:2]
+
+    assert scheduler.next_request() is requests[0]
+    assert list(scheduler._buffer) == requests[1:]
+    queue.has_pending.return_value = False
+    assert scheduler.next_request() is requests[1]
+    assert scheduler.next_request() is requests[2]
+    assert scheduler.next_request() is None
+    # the database thread waits for a push when the queue is empty
+    scheduler.idle_before_close = 30
+    queue.pop.side_effect = [None]
+    scheduler._refill()
+    queue.pop.assert_called_with(POLL_MAX_INTERVAL)
+    assert not scheduler.has_pending_requests()
+
+    scheduler.df.request_seen.return_value = False
+    assert scheduler.enqueue_request(requests[0]) is True
+    queue.push.assert_called_with(requests[0])
+    assert scheduler.has_pending_requests()
+
+    queue.pop.side_effect = [requests[1], None]
+    scheduler._refill()
+    scheduler.close('finished')
+    queue.push.assert_called_with(requests[1])
+    assert queue.close.called
+    assert thread_pool.return_value.stop.called
+    assert scheduler._shutdown_trigger is None
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_async_scheduler_threads(tmp_path, crawler):
+    crawler.settings.setdict({'DB_URL': f'sqlite:///{tmp_path}/async.db', 'SCHEDULER_PERSIST': True,
+                              'SCHEDULER_QUEUE_CLASS': 'scrapy_db.queue.FifoQueue', 'SCHEDULER_ASYNC_BUFFER_SIZE': 4})
+    scheduler = AsyncScheduler.from_crawler(crawler)
+    spider = mock.Mock(settings=crawler.settings, crawler=None)
+    spider.name = 'test'
+    threads = []
+    with mock.patch.object(FifoQueue, '__len__', autospec=True,
+                           side_effect=lambda q: threads.append(threading.current_thread()) or 0), \
+            mock.patch.object(FifoQueue, 'has_pending', autospec=True,
+                              side_effect=lambda q: threads.append(threading.current_thread()) or Base.has_pending(q)):
+        scheduler.open(spider)
+        run_reactor_until(lambda: not scheduler._refilling)
+    # the queue is counted in the database thread
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+    for i in range(20):
+        assert scheduler.enqueue_request(Request(f'https://example.com/{i}'))
+    run_reactor_until(lambda: not scheduler._enqueuing)
+    # neither the database thread nor the reactor thread keeps a pooled connection between two operations
+    database = get_database(crawler.settings)
+    assert isinstance(database, PooledDatabase)
+    assert not database._in_use
+    assert scheduler.has_pending_requests()
+    # closed while a refill claims requests in the database thread
+    assert scheduler._refilling
+    closed = []
+    scheduler.close('finished').addBoth(closed.append)
+    run_reactor_until(lambda: closed)
+    assert closed == [None]
+    assert not scheduler._buffer
+    assert len(scheduler.queue.db) == 20
+    assert not database._in_use
+
+
+def test_async_scheduler_log_failure(caplog):
+    AsyncScheduler._log_failure(Failure(ValueError('boom')), 'Failed to pop requests')
+    assert caplog.records[-1].getMessage() == 'Failed to pop requests'
+    assert caplog.records[-1].exc_info[1].args == ('boom',)
+
+
+@mock.patch('scrapy_db.scheduler.task.LoopingCall')
+@mock.patch('scrapy_db.scheduler.load_object')
+def test_stats_log(load_object, looping_call, crawler):
+    crawler.settings.setdict({'DB_STATS_LOG_INTERVAL': 30, 'DB_STATS_EXPORT': 'json.dumps'})
+    scheduler = Scheduler.from_crawler(crawler)
+    assert scheduler.stats_log_interval == 30
+    assert scheduler.stats_export is load_object.return_value
+    scheduler.stats_export = export = mock.Mock()
+    spider = mock.Mock()
+    scheduler.open(spider)
+    assert scheduler.spider is spider
+    looping_call.return_value.start.assert_called_with(30, now=False)
+
+    crawler.stats.get_stats.return_value = {'scheduler/db/pop/count': 1, 'scheduler/enqueued/db': 1}
+    with mock.patch('scrapy_db.scheduler.close_databases'):
+        scheduler.close()
+    assert looping_call.return_value.stop.called
+    export.assert_called_with({'scheduler/db/pop/count': 1}, spider)
@@ -1,13 +1,17 @@
+import threading
 import time
 from unittest import mock
 
 import pytest
-from scrapy import signals
+from scrapy import signals, Request, FormRequest
 from scrapy.exceptions import DontCloseSpider
 from scrapy.settings import Settings
+from twisted.python.threadpool import ThreadPool
 
 from scrapy_db import defaults
+from scrapy_db.scheduler import AsyncScheduler
 from scrapy_db.spiders import DBSpider, DBCrawlSpider
+from tests.conftest import _attributes, run_reactor_until
 
 
 class MySpider(DBSpider):
@@ -105,7 +109,7 @@ def test_consume_urls_from_db(db, spider_cls):
     queue = []
     mock_db = mock.Mock()
     mock_db.push = lambda x: queue.append(x)
-    mock_db.fetch_data = lambda x: [mock.Mock(start_url=a) for a in queue]
+    mock_db.fetch_data = lambda x, after=None: [mock.Mock(start_url=a, id=i + 1) for i, a in enumerate(queue)]
     mock_db.__len__ = lambda x: len(queue)
     db.build_model_from_settings.return_value = mock_db
 
@@ -162,3 +166,126 @@ def test_consume_urls_from_db(db, spider_cls):
     spider.max_idle_time = -1
     spider.schedule_next_requests = lambda: time.sleep(0.1)
     assert spider.spider_idle() is None
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_keyset_pagination():
+    crawler = get_crawler()
+    crawler.settings.setdict({'START_URLS_TABLE': 'test_keyset_start_urls', 'CONCURRENT_REQUESTS': 2})
+    spider = MySpider.from_crawler(crawler)
+    spider.db.push_many([{'start_url': f'https://example.com/{i}'} for i in range(5)])
+    spider.db.fetch_data = mock.Mock(wraps=spider.db.fetch_data)
+    assert [r.url for r in spider.next_requests()] == ['https://example.com/0', 'https://example.com/1']
+    assert [r.url for r in spider.next_requests()] == ['https://example.com/2', 'https://example.com/3']
+    assert spider.db.fetch_data.call_args == mock.call(2, after=2)
+    # rows put back behind the cursor are read once the table is exhausted after it
+    spider.db.db.update(deleted=0).where(spider.db.db.id == 1).execute()
+    assert [r.url for r in spider.next_requests()] == ['https://example.com/4']
+    assert [r.url for r in spider.next_requests()] == ['https://example.com/0']
+    assert list(spider.next_requests()) == []
+    assert spider._start_urls_exhausted
+    spider.db.drop_table()
+
+
+@mock.patch('scrapy_db.spiders.DBModel')
+def test_low_watermark(db):
+    crawler = get_crawler()
+    crawler.settings.set('START_URLS_LOW_WATERMARK', 2)
+    spider = MySpider.from_crawler(crawler)
+    assert spider.low_watermark == 2
+    crawler.signals.connect.assert_any_call(spider.request_left_downloader, signal=signals.request_left_downloader)
+    spider.schedule_next_requests = mock.Mock()
+    engine = crawler.engine
+    engine.downloader.active = {1, 2}
+    engine._slot.scheduler.has_pending_requests.return_value = False
+
+    spider.request_left_downloader(mock.Mock(), spider)
+    assert not spider.schedule_next_requests.called
+    engine.downloader.active = {1}
+    engine._slot.scheduler.has_pending_requests.return_value = True
+    spider.request_left_downloader(mock.Mock(), spider)
+    assert not spider.schedule_next_requests.called
+    engine._slot.scheduler.has_pending_requests.return_value = False
+    spider.request_left_downloader(mock.Mock(), spider)
+    assert spider.schedule_next_requests.call_count == 1
+
+    spider._start_urls_exhausted = True
+    spider.request_left_downloader(mock.Mock(), spider)
+    assert spider.schedule_next_requests.call_count == 1
+    with pytest.raises(DontCloseSpider):
+        spider.spider_idle()
+    assert not spider._start_urls_exhausted
+
+
+@mock.patch('scrapy_db.spiders.DBModel')
+def test_json_format(db):
+    crawler = get_crawler()
+    crawler.settings.set('START_URLS_FORMAT', 'json')
+    spider = MySpider.from_crawler(crawler)
+    assert spider.start_urls_format == 'json'
+
+    request = spider.make_request_from_data(mock.Mock(start_url='https://example.com'))
+    assert type(request) is Request
+    assert request.url == 'https://example.com'
+    assert request.dont_filter
+
+    request = spider.make_request_from_data(mock.Mock(
+        start_url='{"url": "https://example.com", "meta": {"a": 1}}'))
+    assert type(request) is Request
+    assert request.meta['a'] == 1
+
+    request = spider.make_request_from_data(mock.Mock(
+        start_url=' \n{"url": "https://example.com", "meta": {"a": 2}}'))
+    assert type(request) is Request
+    assert request.url == 'https://example.com'
+    assert request.meta['a'] == 2
+
+    request = spider.make_request_from_data(mock.Mock(
+        start_url='{"url": "https://example.com", "method": "post", "q": "test"}'))
+    assert isinstance(request, FormRequest)
+    assert request.method == 'POST'
+    assert request.body == b'q=test'
+
+    assert spider.make_request_from_data(mock.Mock(start_url='{"url": ')) == []
+    assert spider.make_request_from_data(mock.Mock(start_url='{"meta": {}}')) == []
+
+    spider = MySpider()
+    spider.start_urls_format = 'xml'
+    with pytest.raises(ValueError) as e:
+        spider.setup_db(get_crawler())
+    assert 'start_urls_format' in str(e.value)
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_async_start_urls(tmp_path):
+    crawler = get_crawler()
+    crawler.settings.setdict({'DB_URL': f'sqlite:///{tmp_path}/start_urls.db', 'CONCURRENT_REQUESTS': 2,
+                              'SCHEDULER': 'scrapy_db.scheduler.AsyncScheduler'})
+    spider = MySpider.from_crawler(crawler)
+    assert spider.start_urls_async
+    spider.db.push_many([{'start_url': f'https://example.com/{i}'} for i in range(3)])
+    spider.db.exists = mock.Mock()
+    spider.spider_idle_start_time = 0
+    threads = []
+    read_start_urls = spider._read_start_urls
+    spider._read_start_urls = lambda: threads.append(threading.current_thread().name) or read_start_urls()
+    scheduler = AsyncScheduler.from_crawler(crawler)
+    scheduler._threadpool = ThreadPool(minthreads=1, maxthreads=1, name='scrapy_db')
+    scheduler._threadpool.start()
+    crawler.engine._slot.scheduler = scheduler
+    try:
+        # the rows are read in the database thread of the scheduler, the requests are scheduled on the reactor
+        with pytest.raises(DontCloseSpider):
+            spider.spider_idle()
+        spider.schedule_next_requests()
+        assert spider._reading_start_urls
+        run_reactor_until(lambda: not spider._reading_start_urls)
+        assert [c.args[0].url for c in crawler.engine.crawl.call_args_list] == [
+            'https://example.com/0', 'https://example.com/1']
+        assert spider.spider_idle_start_time > 0
+        assert not spider.db.exists.called
+        assert len(threads) == 1
+        assert 'scrapy_db' in threads[0]
+    finally:
+        scheduler._threadpool.stop()
+    spider.db.drop_table()
@@ -0,0 +1,73 @@
+from unittest import mock
+
+from scrapy import Request
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+
+from scrapy_db.queue import FifoQueue
+from scrapy_db.stats import DBStats, timer, collect, log_stats
+from tests.conftest import _attributes
+from tests.test_queue import get_spider
+
+
+def get_stats():
+    return MemoryStatsCollector(mock.Mock())
+
+
+def test_db_stats():
+    stats = get_stats()
+    db_stats = DBStats(stats, 'scheduler/db')
+    db_stats.record('pop', 0.0005)
+    db_stats.record('pop', 0.05)
+    db_stats.record('pop', 2)
+    assert stats.get_value('scheduler/db/pop/count') == 3
+    assert stats.get_value('scheduler/db/pop/time') == 2.0505
+    assert stats.get_value('scheduler/db/pop/latency/le_1ms') == 1
+    assert stats.get_value('scheduler/db/pop/latency/le_100ms') == 1
+    assert stats.get_value('scheduler/db/pop/latency/gt_1s') == 1
+
+    with timer(db_stats, 'push'):
+        pass
+    assert stats.get_value('scheduler/db/push/count') == 1
+    with timer(None, 'push'):
+        pass
+
+    stats.set_value('scheduler/enqueued/db', 1)
+    assert set(collect(stats)) == {k for k in stats.get_stats() if k.startswith('scheduler/db/')}
+
+
+def test_from_settings():
+    stats = get_stats()
+    assert DBStats.from_settings(Settings(), stats, 'scheduler/db') is None
+    assert DBStats.from_settings(Settings({'DB_STATS_ENABLED': True}), None, 'scheduler/db') is None
+    assert isinstance(DBStats.from_settings(Settings({'DB_STATS_ENABLED': True}), stats, 'scheduler/db'), DBStats)
+
+
+def test_log_stats(caplog):
+    stats = get_stats()
+    DBStats(stats, 'dupefilter/db').record('request_seen', 0.002)
+    hook = mock.Mock()
+    with caplog.at_level('INFO', logger='scrapy_db.stats'):
+        log_stats(stats, hook, 'spider')
+    assert 'dupefilter/db/request_seen: 1 ops, 2.000 ms avg' in caplog.text
+    hook.assert_called_with(collect(stats), 'spider')
+
+
+@mock.patch('scrapy_db.db._attributes', _attributes)
+def test_queue_stats():
+    spider = get_spider(DB_STATS_ENABLED=True)
+    spider.crawler.stats = get_stats()
+    queue = FifoQueue(spider, 'test_stats_%(spider)s', 'queue')
+    queue.push(Request(url='https://example.com'))
+    assert queue.pop().url == 'https://example.com'
+    values = collect(spider.crawler.stats)
+    for op in ('encode', 'push', 'pop', 'decode'):
+        assert values[f'scheduler/db/{op}/count'] == 1
+
+    # the wait for a push is not a pop latency
+    assert queue.pop(0.2) is None
+    values = collect(spider.crawler.stats)
+    assert values['scheduler/db/pop/count'] == 2
+    assert values['scheduler/db/pop/time'] < 0.1
+    assert values['scheduler/db/pop_wait/count'] == 1
+    assert values['scheduler/db/pop_wait/time'] >= 0.15
@@ -1,6 +1,10 @@
 import time
+from unittest import mock
 
-from scrapy_db.utils import execute_with_timeout, CustomPickle, is_dict, HexPickle
+import pytest
+
+from scrapy_db.utils import execute_with_timeout, CustomPickle, is_dict, HexPickle, BoundedCache, BinaryPickle, \
+    MsgpackSerializer
 
 
 def test_execute_with_timeout(mocker):
@@ -32,8 +36,35 @@ def test_execute_with_timeout(mocker):
     t = time.time()
     spy = mocker.spy(Test, 'call_count')
     assert Test().func(timeout=0.5) is None
-    assert spy.call_count == 5
-    assert 0.6 > time.time() - t >= 0.5
+    assert 2 <= spy.call_count <= 5
+    assert 0.75 > time.time() - t >= 0.5
+
+
+def test_execute_with_timeout_backoff(mocker):
+    sleep = mocker.patch('scrapy_db.utils.time.sleep')
+    calls = []
+
+    @execute_with_timeout
+    def func(timeout=0):
+        calls.append(time.time())
+        return len(calls) == 6
+
+    # positional timeouts are honoured too
+    assert func(5) is True
+    waits = [c.args[0] for c in sleep.call_args_list]
+    assert len(waits) == 5
+    assert all(0.5 * 0.01 * 2 ** i <= w <= 0.01 * 2 ** i for i, w in enumerate(waits))
+
+    class Queue(object):
+        wait_for_push = mocker.Mock()
+
+        @execute_with_timeout
+        def pop(self, timeout=0):
+            return self.wait_for_push.call_count == 2
+
+    assert Queue().pop(timeout=5)
+    assert Queue.wait_for_push.call_count == 2
+    assert sleep.call_count == 5
 
 
 def test_custom_json():
@@ -66,3 +97,51 @@ def test_hex_pickle():
     assert isinstance(r, dict)
     assert r['test123'] == 'test value'
     assert isinstance(r['test bytes'], bytes)
+
+
+def test_binary_pickle():
+    data = {'body': b'\x00' * 100000, 'url': 'https://example.com'}
+    result = BinaryPickle.dumps(data)
+    assert isinstance(result, bytes)
+    assert BinaryPickle.loads(result) == data
+    assert BinaryPickle.loads(memoryview(result)) == data
+
+
+def test_msgpack_serializer():
+    pytest.importorskip('msgpack')
+    data = {'headers': {b'Accept': [b'*/*']}, 'body': b'test', 'meta': {'depth': 1}}
+    result = MsgpackSerializer.dumps(data)
+    assert isinstance(result, bytes)
+    assert MsgpackSerializer.loads(result) == data
+
+
+@mock.patch('scrapy_db.utils.msgpack', None)
+def test_msgpack_serializer_missing():
+    for func, arg in ((MsgpackSerializer.dumps, {}), (MsgpackSerializer.loads, b'\x80')):
+        with pytest.raises(ImportError) as e:
+            func(arg)
+        assert 'msgpack' in str(e.value)
+
+
+@pytest.mark.parametrize('policy, kept', [
+    ('lru', {'a', 'c'}),
+    ('fifo', {'b', 'c'}),
+])
+def test_bounded_cache(policy, kept):
+    cache = BoundedCache(2, policy)
+    cache.add('a')
+    cache.add('b', 'value')
+    assert 'a' in cache
+    assert cache.get('b') == 'value'
+    assert cache.get('x', 1) == 1
+    assert 'a' in cache
+    cache.add('c')
+    assert len(cache) == 2
+    assert {k for k in 'abc' if k in cache} == kept
+    cache.clear()
+    assert len(cache) == 0
+
+    with pytest.raises(ValueError):
+        BoundedCache(0)
+    with pytest.raises(ValueError):
+        BoundedCache(1, 'random')